@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+
+    blog.cache
+    ~~~~~~~~~~~~~~~~~~
+
+    Full-page response cache for the read-mostly public views;
+    pages are stored in any werkzeug.contrib.cache backend and
+    keyed on the site-wide generation number, which the data
+    layer bumps on every write.
+
+    :copyright: (c) 2010 by Gianluca Bargelli.
+    :license: MIT License, see LICENSE for more details.
+
+
+"""
+
+import hashlib
+import threading
+from werkzeug.contrib.cache import NullCache, SimpleCache, \
+     MemcachedCache, GAEMemcachedCache, FileSystemCache
+
+
+class ResponseCache(object):
+    """
+    Stores rendered responses as (body, status, headers) tuples,
+    so that every backend can pickle them.
+
+    Hits, misses and the size of the pages stored by this process
+    for the current generation are tracked for reporting.
+    """
+
+    def __init__(self, backend, timeout=300):
+        self.backend = backend
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        # (generation, key) -> body size of the pages stored so far
+        self._sizes = {}
+
+    def make_key(self, generation, logged_in, path, query_string):
+        """Returns the backend key of a page (hashed, for memcached)."""
+        raw = repr((generation, bool(logged_in), path, query_string))
+        return 'page:' + hashlib.sha1(raw).hexdigest()
+
+    def get(self, generation, key, response_class):
+        """Returns the cached response for key, or None on a miss."""
+        cached = self.backend.get(key)
+
+        self._lock.acquire()
+        try:
+            if cached is None:
+                self._misses += 1
+                self._sizes.pop((generation, key), None)
+            else:
+                self._hits += 1
+        finally:
+            self._lock.release()
+
+        if cached is not None:
+            data, status, headers = cached
+            return response_class(data, status=status, headers=headers)
+
+    def set(self, generation, key, response):
+        """
+        Stores a response without its cookies, which belong to the
+        client that triggered the rendering; pages of older generations
+        are forgotten.
+        """
+        data = response.data
+        headers = [(name, value) for name, value in response.headers.to_list()
+                   if name.lower() != 'set-cookie']
+        self.backend.set(key, (data, response.status_code, headers),
+                         timeout=self.timeout)
+
+        self._lock.acquire()
+        try:
+            for stored in self._sizes.keys():
+                if stored[0] != generation:
+                    del self._sizes[stored]
+            self._sizes[(generation, key)] = len(data)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns hits, misses, the hit ratio and the bytes held by the
+        pages this process stored for the current generation.
+        """
+        self._lock.acquire()
+        try:
+            lookups = self._hits + self._misses
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_ratio': lookups and float(self._hits) / lookups,
+                    'pages': len(self._sizes),
+                    'bytes': sum(self._sizes.values())}
+        finally:
+            self._lock.release()
+
+
+def factory(config):
+    """
+    Returns a ResponseCache on the backend named by CACHE_TYPE
+    (null, simple, memcached, gaememcached or filesystem).
+    """
+    cache_type = config['CACHE_TYPE']
+    timeout = config['CACHE_DEFAULT_TIMEOUT']
+
+    if cache_type == 'simple':
+        backend = SimpleCache(threshold=config['CACHE_THRESHOLD'],
+                              default_timeout=timeout)
+    elif cache_type == 'memcached':
+        backend = MemcachedCache(config['CACHE_MEMCACHED_SERVERS'],
+                                 default_timeout=timeout,
+                                 key_prefix=config['CACHE_KEY_PREFIX'])
+    elif cache_type == 'gaememcached':
+        backend = GAEMemcachedCache(default_timeout=timeout,
+                                    key_prefix=config['CACHE_KEY_PREFIX'])
+    elif cache_type == 'filesystem':
+        backend = FileSystemCache(config['CACHE_DIR'],
+                                  threshold=config['CACHE_THRESHOLD'],
+                                  default_timeout=timeout)
+    else:
+        backend = NullCache()
+
+    return ResponseCache(backend, timeout)
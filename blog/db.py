@@ -6,7 +6,8 @@
 
     Experimental library to implement a data layer for
     Proudlygeek's blog app. It currently supports sqlite
-    and Google App Engine's Datastore.
+    and Google App Engine's Datastore, plus an in-memory
+    layer for the tests and the benchmarks.
 
 
     :copyright: (c) 2010 by Gianluca Bargelli.
@@ -20,21 +21,39 @@ from flask import g, Markup
 from blog.helpers import slugify_entry, filter_projects
 
 
-if app.config['PLATFORM']=='sqlite':
+# The memory layer reads its sample users from the sqlite fixtures
+if app.config['PLATFORM'] in ('sqlite', 'memory'):
     try:
         import sqlite3
+        import bisect
         import datetime
+        import os
+        import re
+        import threading
+        import time
+        import Queue
+        import logging
+        import logging.handlers
+        import collections
+        from itertools import izip
         from contextlib import closing
-        from blog.helpers import fill_entries
+        from blog import metrics
+        from blog.helpers import fill_entries, fill_tags, fill_author, \
+             fill_humanized_dates, render_markdown, render_version, \
+             highlight_snippet, split_excerpt, chunks, MAX_SQL_VARIABLES
     except ImportError:
         print "Database Wrapper error (sqlite)."
 
 if app.config['PLATFORM']=='gae':
     try:
+        import random
+        import datetime
         from google.appengine.ext import db
-        from blog.models import User, Entry
-        from blog.helpers import fill_markdown_content, \
-             generate_readmore
+        from google.appengine.ext import deferred
+        from google.appengine.api import memcache
+        from blog.models import User, Entry, CounterShard
+        from blog.helpers import render_markdown, render_version, \
+             split_excerpt, chunks
 
     except ImportError:
         print "Database Wrapper error (GAE)."
@@ -44,41 +63,541 @@ class DataLayer(object):
     def __init__(self):
         pass
 
+    def dispose(self):
+        """Releases the layer's connections, if it keeps any."""
+        pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of sqlite connections which stay open (and keep
+    their page cache warm) across requests.
+
+    Connections are opened lazily up to *size*; when all of them are
+    checked out, callers wait up to *timeout* seconds for one to be
+    checked in again. Every new connection is an instance of
+    *factory* (a sqlite3.Connection subclass, sqlite3.Connection
+    itself by default) and runs the given PRAGMA statements, e.g.
+    ``journal_mode=WAL``.
+    """
+
+    def __init__(self, database, size=5, timeout=10.0, pragmas=(),
+                 factory=None):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.factory = factory
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def connect(self):
+        """Opens a new connection configured with the pool's pragmas."""
+        conn = sqlite3.connect(self.database, check_same_thread=False,
+                               factory=self.factory or sqlite3.Connection)
+        for pragma in self.pragmas:
+            conn.execute('PRAGMA %s' % pragma)
+        return conn
+
+    def checkout(self):
+        """Returns an idle connection, opening or waiting for one if needed."""
+        try:
+            conn = self._idle.get_nowait()
+        except Queue.Empty:
+            conn = None
+
+        if conn is None:
+            self._lock.acquire()
+            try:
+                grow = self._opened < self.size
+                if grow:
+                    self._opened += 1
+            finally:
+                self._lock.release()
+
+            if grow:
+                try:
+                    conn = self.connect()
+                except:
+                    self._discard()
+                    raise
+            else:
+                start = time.time()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Queue.Empty:
+                    raise sqlite3.OperationalError(
+                          'No connection available after %.1f seconds '
+                          '(pool size %d).' % (self.timeout, self.size))
+                waited = time.time() - start
+                self._lock.acquire()
+                try:
+                    self._waits += 1
+                    self._wait_time += waited
+                    self._max_wait_time = max(self._max_wait_time, waited)
+                finally:
+                    self._lock.release()
+
+        self._lock.acquire()
+        try:
+            self._checkouts += 1
+        finally:
+            self._lock.release()
+        return conn
+
+    def checkin(self, conn):
+        """
+        Gives a connection back to the pool; any transaction left
+        open by the borrower is rolled back first.
+        """
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            self._discard()
+        else:
+            self._idle.put(conn)
+
+    def dispose(self):
+        """Closes every idle connection."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            conn.close()
+            self._discard()
+
+    def stats(self):
+        """Returns a dictionary describing the pool usage so far."""
+        self._lock.acquire()
+        try:
+            return {'size': self.size,
+                    'open': self._opened,
+                    'idle': self._idle.qsize(),
+                    'in_use': self._opened - self._idle.qsize(),
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'wait_time': self._wait_time,
+                    'max_wait_time': self._max_wait_time}
+        finally:
+            self._lock.release()
+
+    def _discard(self):
+        """Forgets about a connection which has been closed."""
+        self._lock.acquire()
+        try:
+            self._opened -= 1
+        finally:
+            self._lock.release()
+
+
+class QueryLog(object):
+    """
+    Records the statements run through instrumented cursors: their
+    text, the shape of their parameters, their duration (up to the
+    last fetched row) and their row count.
+
+    The latest *size* records are kept, with totals per statement.
+    The query plan of every distinct statement is looked up once, and
+    plans scanning a whole table are flagged; those and the statements
+    slower than SQLITE_SLOW_QUERY_MS go to the rotating slow log.
+    """
+
+    def __init__(self, size=200):
+        self.recent = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._plans = {}
+        self._logger = None
+        self._log_path = None
+
+    def add(self, conn, sql, parameters, seconds, rows, many=False):
+        """Records a finished statement and logs it if it is slow."""
+        key = statement_key(sql)
+        sample = parameters
+        if many:
+            sample = parameters and parameters[0] or ()
+        plan, scans, new = self.plan(conn, key, sql, sample)
+
+        record = {'sql': key,
+                  'parameters': parameters_shape(parameters, many),
+                  'seconds': seconds,
+                  'rows': rows,
+                  'plan': plan,
+                  'scans': scans,
+                  'slow': seconds * 1000.0 >= app.config['SQLITE_SLOW_QUERY_MS']}
+        self.recent.append(record)
+
+        self._lock.acquire()
+        try:
+            totals = self._totals.get(key)
+            if totals is None:
+                totals = self._totals[key] = {'sql': key, 'calls': 0,
+                                              'seconds': 0.0, 'rows': 0,
+                                              'max_seconds': 0.0,
+                                              'scans': scans}
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['rows'] += rows
+            totals['max_seconds'] = max(totals['max_seconds'], seconds)
+        finally:
+            self._lock.release()
+
+        if record['slow']:
+            self.log('Slow statement', record)
+        elif scans and new:
+            self.log('Full table scan', record)
+        return record
+
+    def plan(self, conn, key, sql, parameters):
+        """
+        Returns the query plan of a statement (its detail lines), the
+        tables it scans in full and whether it was looked up now.
+        """
+        try:
+            plan, scans = self._plans[key]
+            return plan, scans, False
+        except KeyError:
+            pass
+
+        try:
+            # A plain cursor, which is not recorded in turn
+            cursor = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+            plan = [row[-1] for row in
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, parameters)]
+            cursor.close()
+        except sqlite3.Error:
+            # e.g. statements which cannot be explained
+            plan = []
+        scans = scanned_tables(plan)
+        self._plans[key] = plan, scans
+        return plan, scans, True
+
+    def stats(self):
+        """Returns the totals per statement, the slowest overall first."""
+        self._lock.acquire()
+        try:
+            totals = [dict(item) for item in self._totals.itervalues()]
+        finally:
+            self._lock.release()
+        totals.sort(key=lambda item: item['seconds'], reverse=True)
+        return totals
+
+    def reset(self):
+        """Forgets the records, the totals and the plans."""
+        self._lock.acquire()
+        try:
+            self.recent.clear()
+            self._totals.clear()
+            self._plans.clear()
+        finally:
+            self._lock.release()
+
+    def log(self, reason, record):
+        """Writes a record to the slow log."""
+        logger = self.logger()
+        if logger is None:
+            return
+        lines = ['%s: %.1f ms, %d rows, parameters %s'
+                 % (reason, record['seconds'] * 1000.0, record['rows'],
+                    record['parameters']),
+                 '    ' + record['sql']]
+        lines.extend(['    plan: ' + detail for detail in record['plan']])
+        if record['scans']:
+            lines.append('    full scan of: ' + ', '.join(record['scans']))
+        logger.warning('\n'.join(lines))
+
+    def logger(self):
+        """
+        Returns the slow log, a rotating file at SQLITE_SLOW_QUERY_LOG
+        (None when that is not set).
+        """
+        path = app.config['SQLITE_SLOW_QUERY_LOG']
+        if path != self._log_path:
+            self._lock.acquire()
+            try:
+                logger = logging.getLogger('blog.slow_queries')
+                logger.propagate = False
+                for handler in logger.handlers[:]:
+                    logger.removeHandler(handler)
+                    handler.close()
+                if path:
+                    handler = logging.handlers.RotatingFileHandler(path,
+                              maxBytes=app.config['SQLITE_SLOW_QUERY_LOG_BYTES'],
+                              backupCount=app.config['SQLITE_SLOW_QUERY_LOG_BACKUPS'])
+                    handler.setFormatter(logging.Formatter(
+                                         '%(asctime)s %(message)s'))
+                    logger.addHandler(handler)
+                    self._logger = logger
+                else:
+                    self._logger = None
+                self._log_path = path
+            finally:
+                self._lock.release()
+        return self._logger
+
+
+if app.config['PLATFORM']=='sqlite':
+    query_log = QueryLog()
+
+    class InstrumentedCursor(sqlite3.Cursor):
+        """
+        A cursor which records its statements in the query log (and
+        their time in the db phase of the request metrics) once their
+        last row has been fetched.
+        """
+
+        _statement = None
+
+        def execute(self, sql, parameters=()):
+            self._finish()
+            start = time.time()
+            try:
+                sqlite3.Cursor.execute(self, sql, parameters)
+            finally:
+                self._statement = [sql, parameters, time.time() - start, 0,
+                                   False]
+            if self.description is None:
+                self._finish(self.rowcount)
+            return self
+
+        def executemany(self, sql, seq_of_parameters):
+            self._finish()
+            seq_of_parameters = list(seq_of_parameters)
+            start = time.time()
+            try:
+                sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+            finally:
+                self._statement = [sql, seq_of_parameters,
+                                   time.time() - start, 0, True]
+            self._finish(self.rowcount)
+            return self
+
+        def fetchone(self):
+            start = time.time()
+            row = sqlite3.Cursor.fetchone(self)
+            self._fetched(start, row is not None and 1 or 0, row is None)
+            return row
+
+        def fetchmany(self, size=None):
+            if size is None:
+                size = self.arraysize
+            start = time.time()
+            rows = sqlite3.Cursor.fetchmany(self, size)
+            self._fetched(start, len(rows), len(rows) < size)
+            return rows
+
+        def fetchall(self):
+            start = time.time()
+            rows = sqlite3.Cursor.fetchall(self)
+            self._fetched(start, len(rows), True)
+            return rows
+
+        def next(self):
+            start = time.time()
+            try:
+                row = sqlite3.Cursor.next(self)
+            except StopIteration:
+                self._fetched(start, 0, True)
+                raise
+            self._fetched(start, 1, False)
+            return row
+
+        def close(self):
+            self._finish()
+            sqlite3.Cursor.close(self)
+
+        def __del__(self):
+            # Statements whose rows were not all fetched
+            try:
+                self._finish()
+            except Exception:
+                pass
+
+        def _fetched(self, start, rows, done):
+            statement = self._statement
+            if statement is not None:
+                statement[2] += time.time() - start
+                statement[3] += rows
+                if done:
+                    self._finish()
+
+        def _finish(self, rows=None):
+            statement = self._statement
+            if statement is not None:
+                self._statement = None
+                sql, parameters, seconds, fetched, many = statement
+                if rows is None or rows < 0:
+                    rows = fetched
+                metrics.add('db', seconds)
+                if app.config['SQLITE_SLOW_QUERY_MS'] is not None:
+                    query_log.add(self.connection, sql, parameters,
+                                  seconds, rows, many)
+
+    class InstrumentedConnection(sqlite3.Connection):
+        """
+        The default class of the pooled connections: its cursors (and
+        so Connection.execute, which goes through cursor()) are
+        instrumented while queries are being logged or the request
+        is being timed.
+        """
+
+        def cursor(self, factory=None):
+            if factory is None:
+                if app.config['SQLITE_SLOW_QUERY_MS'] is not None \
+                   or metrics.timing():
+                    factory = InstrumentedCursor
+                else:
+                    factory = sqlite3.Cursor
+            return sqlite3.Connection.cursor(self, factory)
+
 
 class SQLiteLayer(DataLayer):
+    # The class of the pooled connections (e.g. one counting queries),
+    # InstrumentedConnection when None
+    connection_factory = None
+
     def __init__(self):
         super(SQLiteLayer, self).__init__()
+        self._pool = None
+        # Page-boundary indexes of the listings, keyed by DATABASE,
+        # tag name and page size (see page_boundaries)
+        self._page_boundaries = {}
+        # Held while a background re-render pass is running
+        self._rerender_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """
+        The connection pool for the configured DATABASE; it is built
+        again whenever the setting or the connection_factory changes
+        (e.g. between tests).
+        """
+        database = app.config['DATABASE']
+        factory = self.connection_factory or InstrumentedConnection
+        if self._pool is None or self._pool.database != database \
+           or self._pool.factory is not factory:
+            if self._pool is not None:
+                self._pool.dispose()
+            self._pool = ConnectionPool(database,
+                         size=app.config['SQLITE_POOL_SIZE'],
+                         timeout=app.config['SQLITE_POOL_TIMEOUT'],
+                         pragmas=('journal_mode=WAL',
+                                  'synchronous=NORMAL',
+                                  'cache_size=%d' % app.config['SQLITE_CACHE_SIZE'],
+                                  'mmap_size=%d' % app.config['SQLITE_MMAP_SIZE']),
+                         factory=factory)
+        return self._pool
 
     def connect_db(self):
-        """Returns a new connection to the database."""
-        return sqlite3.connect(app.config['DATABASE'])
+        """Checks out a pooled connection to the database."""
+        return self.pool.checkout()
+
+    def pool_stats(self):
+        """Returns the connection pool statistics (see ConnectionPool.stats)."""
+        return self.pool.stats()
+
+    def dispose(self):
+        """Closes every pooled connection."""
+        if self._pool is not None:
+            self._pool.dispose()
+        self._page_boundaries.clear()
 
     def init_db(self, testdb=False):
-        """Creates the database tables."""
-#        if not testdb:
-#            schema = 'schema.sql'
-#        else:
-#            schema = 'fixture-sqlite.sql'
-#            DATABASE = 'blog.db'
-#
-#        with closing(self.connect_db()) as db:
-#            with app.open_resource(schema) as f:
-#                db.cursor().executescript(f.read())
-#            db.commit()
-        pass
-    
+        """
+        Creates the database tables (with the sample users, for tests)
+        and brings them up to date with every migration.
+        """
+        if not testdb:
+            schema = 'schema/schema.sql'
+        else:
+            schema = 'schema/fixture-sqlite.sql'
+
+        conn = self.connect_db()
+        try:
+            f = app.open_resource(schema)
+            try:
+                conn.executescript(f.read())
+            finally:
+                f.close()
+            self.migrate(conn)
+        finally:
+            self.pool.checkin(conn)
+        # The generation number starts again
+        self._page_boundaries.clear()
+
+    def schema_version(self, conn):
+        """Returns the schema version recorded in the database."""
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, conn):
+        """
+        Applies, in order, the migrations newer than the schema version
+        of the database and returns the list of the applied versions.
+
+        Each migration runs in a transaction together with the bump of
+        PRAGMA user_version, so a failing one leaves the database at the
+        previous version.
+
+        The full-text index needs a sqlite3 library built with FTS5;
+        without it the migration creating the index only bumps the
+        version, and searching finds nothing (see search_entries).
+        """
+        applied = []
+        current = self.schema_version(conn)
+        for version, path in list_migrations():
+            if version <= current:
+                continue
+            f = open(path)
+            try:
+                script = f.read()
+            finally:
+                f.close()
+            if 'USING fts5' in script and not has_fts5():
+                script = ''
+            try:
+                conn.executescript('BEGIN;\n%s\nPRAGMA user_version = %d;\nCOMMIT;'
+                                   % (script, version))
+            except sqlite3.Error, e:
+                # executescript stops at the failing statement and leaves
+                # the transaction open (newer sqlite3 modules roll it back)
+                try:
+                    conn.executescript('ROLLBACK;')
+                except sqlite3.OperationalError:
+                    pass
+                raise sqlite3.OperationalError('Migration %s failed: %s'
+                                               % (os.path.basename(path), e))
+            applied.append(version)
+        return applied
+
     def close(self):
-        """Closes the database connection at the end of the request."""
-        g.db.close()
+        """Returns the database connection to the pool at the end of the request."""
+        self.pool.checkin(g.db)
 
-    def query_db(self, query, args=(), one=False):
-        """Queries the database and returns a list of dictionaries."""
+    def query_db(self, query, args=(), one=False, lazy=False):
+        """
+        Queries the database and returns a list of dictionaries (the
+        templates and helpers add keys to them), or the first one with
+        *one*; with *lazy* the rows are fetched in batches as the
+        returned iterator is consumed, e.g. for scans of every entry.
+        """
         cur = g.db.execute(query, args)
-        rv = [dict((cur.description[idx][0], value)
-        for idx, value in enumerate(row)) for row in cur.fetchall()]
-        return (rv[0] if rv else None) if one else rv
+        # sqlite3 leaves no description for WITH statements without rows
+        names = [column[0] for column in cur.description or ()]
+        if lazy:
+            return iter_rows(cur, names)
+        if one:
+            row = cur.fetchone()
+            return dict(izip(names, row)) if row is not None else None
+        return [dict(izip(names, row)) for row in cur.fetchall()]
     
-    def get_entries(self, tagname, offset):
+    def get_entries(self, tagname, offset, before=None):
         """
         Retrieves entries from the database. 
         It returns a tuple following the scheme:
@@ -87,51 +606,134 @@ class SQLiteLayer(DataLayer):
 
         Where entries_list is a list of entries for the given tagname
         (which can be None) and #entries is their total number.
+
+        Untagged pages are fetched with a keyset seek on
+        (creation_date, id): *before* is a cursor (see page_cursor) and
+        only older entries are returned; a plain offset is translated
+        into the cursor of the preceding page through the cached
+        page-boundary index, so deep pages cost the same as the first one.
+        Tag listings are paged with LIMIT/OFFSET on the
+        entry_tags_tag index.
+
+        The totals come from the counter table (see count_entries); only
+        the LISTING_COLUMNS of the entries are read.
         """
         if not tagname:
-            entries = self.query_db(
-                      """
-                      SELECT *
-                      FROM Entry
-                      ORDER BY creation_date DESC, id DESC 
-                      LIMIT ? OFFSET ? 
-                      """, 
-                      (app.config['MAX_PAGE_ENTRIES'], offset))
-
-            num_entries = self.query_db(
+            num_entries = self.count_entries()
+
+            if before is None and offset:
+                page = offset // app.config['MAX_PAGE_ENTRIES'] + 1
+                before = self.page_cursor(None, page)
+                if before is None:
+                    return [], num_entries
+                before = parse_cursor(before)
+            elif before is not None:
+                before = parse_cursor(before)
+
+            if before is None:
+                entries = self.query_db(
+                          """
+                          SELECT %s
+                          FROM Entry
+                          ORDER BY creation_date DESC, id DESC 
+                          LIMIT ?
+                          """ % LISTING_COLUMNS, 
+                          (render_version(), app.config['MAX_PAGE_ENTRIES']))
+            else:
+                entries = self.query_db(
                           """
-                          SELECT COUNT(*)
+                          SELECT %s
                           FROM Entry
-                          """,
-                          one=True)['COUNT(*)']
+                          WHERE creation_date <= ?
+                          AND (creation_date < ? OR id < ?)
+                          ORDER BY creation_date DESC, id DESC 
+                          LIMIT ?
+                          """ % LISTING_COLUMNS, 
+                          (render_version(), before[0], before[0], before[1],
+                           app.config['MAX_PAGE_ENTRIES']))
 
         else:
             entries = self.query_db(
                       """
-                      SELECT entry.id, entry.slug, entry.title, entry.body, 
-                      entry.last_date,entry.creation_date FROM entry
+                      SELECT %s FROM entry
                       JOIN entry_tags ON entry.id = entry_tags.id_entry_FK
                       JOIN tag ON entry_tags.id_tag_FK = tag.id
                       WHERE tag.name = ?
                       ORDER BY entry.creation_date DESC, entry.id DESC
-                      """,
-                      [tagname])
-
-            num_entries = self.query_db(
-                    """
-                    SELECT COUNT(*)
-                    FROM entry
-                    JOIN entry_tags ON entry.id = entry_tags.id_entry_FK
-                    JOIN tag on entry_tags.id_tag_FK = tag.id
-                    WHERE tag.name = ?
-                    """,
-                    [tagname], one=True)['COUNT(*)']
+                      LIMIT ? OFFSET ?
+                      """ % LISTING_COLUMNS,
+                      (render_version(), tagname,
+                       app.config['MAX_PAGE_ENTRIES'], offset))
+
+            num_entries = self.count_entries(tagname)
         
         # Filling entries (Join tables for sqlite)
         fill_entries(entries)
         # Return the entries 
         return entries, num_entries
 
+    def page_boundaries(self, tagname):
+        """
+        Returns the page-boundary index of the listing of the given tag
+        (if any): the sort keys of the last entry of every page followed
+        by another one, oldest first.
+
+        The index is read from the entry_date (or entry_tags_tag) index
+        and cached per database, tag and page size until the generation
+        number moves, i.e. until the next write.
+        """
+        size = app.config['MAX_PAGE_ENTRIES']
+        key = (app.config['DATABASE'], tagname, size)
+        generation = self.generation()
+        cached = self._page_boundaries.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        if not tagname:
+            keys = g.db.execute(
+                   """
+                   SELECT creation_date, id
+                   FROM entry
+                   ORDER BY creation_date DESC, id DESC
+                   """).fetchall()
+        else:
+            keys = g.db.execute(
+                   """
+                   SELECT entry.creation_date, entry.id FROM entry
+                   JOIN entry_tags ON entry.id = entry_tags.id_entry_FK
+                   JOIN tag ON entry_tags.id_tag_FK = tag.id
+                   WHERE tag.name = ?
+                   ORDER BY entry.creation_date DESC, entry.id DESC
+                   """, (tagname,)).fetchall()
+        boundaries = [tuple(row) for row in keys[size-1:-1:size]]
+        boundaries.reverse()
+        self._page_boundaries[key] = (generation, boundaries)
+        return boundaries
+
+    def page_cursor(self, tagname, page):
+        """
+        Returns the ?before= cursor of the given page number, i.e. the
+        sort key of the last entry of the previous page, or None for the
+        first page (and for pages past the end); tag listings are paged
+        by number only.
+        """
+        if tagname or page < 2:
+            return None
+
+        boundaries = self.page_boundaries(None)
+        if page - 1 <= len(boundaries):
+            return format_cursor(boundaries[-(page-1)])
+
+    def page_number(self, tagname, before):
+        """
+        Returns the page number a ?before= cursor points to in the
+        listing of the given tag (if any): one more than the number of
+        page boundaries at or after the cursor.
+        """
+        boundaries = self.page_boundaries(tagname)
+        return len(boundaries) - bisect.bisect_left(boundaries,
+                                                    parse_cursor(before)) + 1
+
     def get_entry(self, title, entry_date):
         """
         Retrieves a specific entry by specifing a creation date
@@ -150,7 +752,21 @@ class SQLiteLayer(DataLayer):
             fill_entries([entry])
             return entry
 
-    
+    def get_entry_by_id(self, entry_id):
+        """
+        Retrieves a specific entry by specifing an unique
+        ID as argument; this method is expecting to fetch
+        one or none entries from the database.
+        """
+        entry = self.query_db('SELECT * FROM entry WHERE id = ?',
+                              [entry_id], one=True)
+
+        if entry:
+            # The name the datastore entries use
+            entry['entry_id'] = entry['id']
+            fill_tags([entry])
+            return entry
+
     def get_recent_entries(self, n):
         """
         Retrieves the latest n entries sorted by descending date
@@ -158,17 +774,115 @@ class SQLiteLayer(DataLayer):
         """
         entries = self.query_db(
                               """
-                              SELECT *
+                              SELECT %s
                               FROM Entry
                               ORDER BY creation_date DESC, id DESC 
                               LIMIT ? 
-                              """, 
-                              n)
+                              """ % LISTING_COLUMNS, 
+                              (render_version(), n))
 
         # Filling entries (Join tables for sqlite)
         fill_entries(entries)
         return entries
 
+    def has_search_index(self):
+        """Returns whether the database has the full-text index."""
+        return self.query_db("SELECT 1 FROM sqlite_master \
+                              WHERE name = 'entry_search'",
+                             one=True) is not None
+
+    def search_entries(self, query, offset):
+        """
+        Full-text search over the entries' titles and bodies.
+        It returns a tuple following the scheme:
+
+        (entries_list, #results)
+
+        Where entries_list holds a page of the matching entries, best
+        first (bm25, with title matches weighing more than body ones),
+        each one with a highlighted *snippet* of its text.
+
+        Only the newest SEARCH_MAX_RESULTS matches are ranked, which
+        bounds the cost of queries made of very common words; the
+        snippets are built for the returned page alone.
+
+        Databases migrated without FTS5 have no index, and like the
+        datastore they find nothing.
+        """
+        match = fts_query(query)
+        if not match or not self.has_search_index():
+            return [], 0
+
+        limit = app.config['SEARCH_MAX_RESULTS']
+        entries = self.query_db(
+                  """
+                  WITH candidates AS (
+                      SELECT rowid, bm25(entry_search, 10.0, 1.0) AS score
+                      FROM entry_search
+                      WHERE entry_search MATCH ?
+                      ORDER BY rowid DESC
+                      LIMIT ?),
+                  page AS (
+                      SELECT rowid, score
+                      FROM candidates
+                      ORDER BY score
+                      LIMIT ? OFFSET ?)
+                  SELECT entry.*,
+                  snippet(entry_search, 1, char(2), char(3), '...', ?)
+                  AS snippet
+                  FROM page
+                  JOIN entry_search ON entry_search.rowid = page.rowid
+                  JOIN entry ON entry.id = page.rowid
+                  WHERE entry_search MATCH ?
+                  ORDER BY page.score
+                  """,
+                  (match, limit, app.config['MAX_PAGE_ENTRIES'], offset,
+                   app.config['SEARCH_SNIPPET_WORDS'], match))
+
+        num_results = self.query_db(
+                      """
+                      SELECT COUNT(*) AS results
+                      FROM (SELECT rowid FROM entry_search
+                            WHERE entry_search MATCH ?
+                            ORDER BY rowid DESC
+                            LIMIT ?)
+                      """,
+                      (match, limit), one=True)['results']
+
+        for entry in entries:
+            entry['snippet'] = highlight_snippet(entry['snippet'])
+        fill_entries(entries)
+        return entries, num_results
+
+    def get_archive(self):
+        """
+        Returns the id, slug, dates and tags of every entry, newest
+        first and without their texts; the freeze command enumerates
+        the pages of the blog from it.
+        """
+        entries = self.query_db(
+                  """
+                  SELECT id, slug, creation_date, last_date
+                  FROM entry
+                  ORDER BY creation_date DESC, id DESC
+                  """)
+        fill_tags(entries)
+        return entries
+
+
+    def get_entry_list(self):
+        """
+        Returns the id, slug, title, author and tags of every entry,
+        for the admin panel.
+        """
+        entries = self.query_db(
+                  """
+                  SELECT id, user_id_FK, slug, title 
+                  FROM entry
+                  """)
+        fill_tags(entries)
+        fill_author(entries)
+        return entries
 
     def get_user(self, username):
         """Return the user model if the given username exists."""
@@ -202,49 +916,307 @@ class SQLiteLayer(DataLayer):
         """Inserts a new entry post into the database."""
         today = datetime.date.today()
         creation_date = today.strftime('%Y-%m-%d')
-        last_date = creation_date
+        # last_date is a UTC timestamp, it backs the HTTP validators
+        last_date = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        content_html = render_markdown(text)
 
-        g.db.execute(
+        cur = g.db.execute(
         """
-        INSERT INTO entry
-        VALUES (null, ?, ?, ?, ?, ?, ?)
+        INSERT INTO entry (id, slug, title, body, content_html,
+                           excerpt_html, render_version, creation_date,
+                           last_date, user_id_FK)
+        VALUES (null, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (slugify_entry(title),
          title,
          text,
+         content_html,
+         split_excerpt(content_html),
+         render_version(),
          creation_date,
          last_date,
          g.user['id']))
 
+        # Tags and counters are written in the same transaction as the entry
+        self.process_tags(cur.lastrowid, tags.split())
+        self.bump_counters({'entries': 1, 'generation': 1})
+        g.db.commit()
+
+    def insert_entries(self, entries, owner):
+        """
+        Inserts a batch of entries in a single transaction and returns
+        how many were inserted. Entries are dictionaries with a title,
+        slug, body, content_html, render_version, creation_date (a date)
+        and a list of tags (the excerpt is taken from content_html);
+        those whose slug and date are already taken are skipped, so an
+        import can be run again.
+
+        Ids are handed out inside the transaction, which lets entries,
+        tags and entry_tags all be written with executemany.
+        """
+        last_date = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+        # Taking the write lock up front keeps the ids free
+        g.db.execute('BEGIN IMMEDIATE')
+        try:
+            taken = set()
+            for chunk in chunks(list(set([entry['slug'] for entry in entries])),
+                                MAX_SQL_VARIABLES):
+                taken.update(g.db.execute(
+                             """
+                             SELECT slug, creation_date FROM entry
+                             WHERE slug IN (%s)
+                             """ % ','.join('?' * len(chunk)), chunk))
+
+            next_id = g.db.execute(
+                      """
+                      SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence
+                                           WHERE name = 'entry'), 0),
+                                 COALESCE((SELECT MAX(id) FROM entry), 0))
+                      """).fetchone()[0] + 1
+
+            rows = []
+            links = []
+            for entry in entries:
+                creation_date = entry['creation_date'].strftime('%Y-%m-%d')
+                if (entry['slug'], creation_date) in taken:
+                    continue
+                taken.add((entry['slug'], creation_date))
+                rows.append((next_id, entry['slug'], entry['title'],
+                             entry['body'], entry['content_html'],
+                             split_excerpt(entry['content_html']),
+                             entry['render_version'], creation_date,
+                             last_date, owner))
+                links.extend([(next_id, tag) for tag in set(entry['tags'])])
+                next_id += 1
+
+            g.db.executemany(
+            """
+            INSERT INTO entry (id, slug, title, body, content_html,
+                               excerpt_html, render_version, creation_date,
+                               last_date, user_id_FK)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+
+            tag_ids = self.tag_ids([tag for entry_id, tag in links])
+            g.db.executemany('INSERT INTO entry_tags VALUES (?, ?)',
+                             [(entry_id, tag_ids[tag])
+                              for entry_id, tag in links])
+
+            deltas = {'entries': len(rows), 'generation': 1}
+            for entry_id, tag in links:
+                deltas['tag:' + tag] = deltas.get('tag:' + tag, 0) + 1
+            self.bump_counters(deltas)
+            g.db.commit()
+        except:
+            g.db.rollback()
+            raise
+
+        return len(rows)
+
+    def update_entry(self, entry_id, title, text, tags):
+        """Updates an existing entry and replaces its tags."""
+        last_date = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        content_html = render_markdown(text)
+
+        g.db.execute(
+        """
+        UPDATE entry
+        SET slug = ?, title = ?, body = ?, content_html = ?,
+            excerpt_html = ?, render_version = ?, last_date = ?
+        WHERE id = ?
+        """,
+        (slugify_entry(title),
+         title,
+         text,
+         content_html,
+         split_excerpt(content_html),
+         render_version(),
+         last_date,
+         entry_id))
+
+        # Only the tags which changed are touched
+        old_tags = set([tag for (tag,) in g.db.execute(
+                        """
+                        SELECT tag.name FROM tag
+                        JOIN entry_tags ON tag.id = entry_tags.id_tag_FK
+                        WHERE entry_tags.id_entry_FK = ?
+                        """,
+                        [entry_id])])
+        new_tags = unique(tags.split())
+        removed = list(old_tags.difference(new_tags))
+
+        if removed:
+            g.db.execute(
+            """
+            DELETE FROM entry_tags
+            WHERE id_entry_FK = ?
+            AND id_tag_FK IN (SELECT id FROM tag WHERE name IN (%s))
+            """ % ','.join('?' * len(removed)),
+            [entry_id] + removed)
+        self.process_tags(entry_id, [tag for tag in new_tags
+                                     if tag not in old_tags])
+
+        deltas = dict([('tag:' + tag, -1) for tag in removed])
+        deltas['generation'] = 1
+        self.bump_counters(deltas)
         g.db.commit()
-        lastid = self.query_db('SELECT last_insert_rowid()',one=True)['last_insert_rowid()']
-        if tags !='':
-           self.process_tags(lastid, tags.split())
+
+    def rerender_entries(self, conn, batch_size=50):
+        """
+        Renders again the stored HTML of every entry whose render_version
+        differs from the current one, committing every batch_size entries;
+        it returns the number of updated entries.
+        """
+        version = render_version()
+        updated = 0
+
+        while True:
+            rows = conn.execute(
+                   """
+                   SELECT id, body FROM entry
+                   WHERE render_version IS NULL
+                   OR render_version != ?
+                   LIMIT ?
+                   """,
+                   (version, batch_size)).fetchall()
+
+            if not rows:
+                break
+
+            updates = []
+            for id, body in rows:
+                content_html = render_markdown(body)
+                updates.append((content_html, split_excerpt(content_html),
+                                version, id))
+            conn.executemany(
+            """
+            UPDATE entry
+            SET content_html = ?, excerpt_html = ?, render_version = ?
+            WHERE id = ?
+            """, updates)
+            conn.commit()
+            updated += len(rows)
+
+        return updated
+
+    def schedule_rerender(self):
+        """
+        Starts a background re-render pass, unless one is already running;
+        the thread checks out its own connection since g.db belongs to
+        the current request.
+        """
+        if not self._rerender_lock.acquire(False):
+            return
+
+        thread = threading.Thread(target=self._rerender_worker,
+                                  args=(self.pool,))
+        thread.daemon = True
+        thread.start()
+
+    def _rerender_worker(self, pool):
+        """Body of the background re-render thread."""
+        try:
+            conn = pool.checkout()
+            try:
+                self.rerender_entries(conn)
+            finally:
+                pool.checkin(conn)
+        finally:
+            self._rerender_lock.release()
 
     def process_tags(self, entry_id, tags_list):
         """
-        For each tag into tags_list it retrieves it's id from the database;
-        if a supplied tag is not recorded then it creates a new database record.
+        Links the entry to the tags into tags_list, creating the ones
+        which are not recorded yet, and updates the tag counters; the
+        statements issued do not depend on the number of tags, and
+        nothing is committed, so the caller's transaction holds them.
         """
-        for tag in tags_list:
-            current=self.query_db('SELECT id FROM tag \
-                              WHERE tag.name = ?',
-                              [tag],
-                              one=True)
+        tags_list = unique(tags_list)
+        if not tags_list:
+            return
 
-            if current is None:
-                g.db.execute('INSERT INTO tag \
-                              VALUES (null, ?)',
-                              [tag])
+        tag_ids = self.tag_ids(tags_list)
+        g.db.executemany('INSERT INTO entry_tags VALUES (?, ?)',
+                         [(entry_id, tag_ids[tag]) for tag in tags_list])
+        self.bump_counters(dict([('tag:' + tag, 1) for tag in tags_list]))
 
-                current = self.query_db('SELECT last_insert_rowid()', 
-                                    one=True)['last_insert_rowid()']
-            else:
-                current = current['id']
+    def tag_ids(self, names):
+        """
+        Returns a name -> id map of the given tags, creating the
+        missing ones with a multi-row INSERT OR IGNORE (tag.name
+        is unique).
+        """
+        tag_ids = {}
+        for chunk in chunks(unique(names), MAX_SQL_VARIABLES):
+            g.db.execute('INSERT OR IGNORE INTO tag (name) VALUES %s'
+                         % ','.join(['(?)'] * len(chunk)), chunk)
+            tag_ids.update([(name, id) for id, name in g.db.execute(
+                           """
+                           SELECT id, name FROM tag
+                           WHERE name IN (%s)
+                           """ % ','.join('?' * len(chunk)), chunk)])
+        return tag_ids
+
+    def bump_counter(self, name, delta):
+        """
+        Adds delta to the named counter, creating it if needed; it
+        does not commit, so the change belongs to the caller's transaction.
+        """
+        self.bump_counters({name: delta})
+
+    def bump_counters(self, deltas):
+        """Like bump_counter, for a name -> delta map of counters."""
+        items = [(name, delta) for name, delta in deltas.iteritems() if delta]
+        g.db.executemany('INSERT OR IGNORE INTO counter VALUES (?, 0)',
+                         [(name,) for name, delta in items])
+        g.db.executemany('UPDATE counter SET value = value + ? \
+                          WHERE name = ?',
+                         [(delta, name) for name, delta in items])
+
+    def count_entries(self, tagname=None):
+        """
+        Returns the number of entries (with the given tag, if any)
+        as recorded in the counter table.
+        """
+        if tagname:
+            name = 'tag:' + tagname
+        else:
+            name = 'entries'
+
+        counter = self.query_db('SELECT value FROM counter \
+                                 WHERE name = ?',
+                                 [name], one=True)
+        return counter['value'] if counter else 0
 
-            g.db.execute('INSERT INTO entry_tags \
-                          VALUES (?, ?)',
-                          (entry_id, current))
+    def generation(self):
+        """
+        Returns the site-wide generation number, bumped by every
+        write; cached pages of older generations are never served.
+        """
+        counter = self.query_db("SELECT value FROM counter \
+                                 WHERE name = 'generation'",
+                                 one=True)
+        return counter['value'] if counter else 0
+
+    def recount(self):
+        """Rebuilds the entry and tag counters from scratch."""
+        g.db.execute("DELETE FROM counter \
+                      WHERE name = 'entries' OR name LIKE 'tag:%'")
+        g.db.execute(
+        """
+        INSERT INTO counter
+        SELECT 'entries', COUNT(*) FROM entry
+        """)
+        g.db.execute(
+        """
+        INSERT INTO counter
+        SELECT 'tag:' || tag.name, COUNT(*)
+        FROM tag
+        JOIN entry_tags ON tag.id = entry_tags.id_tag_FK
+        GROUP BY tag.name
+        """)
+        self.bump_counter('generation', 1)
         g.db.commit()
 
 
@@ -274,7 +1246,7 @@ class BigtableLayer(DataLayer):
         rs = db.GqlQuery(parsed_query)
         return rs
     
-    def get_entries(self, tagname, offset):
+    def get_entries(self, tagname, offset, before=None):
         """
         Retrieves entries from the datastore. 
         It returns a tuple following the scheme:
@@ -283,6 +1255,9 @@ class BigtableLayer(DataLayer):
 
         Where entries_list is a list of entries for the given tagname
         (which can be None) and #entries is their total number.
+
+        The datastore is paged by offset; page_cursor never hands out
+        cursors, so *before* is accepted for compatibility only.
         """
         if not tagname:
             entries = self.query_db(
@@ -294,11 +1269,7 @@ class BigtableLayer(DataLayer):
             """,
             (app.config['MAX_PAGE_ENTRIES'], offset))
             
-            num_entries = db.GqlQuery(
-            """
-            SELECT *
-            FROM Entry
-            """).count()
+            num_entries = self.count_entries()
 
         else:
             entries = self.query_db(
@@ -311,23 +1282,24 @@ class BigtableLayer(DataLayer):
             """,
             (tagname, app.config['MAX_PAGE_ENTRIES'], offset ))
             
-            num_entries = db.GqlQuery(
-            """
-            SELECT *
-            FROM Entry
-            WHERE tags = '?'
-            """).count()
+            num_entries = self.count_entries(tagname)
         
         # Parse Markdown Text
         list_entries = gqlentries_to_list(entries)
         
         # Filter Projects
         if not tagname: filter_projects(list_entries)
-
-        fill_markdown_content(list_entries)
         
         return list_entries, num_entries
 
+    def page_cursor(self, tagname, page):
+        """Pages are addressed by number on the datastore."""
+        return None
+
+    def page_number(self, tagname, before):
+        """Pages are addressed by number on the datastore."""
+        return 1
+
     def get_entry(self, title, entry_date):
         """
         Retrieves a specific entry by specifing a creation date
@@ -343,7 +1315,6 @@ class BigtableLayer(DataLayer):
 
         if entry is not None:
             list_entry = gqlentries_to_list([entry])
-            fill_markdown_content(list_entry)
         else:
             list_entry = [None]
 
@@ -380,10 +1351,39 @@ class BigtableLayer(DataLayer):
         # Filter Projects
         filter_projects(list_entries)
 
-        fill_markdown_content(list_entries)
-
         return list_entries
 
+    def search_entries(self, query, offset):
+        """
+        The datastore has no full-text index, so searching
+        always comes back empty on App Engine.
+        """
+        return [], 0
+
+    def get_archive(self):
+        """
+        Returns every entry, newest first; the freeze command
+        enumerates the pages of the blog from it.
+        """
+        entries = db.GqlQuery(
+        """
+        SELECT *
+        FROM Entry
+        ORDER BY creation_date DESC
+        """)
+
+        return gqlentries_to_list(entries)
+
+    def get_entry_list(self):
+        """
+        Returns the id, slug, title, author and tags of every entry,
+        for the admin panel.
+        """
+        entries = gqlentries_to_list(Entry.all())
+        for entry in entries:
+            entry['id'] = entry['entry_id']
+        return entries
+
 
     def get_user(self, username):
         """Return the user model if the given username exists."""
@@ -409,11 +1409,15 @@ class BigtableLayer(DataLayer):
         """Insert a new entry."""
         # Retrieves Owner's key
         owner_key = db.Key.from_path('User', owner)
+        content_html = render_markdown(text)
         # Create a new entity (without tags)
         new_entry = Entry(
                     slug=slugify_entry(title),
                     title=title,
                     body=text,
+                    content_html=content_html,
+                    excerpt_html=split_excerpt(content_html),
+                    render_version=render_version(),
                     user_id_FK=owner_key)
 
         # Insert tags into entry's list
@@ -423,6 +1427,64 @@ class BigtableLayer(DataLayer):
         # Store Entity
         db.put(new_entry)
 
+        # Entities and counter shards live in different entity groups,
+        # so each counter is updated in its own transaction
+        increment_counter('entries', 1)
+        for tag in new_entry.tags:
+            increment_counter('tag:' + tag, 1)
+        increment_counter('generation', 1)
+
+
+    def insert_entries(self, entries, owner):
+        """
+        Inserts a batch of entries (see SQLiteLayer.insert_entries)
+        with one datastore call per 500 entities and returns how many
+        were inserted; entries whose slug and date are already taken
+        are skipped.
+
+        The taken slugs and dates are looked up with one IN query per
+        30 slugs of the batch (the most the datastore allows) rather
+        than one query per entry.
+        """
+        owner_key = db.Key.from_path('User', owner)
+        taken = set()
+        for chunk in chunks(list(set([entry['slug'] for entry in entries])),
+                            30):
+            taken.update([(existing.slug, existing.creation_only_date)
+                          for existing in Entry.all().filter('slug IN',
+                                                             chunk)])
+
+        new_entries = []
+        for entry in entries:
+            date = entry['creation_date']
+            if (entry['slug'], date) in taken:
+                continue
+            taken.add((entry['slug'], date))
+            new_entries.append(Entry(
+                slug=entry['slug'],
+                title=entry['title'],
+                body=entry['body'],
+                content_html=entry['content_html'],
+                excerpt_html=split_excerpt(entry['content_html']),
+                render_version=entry['render_version'],
+                creation_date=datetime.datetime(date.year, date.month,
+                                                date.day),
+                creation_only_date=date,
+                user_id_FK=owner_key,
+                tags=list(entry['tags'])))
+
+        for start in range(0, len(new_entries), 500):
+            db.put(new_entries[start:start+500])
+
+        counts = {}
+        for entry in new_entries:
+            for tag in set(entry.tags):
+                counts[tag] = counts.get(tag, 0) + 1
+        increment_counter('entries', len(new_entries))
+        for tag, count in counts.iteritems():
+            increment_counter('tag:' + tag, count)
+        increment_counter('generation', 1)
+        return len(new_entries)
 
     def update_entry(self, entry_id, title, text, tags):
         """Update an existing entry."""
@@ -434,18 +1496,438 @@ class BigtableLayer(DataLayer):
         existing_entry.slug = slugify_entry(title)
         existing_entry.title = title
         existing_entry.body = text
+        existing_entry.content_html = render_markdown(text)
+        existing_entry.excerpt_html = split_excerpt(existing_entry.content_html)
+        existing_entry.render_version = render_version()
         # Insert tags into entry's list
+        old_tags = existing_entry.tags
         existing_entry.tags = tags.split()
         # Store Entity
         existing_entry.put()
 
+        for tag in set(old_tags) - set(existing_entry.tags):
+            increment_counter('tag:' + tag, -1)
+        for tag in set(existing_entry.tags) - set(old_tags):
+            increment_counter('tag:' + tag, 1)
+        increment_counter('generation', 1)
+
+    def count_entries(self, tagname=None):
+        """
+        Returns the number of entries (with the given tag, if any)
+        by summing the shards of the matching counter.
+        """
+        if tagname:
+            return get_counter('tag:' + tagname)
+        return get_counter('entries')
+
+    def generation(self):
+        """
+        Returns the site-wide generation number, bumped by every
+        write; cached pages of older generations are never served.
+        """
+        return get_counter('generation')
+
+    def recount(self):
+        """Rebuilds the entry and tag counters from scratch."""
+        recount_gae_counters()
+
+    def schedule_rerender(self):
+        """
+        Queues a deferred re-render pass; the memcache flag keeps
+        concurrent requests from queueing the same work twice.
+        """
+        if memcache.add('blog:rerender', True, time=600):
+            deferred.defer(rerender_gae_entries)
+
+class MemoryLayer(DataLayer):
+    """
+    Keeps the blog in the process memory, for the tests and the
+    benchmarks. Entries are dictionaries shaped like the sqlite rows.
+    They are listed through the sorted lists of their (creation_date,
+    id) sort keys, one for all the entries and one per tag (the
+    inverted index), which bisect keeps in order; entries are also
+    indexed by slug and date and by the words of their text.
+
+    Nothing is stored anywhere else: init_db starts over with the
+    users of the sqlite schema (or of its test fixture).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.init_db()
+
+    def connect_db(self):
+        """There is nothing to connect to: g.db is the layer itself."""
+        return self
+
+    def close(self):
+        pass
+
+    def init_db(self, testdb=False):
+        """Forgets every entry and loads the users of the schema."""
+        if not testdb:
+            schema = 'schema/schema.sql'
+        else:
+            schema = 'schema/fixture-sqlite.sql'
+
+        conn = sqlite3.connect(':memory:')
+        try:
+            f = app.open_resource(schema)
+            try:
+                conn.executescript(f.read())
+            finally:
+                f.close()
+            ranks = conn.execute('SELECT id, role_name FROM rank').fetchall()
+            users = conn.execute('SELECT id, username, password, rank_id_FK '
+                                 'FROM user').fetchall()
+        finally:
+            conn.close()
+
+        self._lock.acquire()
+        try:
+            # id -> row, and the indexes
+            self._entries = {}
+            self._tags = {}
+            self._by_date = []
+            self._by_tag = {}
+            self._by_slug = {}
+            self._by_word = {}
+            self._next_id = 1
+            self._generation = 0
+            self._ranks = dict(ranks)
+            self._users = {}
+            self._usernames = {}
+            for id, username, password, rank in users:
+                self._users[id] = {'id': id, 'username': username,
+                                   'password': password, 'rank_id_FK': rank}
+                self._usernames[username] = id
+        finally:
+            self._lock.release()
+
+    def schema_version(self, conn):
+        """The memory layer is always up to date."""
+        return list_migrations()[-1][0]
+
+    def migrate(self, conn):
+        return []
+
+    def insert_user(self, username, password, role_name='administrator'):
+        """
+        Adds a user with the given password hash and role (there is
+        no SQL to do it with) and returns its id.
+        """
+        self._lock.acquire()
+        try:
+            id = max(self._users.keys() or [0]) + 1
+            rank = None
+            for rank_id, name in self._ranks.items():
+                if name == role_name:
+                    rank = rank_id
+            if rank is None:
+                rank = max(self._ranks.keys() or [-1]) + 1
+                self._ranks[rank] = role_name
+            self._users[id] = {'id': id, 'username': username,
+                               'password': password, 'rank_id_FK': rank}
+            self._usernames[username] = id
+            return id
+        finally:
+            self._lock.release()
+
+    def get_entries(self, tagname, offset, before=None):
+        """
+        Returns a page of entries, with the given tag if any, and
+        their total number (see SQLiteLayer.get_entries); *before* is
+        a page cursor.
+        """
+        if tagname:
+            keys = self._by_tag.get(tagname, [])
+        else:
+            keys = self._by_date
+
+        size = app.config['MAX_PAGE_ENTRIES']
+        if before is not None and not tagname:
+            end = bisect.bisect_left(keys, parse_cursor(before))
+        else:
+            end = len(keys) - offset
+        page = keys[max(0, end - size):max(0, end)]
+        page.reverse()
+
+        entries = self._rows([id for creation_date, id in page])
+        self._fill(entries)
+        return entries, len(keys)
+
+    def page_cursor(self, tagname, page):
+        """
+        Returns the ?before= cursor of the given page number, or None
+        for the first page (and for pages past the end); tag listings
+        are paged by number only.
+        """
+        if tagname:
+            return None
+
+        keys = self._by_date
+        size = app.config['MAX_PAGE_ENTRIES']
+        if 2 <= page <= (len(keys) - 1) // size + 1:
+            return format_cursor(keys[len(keys) - size * (page - 1)])
+
+    def page_number(self, tagname, before):
+        """Returns the page number a ?before= cursor points to."""
+        if tagname:
+            keys = self._by_tag.get(tagname, [])
+        else:
+            keys = self._by_date
+        size = app.config['MAX_PAGE_ENTRIES']
+        newer = len(keys) - bisect.bisect_left(keys, parse_cursor(before))
+        return min(newer // size, max(0, len(keys) - 1) // size) + 1
+
+    def get_entry(self, title, entry_date):
+        """Returns the entry with the given slug and creation date."""
+        id = self._by_slug.get((title, entry_date.strftime('%Y-%m-%d')))
+        if id is not None:
+            entries = self._rows([id])
+            self._fill(entries)
+            return entries[0]
+
+    def get_entry_by_id(self, entry_id):
+        """Returns the entry with the given id, for editing."""
+        if entry_id in self._entries:
+            entry = self._rows([entry_id])[0]
+            # The name the datastore entries use
+            entry['entry_id'] = entry['id']
+            entry['tags'] = list(self._tags[entry_id])
+            return entry
+
+    def get_recent_entries(self, n):
+        """Returns the latest n entries, newest first."""
+        keys = self._by_date[-n:]
+        keys.reverse()
+        entries = self._rows([id for creation_date, id in keys])
+        self._fill(entries)
+        return entries
+
+    def search_entries(self, query, offset):
+        """
+        Returns a page of the entries containing every word of the
+        query, newest first (the memory layer does not rank them), each
+        one with a highlighted *snippet* of its text, and their number;
+        only the newest SEARCH_MAX_RESULTS matches are counted.
+        """
+        words = set(text_words(query))
+        if not words:
+            return [], 0
+
+        matches = None
+        for word in words:
+            ids = self._by_word.get(word, set())
+            if matches is None:
+                matches = set(ids)
+            else:
+                matches &= ids
+        matches = sorted(matches, reverse=True)[:app.config['SEARCH_MAX_RESULTS']]
+
+        size = app.config['MAX_PAGE_ENTRIES']
+        entries = self._rows(matches[offset:offset+size])
+        for entry in entries:
+            entry['snippet'] = highlight_snippet(make_snippet(entry['body'],
+                               words, app.config['SEARCH_SNIPPET_WORDS']))
+        self._fill(entries)
+        return entries, len(matches)
+
+    def get_archive(self):
+        """
+        Returns the id, slug, dates and tags of every entry, newest
+        first and without their texts.
+        """
+        entries = []
+        for creation_date, id in reversed(self._by_date):
+            entry = self._entries[id]
+            entries.append({'id': id,
+                            'slug': entry['slug'],
+                            'creation_date': creation_date,
+                            'last_date': entry['last_date'],
+                            'tags': list(self._tags[id])})
+        return entries
+
+    def get_entry_list(self):
+        """
+        Returns the id, slug, title, author and tags of every entry,
+        for the admin panel.
+        """
+        entries = []
+        for id in sorted(self._entries):
+            entry = self._entries[id]
+            entries.append({'id': id,
+                            'user_id_FK': entry['user_id_FK'],
+                            'slug': entry['slug'],
+                            'title': entry['title'],
+                            'tags': list(self._tags[id]),
+                            'author': self._author(entry)})
+        return entries
+
+    def get_user(self, username):
+        """Return the user model if the given username exists."""
+        id = username and self._usernames.get(username)
+        if id is not None:
+            return dict(self._users[id])
+
+    def load_user_profile(self, id):
+        """Load a user's profile given his unique id."""
+        user = self._users.get(id)
+        if user is not None and user['rank_id_FK'] in self._ranks:
+            return {'id': id, 'role_name': self._ranks[user['rank_id_FK']]}
+
+    def insert_entry(self, title, text, owner, tags):
+        """Inserts a new entry post."""
+        content_html = render_markdown(text)
+        self._lock.acquire()
+        try:
+            self._add({'id': self._next_id,
+                       'slug': slugify_entry(title),
+                       'title': title,
+                       'body': text,
+                       'content_html': content_html,
+                       'excerpt_html': split_excerpt(content_html),
+                       'render_version': render_version(),
+                       'creation_date': datetime.date.today().strftime('%Y-%m-%d'),
+                       'last_date': utc_timestamp(),
+                       'user_id_FK': owner},
+                      unique(tags.split()))
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    def insert_entries(self, entries, owner):
+        """
+        Inserts a batch of entries (see SQLiteLayer.insert_entries),
+        skipping those whose slug and date are already taken, and
+        returns how many were inserted.
+        """
+        last_date = utc_timestamp()
+        inserted = 0
+        self._lock.acquire()
+        try:
+            for entry in entries:
+                creation_date = entry['creation_date'].strftime('%Y-%m-%d')
+                if (entry['slug'], creation_date) in self._by_slug:
+                    continue
+                self._add({'id': self._next_id,
+                           'slug': entry['slug'],
+                           'title': entry['title'],
+                           'body': entry['body'],
+                           'content_html': entry['content_html'],
+                           'excerpt_html': split_excerpt(entry['content_html']),
+                           'render_version': entry['render_version'],
+                           'creation_date': creation_date,
+                           'last_date': last_date,
+                           'user_id_FK': owner},
+                          unique(entry['tags']))
+                inserted += 1
+            self._generation += 1
+        finally:
+            self._lock.release()
+        return inserted
+
+    def update_entry(self, entry_id, title, text, tags):
+        """Updates an existing entry and replaces its tags."""
+        content_html = render_markdown(text)
+        self._lock.acquire()
+        try:
+            entry = dict(self._remove(entry_id))
+            entry.update({'slug': slugify_entry(title),
+                          'title': title,
+                          'body': text,
+                          'content_html': content_html,
+                          'excerpt_html': split_excerpt(content_html),
+                          'render_version': render_version(),
+                          'last_date': utc_timestamp()})
+            self._add(entry, unique(tags.split()))
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    def schedule_rerender(self):
+        """Renders the stale entries again, there and then."""
+        version = render_version()
+        self._lock.acquire()
+        try:
+            for entry in self._entries.itervalues():
+                if entry['render_version'] != version:
+                    entry['content_html'] = render_markdown(entry['body'])
+                    entry['excerpt_html'] = split_excerpt(entry['content_html'])
+                    entry['render_version'] = version
+        finally:
+            self._lock.release()
+
+    def count_entries(self, tagname=None):
+        """Returns the number of entries (with the given tag, if any)."""
+        if tagname:
+            return len(self._by_tag.get(tagname, []))
+        return len(self._by_date)
+
+    def generation(self):
+        """
+        Returns the site-wide generation number, bumped by every
+        write; cached pages of older generations are never served.
+        """
+        return self._generation
+
+    def recount(self):
+        """The counts come from the indexes: only the generation moves."""
+        self._generation += 1
+
+    def _add(self, entry, tags):
+        """Stores an entry and indexes it; the lock must be held."""
+        id = entry['id']
+        key = (entry['creation_date'], id)
+        self._entries[id] = entry
+        self._tags[id] = tags
+        bisect.insort(self._by_date, key)
+        for tag in tags:
+            bisect.insort(self._by_tag.setdefault(tag, []), key)
+        self._by_slug[(entry['slug'], entry['creation_date'])] = id
+        for word in set(text_words(entry['title'] + u' ' + entry['body'])):
+            self._by_word.setdefault(word, set()).add(id)
+        self._next_id = max(self._next_id, id + 1)
+
+    def _remove(self, id):
+        """Unindexes an entry and returns it; the lock must be held."""
+        entry = self._entries.pop(id)
+        key = (entry['creation_date'], id)
+        del self._by_date[bisect.bisect_left(self._by_date, key)]
+        for tag in self._tags.pop(id):
+            keys = self._by_tag[tag]
+            del keys[bisect.bisect_left(keys, key)]
+            if not keys:
+                del self._by_tag[tag]
+        del self._by_slug[(entry['slug'], entry['creation_date'])]
+        for word in set(text_words(entry['title'] + u' ' + entry['body'])):
+            self._by_word[word].discard(id)
+        return entry
+
+    def _rows(self, ids):
+        """Returns copies of the entries, which the views fill in."""
+        return [dict(self._entries[id]) for id in ids]
+
+    def _author(self, entry):
+        user = self._users.get(entry['user_id_FK'])
+        return user and user['username']
+
+    def _fill(self, entries):
+        """Adds the dates, tags and author, as fill_entries does."""
+        fill_humanized_dates(entries)
+        for entry in entries:
+            entry['tags'] = list(self._tags[entry['id']])
+            entry['author'] = self._author(entry)
+
+
 def factory(db_name):
     """
     Returns the appropriate data layer class by using the db_name
     parameter as a dictionary key; Right now, it contains entries for
-    sqlite and gae.
+    sqlite, gae and memory.
     """
-    supported_db={'sqlite': SQLiteLayer, 'gae':BigtableLayer}
+    supported_db={'sqlite': SQLiteLayer, 'gae':BigtableLayer,
+                  'memory': MemoryLayer}
     return supported_db[db_name]()
 
 
@@ -480,6 +1962,182 @@ def replace_questionmarks(string, args=()):
     return newstring
 
 
+def list_migrations():
+    """
+    Returns the (version, path) pairs of the migration scripts in
+    blog/schema/migrations, sorted by version; scripts are named
+    NNNN_description.sql.
+    """
+    folder = os.path.join(app.root_path, 'schema', 'migrations')
+    migrations = []
+    for name in os.listdir(folder):
+        match = re.match(r'^(\d+)_\w+\.sql$', name)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(folder, name)))
+    migrations.sort()
+    return migrations
+
+
+# The entry columns the listings read: the full HTML (content_html) only
+# of the entries without an excerpt, and the Markdown body only of those
+# whose stored HTML is stale, which fill_markdown_content renders again;
+# the query's first parameter is the current render_version
+LISTING_COLUMNS = """
+    entry.id, entry.slug, entry.title, entry.creation_date, entry.last_date,
+    entry.user_id_FK, entry.render_version, entry.excerpt_html,
+    CASE WHEN entry.excerpt_html IS NULL THEN entry.content_html END
+    AS content_html,
+    CASE WHEN entry.render_version IS ? THEN NULL ELSE entry.body END
+    AS body"""
+
+# Rows fetched at a time by the lazy query_db
+ROW_BATCH_SIZE = 256
+
+# Lists of placeholders, as in IN (?, ?, ?) and VALUES (?), (?), (?)
+PLACEHOLDER_LIST = r'\?(?:\s*,\s*\?)+'
+PLACEHOLDER_ROWS = r'\((?:\?(?:\s*,\s*\?)*)\)(?:\s*,\s*\((?:\?(?:\s*,\s*\?)*)\))+'
+# A query plan step reading a whole table (an index would show up
+# as SCAN entry USING INDEX ...)
+FULL_SCAN = r'^SCAN (?:TABLE )?(\w+)$'
+
+
+def statement_key(sql):
+    """
+    Returns a statement with its whitespace and its lists of
+    placeholders collapsed, so that e.g. IN lists of any length
+    count as the same statement.
+    """
+    sql = ' '.join(sql.split())
+    sql = re.sub(PLACEHOLDER_ROWS, '(?), ...', sql)
+    return re.sub(PLACEHOLDER_LIST, '?, ...', sql)
+
+
+def parameters_shape(parameters, many=False):
+    """
+    Describes statement parameters by their types, e.g.
+    ``(unicode, int x 3)'', or ``120 x (int, int)'' for executemany.
+    """
+    if many:
+        sample = parameters and parameters[0] or ()
+        return '%d x %s' % (len(parameters), parameters_shape(sample))
+    if isinstance(parameters, dict):
+        return '{%s}' % ', '.join(['%s: %s' % (name, type(value).__name__)
+                                   for name, value in sorted(parameters.items())])
+    runs = []
+    for value in parameters:
+        name = type(value).__name__
+        if runs and runs[-1][0] == name:
+            runs[-1][1] += 1
+        else:
+            runs.append([name, 1])
+    return '(%s)' % ', '.join([count == 1 and name or '%s x %d' % (name, count)
+                               for name, count in runs])
+
+
+def scanned_tables(plan):
+    """
+    Returns the tables a query plan reads in full, i.e. without any
+    index (SCAN entry, but not SCAN entry USING INDEX entry_date).
+    """
+    tables = []
+    for detail in plan:
+        match = re.match(FULL_SCAN, detail)
+        if match is not None:
+            tables.append(match.group(1))
+    return tables
+
+
+def text_words(text):
+    """Returns the lowercase words of a text, as the memory layer indexes them."""
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def make_snippet(text, words, size):
+    """
+    Returns *size* words of text around the first of the given words
+    it contains, delimited by \\x02 and \\x03 as FTS5 snippets are.
+    """
+    tokens = text.split()
+    first = None
+    for index, token in enumerate(tokens):
+        if set(text_words(token)) & words:
+            tokens[index] = u'\x02%s\x03' % token
+            if first is None:
+                first = index
+    start = max(0, (first or 0) - size // 4)
+    snippet = u' '.join(tokens[start:start+size])
+    if start > 0:
+        snippet = u'...' + snippet
+    if start + size < len(tokens):
+        snippet += u'...'
+    return snippet
+
+
+def utc_timestamp():
+    """Returns the current UTC time as the last_date of an entry."""
+    return datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def iter_rows(cursor, names):
+    """Yields the rows of a cursor as dictionaries keyed by *names*."""
+    while True:
+        rows = cursor.fetchmany(ROW_BATCH_SIZE)
+        for row in rows:
+            yield dict(izip(names, row))
+        if len(rows) < ROW_BATCH_SIZE:
+            break
+
+
+def has_fts5():
+    """
+    Returns whether the sqlite3 library was built with FTS5, which the
+    full-text search needs.
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        try:
+            conn.execute('CREATE VIRTUAL TABLE probe USING fts5(text)')
+        except sqlite3.OperationalError:
+            return False
+        return True
+    finally:
+        conn.close()
+
+
+def fts_query(text):
+    """
+    Turns the words of a search box into an FTS5 query matching all
+    of them; quoting every word keeps the FTS5 operators and syntax
+    out of the readers' hands.
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    return u' '.join([u'"%s"' % word for word in words])
+
+
+def unique(items):
+    """Returns the items without duplicates, in their original order."""
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+def format_cursor(key):
+    """
+    Formats a (creation_date, id) sort key as a pagination cursor,
+    e.g. ``2011-01-31_42``.
+    """
+    return '%s_%d' % tuple(key)
+
+
+def parse_cursor(cursor):
+    """
+    Parses a pagination cursor back into a (creation_date, id) sort key;
+    it raises ValueError if the cursor is malformed.
+    """
+    creation_date, entry_id = cursor.rsplit('_', 1)
+    datetime.datetime.strptime(creation_date, '%Y-%m-%d')
+    return creation_date, int(entry_id)
+
+
 def gqlentries_to_list(gql_rs):
     """
     Returns a list of entries given a gql resultset with the following
@@ -491,36 +2149,159 @@ def gqlentries_to_list(gql_rs):
     
     {'entry_id':entry_id_i,
      'slug':slug_i,
-     'author':user_id_FK_i.username,
+     'author':username_i,
      'title':title_i, 
      'body':body_i, 
      'creation_date':creation_date_i,
      'creation_only_date':creation_only_date_i,
      'human_date':human_date_i,
      'last_date':last_date_i,
-     'user_id_FK':user_id_FK,
+     'user_id_FK':user_key_i,
+     'content_html':content_html_i,
+     'excerpt_html':excerpt_html_i,
+     'render_version':render_version_i,
      'tags':[<tag1>,<tag2>,...,<tagj>,<tagj+1>,...,<tagm>] for 1<=j<=m
     }
+
+    The authors are fetched with one batch get for all the entries
+    (see fetch_authors) instead of dereferencing user_id_FK, which
+    would cost a datastore get per entry.
     """
+    items = list(gql_rs)
+    keys = [Entry.user_id_FK.get_value_for_datastore(item) for item in items]
+    authors = fetch_authors(keys)
+
     result_list = list()
-    for item in gql_rs:
+    for item, key in zip(items, keys):
         d = {
         'entry_id':item.key().id(),
         'slug':item.slug,
-        'author':item.user_id_FK.username,
+        'author':authors.get(key),
         'title':item.title,
         'body':item.body,
         'creation_date':item.creation_date,
         'creation_only_date':item.creation_only_date,
         'human_date':item.creation_date.strftime('%d %b').upper(),
         'last_date':item.last_date,
-        'user_id_FK':item.user_id_FK,
+        'user_id_FK':key,
+        'content_html':item.content_html,
+        'excerpt_html':item.excerpt_html,
+        'render_version':item.render_version,
         'tags':item.tags}
         result_list.append(d)
     
     return result_list
 
 
+# Usernames by User key, shared by the requests of an instance; a
+# User's key name is its username, so entries never go stale
+_authors = {}
+AUTHOR_CACHE_SIZE = 1000
+
+
+def fetch_authors(keys):
+    """
+    Returns a dictionary mapping the given User keys (None ones are
+    ignored) to their usernames; the keys which are not cached yet are
+    fetched with a single batch get.
+    """
+    keys = unique([key for key in keys if key is not None])
+    authors = dict((key, _authors[key]) for key in keys if key in _authors)
+    missing = [key for key in keys if key not in authors]
+    if missing:
+        if len(_authors) + len(missing) > AUTHOR_CACHE_SIZE:
+            _authors.clear()
+        for key, user in zip(missing, db.get(missing)):
+            if user is not None:
+                authors[key] = _authors[key] = user.username
+    return authors
+
+
+def rerender_gae_entries(cursor=None, batch_size=50):
+    """
+    Deferred task which renders again the stored HTML of stale entries;
+    it walks the Entry kind in batches and queues itself again with
+    the datastore cursor until every entity has been visited.
+    """
+    version = render_version()
+    query = Entry.all()
+    if cursor:
+        query.with_cursor(cursor)
+
+    batch = query.fetch(batch_size)
+    stale = [item for item in batch if item.render_version != version]
+    for item in stale:
+        item.content_html = render_markdown(item.body)
+        item.excerpt_html = split_excerpt(item.content_html)
+        item.render_version = version
+    db.put(stale)
+
+    if len(batch) == batch_size:
+        deferred.defer(rerender_gae_entries, query.cursor(), batch_size)
+    else:
+        memcache.delete('blog:rerender')
+
+
+# Number of shards of every datastore counter
+COUNTER_SHARDS = 10
+
+
+def increment_counter(name, delta=1):
+    """
+    Adds delta to a random shard of the named counter in a transaction,
+    keeping the cached total (if any) in sync.
+    """
+    def txn():
+        key_name = '%s/%d' % (name, random.randint(0, COUNTER_SHARDS-1))
+        shard = CounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = CounterShard(key_name=key_name, name=name)
+        shard.count += delta
+        shard.put()
+
+    db.run_in_transaction(txn)
+    if delta > 0:
+        memcache.incr('counter:' + name, delta)
+    else:
+        memcache.decr('counter:' + name, -delta)
+
+
+def get_counter(name):
+    """Returns the value of the named counter, summing its shards."""
+    value = memcache.get('counter:' + name)
+    if value is None:
+        value = 0
+        for shard in CounterShard.all().filter('name =', name):
+            value += shard.count
+        memcache.add('counter:' + name, value, time=3600)
+    return value
+
+
+def recount_gae_counters():
+    """
+    Rebuilds the entry and tag counters from scratch, storing every
+    total in a single shard.
+    """
+    totals = {'entries': 0}
+    for item in Entry.all():
+        totals['entries'] += 1
+        for tag in set(item.tags):
+            totals['tag:' + tag] = totals.get('tag:' + tag, 0) + 1
+
+    # Keep the generation going, so stale pages are not served again
+    totals['generation'] = get_counter('generation') + 1
+
+    while True:
+        keys = CounterShard.all(keys_only=True).fetch(500)
+        if not keys:
+            break
+        db.delete(keys)
+
+    db.put([CounterShard(key_name='%s/0' % name, name=name, count=count)
+            for name, count in totals.items()])
+    memcache.delete_multi(['counter:' + name for name in totals])
+
+
 def gqluser_to_dict(gql_user):
     """
     Converts a single user gql resultset using the following dict structure:
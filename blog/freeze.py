@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+
+    blog.freeze
+    ~~~~~~~~~~~~~~~~~~
+
+    Freezes the public pages of the blog into a tree of flat
+    files which the static handlers of app.yaml can serve, e.g.
+    during traffic spikes; pages are rendered through
+    app.test_client() by a pool of worker processes.
+
+    A state file in the destination records a fingerprint of
+    every frozen page, so that a later run only renders the pages
+    showing entries whose last_date changed.
+
+    :copyright: (c) 2010 by Gianluca Bargelli.
+    :license: MIT License, see LICENSE for more details.
+
+
+"""
+
+import os
+import time
+import errno
+import hashlib
+import mimetypes
+import multiprocessing
+from flask import g, json
+from views import app, data_layer, CACHED_ENDPOINTS
+from helpers import entry_pages, render_version, parse_creation_date
+
+STATE_FILE = '.freeze-state.json'
+# Pages which need a query string cannot be served as flat files
+DYNAMIC_ENDPOINTS = ('search_entries',)
+# File extensions the static handlers map back to the content types
+EXTENSIONS = {'text/html': '.html',
+              'application/atom+xml': '.atom'}
+
+
+def freeze(destination, processes=None, incremental=True):
+    """
+    Renders every public page into *destination* and returns a
+    dictionary with the number of rendered, unchanged, removed and
+    failed pages and the elapsed seconds.
+
+    With *incremental*, pages whose fingerprint matches the one of
+    the previous run are left alone; pages which no longer exist
+    are removed in any case.
+    """
+    start = time.time()
+    # Pager links use path URLs while freezing (and worker
+    # processes inherit the setting)
+    app.config['FREEZING'] = True
+    try:
+        pages = enumerate_pages()
+
+        state = load_state(destination)
+        if not incremental:
+            state = dict((url, (None, path))
+                         for url, (digest, path) in state.iteritems())
+
+        todo = [url for url, digest in pages
+                if digest is None or state.get(url, (None, None))[0] != digest]
+
+        # Workers open connections of their own
+        data_layer.dispose()
+        results = render_pages(todo, destination, processes)
+    finally:
+        app.config['FREEZING'] = False
+
+    digests = dict(pages)
+
+    new_state = {}
+    failed = []
+    for url, digest in pages:
+        if url in state and url not in results:
+            new_state[url] = state[url]
+    for url, (status, path) in results.iteritems():
+        if status == 200:
+            new_state[url] = (digests[url], path)
+        else:
+            failed.append((url, status))
+
+    removed = 0
+    for url, (digest, path) in state.iteritems():
+        if url not in digests:
+            remove_file(os.path.join(destination, path))
+            removed += 1
+
+    save_state(destination, new_state)
+    return {'rendered': len(results) - len(failed),
+            'unchanged': len(pages) - len(todo),
+            'removed': removed,
+            'failed': failed,
+            'seconds': time.time() - start}
+
+
+def enumerate_pages():
+    """
+    Returns the (url, fingerprint) pairs of every public page, as
+    found in app.url_map and expanded with the entries and tags of
+    the data layer; the fingerprint is None for pages which do not
+    show entries (and which are therefore always rendered).
+    """
+    ctx = app.test_request_context(base_url=app.config['FREEZE_BASE_URL'])
+    ctx.push()
+    try:
+        g.db = data_layer.connect_db()
+        try:
+            archive = data_layer.get_archive()
+        finally:
+            data_layer.close()
+    finally:
+        ctx.pop()
+    recent = archive[:15]
+
+    # Every listing (None being the untagged one) split into pages
+    listings = {None: archive}
+    for entry in archive:
+        for tag in entry['tags']:
+            listings.setdefault(tag, []).append(entry)
+
+    def listing_pages(tagname):
+        entries = listings.get(tagname, [])
+        size = app.config['MAX_PAGE_ENTRIES']
+        total = entry_pages(len(entries))
+        return [(page, total, entries[size*(page-1):size*page])
+                for page in range(1, total+1)]
+
+    def build(rule, **values):
+        return rule.build(dict((key, value) for key, value in values.items()
+                               if key in rule.arguments))[1]
+
+    pages = []
+    for rule in app.url_map.iter_rules():
+        endpoint = rule.endpoint
+        if endpoint not in CACHED_ENDPOINTS + ('show_home',) \
+           or endpoint in DYNAMIC_ENDPOINTS \
+           or 'GET' not in rule.methods:
+            continue
+
+        if endpoint in ('list_entries', 'list_page'):
+            if 'tagname' in rule.arguments:
+                tags = [tag for tag in listings if tag is not None]
+            else:
+                tags = [None]
+            for tagname in tags:
+                for page, total, entries in listing_pages(tagname):
+                    # The first page has no page number in its URL
+                    if (page == 1) == (endpoint == 'list_entries'):
+                        pages.append((build(rule, tagname=tagname, page=page),
+                                      fingerprint(page, total, entries)))
+        elif endpoint == 'show_projects':
+            page, total, entries = listing_pages('project')[0]
+            pages.append((build(rule), fingerprint(page, total, entries)))
+        elif endpoint == 'view_entry':
+            # Entries sharing a slug and a date share a page, which
+            # changes with any of them
+            urls = []
+            entries = {}
+            for entry in archive:
+                date = parse_creation_date(entry['creation_date'])
+                url = build(rule, year=date.year, month=date.month,
+                            day=date.day, title=entry['slug'])
+                if url not in entries:
+                    urls.append(url)
+                    entries[url] = []
+                entries[url].append(entry)
+            for url in urls:
+                pages.append((url, fingerprint(entries[url])))
+        elif endpoint == 'recent_feed':
+            pages.append((build(rule), fingerprint(recent)))
+        elif not rule.arguments:
+            pages.append((build(rule), None))
+
+    return pages
+
+
+def fingerprint(*items):
+    """
+    Returns a digest of the entries' ids and last dates found in
+    items, together with anything else in them (e.g. page numbers)
+    and the build and renderer versions.
+    """
+    def simplify(item):
+        if isinstance(item, dict):
+            return (item.get('id') or item.get('entry_id'),
+                    unicode(item['last_date']))
+        elif isinstance(item, (list, tuple)):
+            return [simplify(child) for child in item]
+        return item
+
+    raw = repr((app.config['BUILD_VERSION'], render_version(),
+                simplify(items)))
+    return hashlib.sha1(raw).hexdigest()
+
+
+def render_pages(urls, destination, processes=None):
+    """
+    Renders urls into destination, in a pool of *processes* worker
+    processes (one per CPU by default, none when 1), and returns a
+    dictionary mapping each url to its (status, path).
+    """
+    jobs = [(url, destination) for url in urls]
+    if processes == 1 or len(jobs) < 2:
+        results = map(freeze_page, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(freeze_page, jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    return dict((url, (status, path)) for url, status, path in results)
+
+
+def freeze_page(job):
+    """
+    Renders a page and writes it into the frozen tree; it returns
+    the url, the response status and the path of the written file
+    (relative to the destination), which is None on errors.
+    """
+    url, destination = job
+    # The test client only unquotes paths given as byte strings
+    response = app.test_client().get(url.encode('utf-8'),
+                                     base_url=app.config['FREEZE_BASE_URL'])
+    if response.status_code != 200:
+        return url, response.status_code, None
+
+    path = frozen_path(url, response.mimetype)
+    filename = os.path.join(destination, path)
+    make_dirs(os.path.dirname(filename))
+    f = open(filename, 'wb')
+    try:
+        f.write(response.data)
+    finally:
+        f.close()
+
+    return url, response.status_code, path
+
+
+def frozen_path(url, mimetype):
+    """
+    Returns the file path of a frozen page: urls without the
+    extension of their content type become directories holding an
+    index file (/blog is written to blog/index.html).
+    """
+    path = url.strip('/')
+    extension = EXTENSIONS.get(mimetype) or \
+                mimetypes.guess_extension(mimetype) or ''
+    if not path or not path.endswith(extension):
+        path = os.path.join(path, 'index' + extension)
+    return path
+
+
+def make_dirs(path):
+    """Creates a directory and its parents, if they are missing."""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_file(filename):
+    """Removes a frozen page and the directories it leaves empty."""
+    try:
+        os.remove(filename)
+        os.removedirs(os.path.dirname(filename))
+    except OSError:
+        pass
+
+
+def load_state(destination):
+    """Returns the url -> (fingerprint, path) map of the last run."""
+    try:
+        f = open(os.path.join(destination, STATE_FILE))
+    except IOError:
+        return {}
+    try:
+        return dict((url, tuple(value))
+                    for url, value in json.load(f).iteritems())
+    finally:
+        f.close()
+
+
+def save_state(destination, state):
+    """Stores the url -> (fingerprint, path) map of this run."""
+    make_dirs(destination)
+    f = open(os.path.join(destination, STATE_FILE), 'w')
+    try:
+        json.dump(state, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
@@ -14,6 +14,7 @@
 """
 
 from views import app
+from metrics import timed
 from flask import g, Markup, url_for, request
 import math
 import random
@@ -21,6 +22,8 @@ import hashlib
 import datetime
 import re
 import markdown
+import markdown.cache
+import pygments
 from unicodedata import normalize
 from urlparse import urljoin
 
@@ -52,20 +55,42 @@ def slugify_entry(entry_title, delim=u'-'):
     return unicode(delim.join(result))
 
 
+# Maximum number of ids bound to a single IN (...) clause; SQLite
+# refuses statements with more than 999 host parameters.
+MAX_SQL_VARIABLES = 500
+
+
+def chunks(items, size):
+    """Splits a list into consecutive slices of at most size items."""
+    return [items[index:index+size] for index in range(0, len(items), size)]
+
+
 def fill_tags(entries):
     """
     Convenience function which retrieves all the tags and 
     inserts them in the right entry dictionary. 
     This is useful for templating purposes (i.e. displaying
     all entry's tags near the title of the entry).
+
+    Tags for every entry are fetched with one query per
+    MAX_SQL_VARIABLES entries, instead of one query per entry.
     """
-    for entry in entries:
+    tags = dict((entry['id'], []) for entry in entries)
+
+    for ids in chunks(tags.keys(), MAX_SQL_VARIABLES):
         rs = g.db.execute(
-             'SELECT tag.name FROM tag \
-              JOIN entry_tags ON tag.id = entry_tags.id_tag_FK \
-              WHERE entry_tags.id_entry_FK = ?',
-              [entry['id']])
-        entry['tags'] = [item[0] for item in rs.fetchall()]
+             """
+             SELECT entry_tags.id_entry_FK, tag.name
+             FROM tag
+             JOIN entry_tags ON tag.id = entry_tags.id_tag_FK
+             WHERE entry_tags.id_entry_FK IN (%s)
+             """ % ', '.join('?' * len(ids)),
+             ids)
+        for entry_id, name in rs.fetchall():
+            tags[entry_id].append(name)
+
+    for entry in entries:
+        entry['tags'] = tags[entry['id']]
 
 
 def fill_author(entries):
@@ -73,31 +98,44 @@ def fill_author(entries):
     Convenience function which inserts the author's name into
     the dictionary structure passed by default.
     This is useful for templating purpose.
+
+    Authors are looked up once for all the distinct owners.
     """
-    for entry in entries:
+    authors = dict((entry['user_id_FK'], None) for entry in entries)
+
+    for ids in chunks(authors.keys(), MAX_SQL_VARIABLES):
         rs = g.db.execute(
              """
-             SELECT user.username 
+             SELECT user.id, user.username 
              FROM user
-             WHERE user.id = ?
-             """,
-             [entry['user_id_FK']])
-        entry['author'] = rs.fetchall()[0][0]
+             WHERE user.id IN (%s)
+             """ % ', '.join('?' * len(ids)),
+             ids)
+        authors.update(rs.fetchall())
+
+    for entry in entries:
+        entry['author'] = authors[entry['user_id_FK']]
 
 
 def fill_humanized_dates(entries):
     """
     Convenience function which inserts a humanized date
-    into the passed entries dictionary.
+    into the passed entries dictionary; the dates sqlite returns
+    as strings are replaced by date and datetime objects, as the
+    templates and the feed expect.
     """
     for entry in entries:
+        entry['creation_date'] = parse_creation_date(entry['creation_date'])
+        if entry.get('last_date'):
+            entry['last_date'] = parse_last_date(entry['last_date'])
         entry['human_date'] = humanize_date(entry['creation_date'])
 
 
-def generate_readmore(entry, single=False):
+def generate_readmore(entry, single=False, excerpt=None):
     """
-    Replaces any <hr /> tag with an URL to the full entry's text
-    and strips down the current entry's text to make a summary.
+    Replaces the entry's text with its *excerpt* (see split_excerpt)
+    followed by an URL to the full entry's text; a single entry
+    shows a line break in place of the first <hr /> tag instead.
     """
     try:
         #SQLite
@@ -112,61 +150,233 @@ def generate_readmore(entry, single=False):
                  % (url_for('view_entry', year=year, month=month, day=day, 
                  title=entry['slug']), entry['title'])
 
-    strip_index = entry['content'].find("""<hr />""")
-    
     # Stripping down text and appending the generated URL
-    if strip_index > 0:
-        if single:
+    if single:
+        strip_index = entry['content'].find("""<hr />""")
+        if strip_index > 0:
             entry['content'] = entry['content'][:strip_index] + Markup("""<br />""") + entry['content'][strip_index+6:]
-        else:
-            entry['content'] = entry['content'][:strip_index] + Markup(entry_url)
+    elif excerpt is not None:
+        entry['content'] = Markup(excerpt) + Markup(entry_url)
 
     # Add a separator at the end of the post
     entry['content'] = entry['content'] + Markup("""<hr />""")
 
 
-def fill_markdown_content(entries, gen_readmore=True):
+def render_version():
     """
-    Convenience function which converts entry's body Markdown
-    syntax to HTML code.
+    Returns a fingerprint of the Markdown pipeline (library versions
+    and configured extensions); stored HTML rendered with a different
+    fingerprint is considered stale.
     """
-    
-    if len(entries) == 1:
-        single = True
-    else:
-        single = False
+    pipeline = repr((markdown.version,
+                     pygments.__version__,
+                     list(app.config['MARKDOWN_EXTENSIONS'])))
+    return hashlib.sha1(pipeline).hexdigest()
+
+
+# The render caches and the settings they were built from
+_render_cache = None
+_render_cache_settings = None
+_block_cache = None
+_block_cache_settings = None
+
+
+def _markdown_cache(size, path, limit):
+    """
+    Returns a cache of rendered Markdown keeping *size* outputs in
+    memory and, if *path* is set, the *limit* most recently used ones
+    in that SQLite database, or None when both are off.
+    """
+    if not (size or path):
+        return None
+    store = None
+    if path:
+        store = markdown.cache.SQLiteStore(path, limit=limit)
+    # Highlighted code depends on the Pygments version as well
+    return markdown.cache.RenderCache(size, store, pygments.__version__)
+
+
+def render_cache():
+    """
+    Returns the Markdown render cache set up by MARKDOWN_CACHE_SIZE
+    and MARKDOWN_CACHE_STORE, or None when it is turned off; it is
+    rebuilt when those settings change.
+    """
+    global _render_cache, _render_cache_settings
+    settings = (app.config['MARKDOWN_CACHE_SIZE'],
+                app.config['MARKDOWN_CACHE_STORE'],
+                app.config['MARKDOWN_CACHE_STORE_LIMIT'])
+    if settings != _render_cache_settings:
+        _render_cache = _markdown_cache(*settings)
+        _render_cache_settings = settings
+    return _render_cache
+
+
+def block_cache():
+    """
+    Returns the cache of rendered Markdown blocks set up by
+    MARKDOWN_BLOCK_CACHE_SIZE, or None when it is turned off; it is
+    rebuilt when the setting changes.
+
+    Blocks are kept in memory only: a store would cost a query for
+    every block missed and a commit for every new one, and the blocks
+    would evict the whole documents from MARKDOWN_CACHE_STORE.
+    """
+    global _block_cache, _block_cache_settings
+    settings = (app.config['MARKDOWN_BLOCK_CACHE_SIZE'], None, None)
+    if settings != _block_cache_settings:
+        _block_cache = _markdown_cache(*settings)
+        _block_cache_settings = settings
+    return _block_cache
+
+
+@timed('markdown')
+def render_markdown(text):
+    """
+    Converts Markdown text to HTML using the configured extensions,
+    with the converter the current thread keeps for them; outputs
+    are looked up in the render cache first, then the blocks of a
+    text which is not there (e.g. an edited entry) in the block cache.
+    """
+    converter = markdown.get_converter(app.config['MARKDOWN_EXTENSIONS'],
+                                       cache=render_cache(),
+                                       block_cache=block_cache())
+    return converter.convert(text)
+
+
+def split_excerpt(content_html):
+    """
+    Returns the excerpt of an entry's HTML, i.e. what comes before
+    its first <hr /> tag (the ``read more'' break), or None when
+    there is no such break.
+    """
+    strip_index = content_html.find("""<hr />""")
+    if strip_index > 0:
+        return content_html[:strip_index]
+    return None
+
+
+def fill_markdown_content(entries, gen_readmore=True, single=False):
+    """
+    Convenience function which fills the entry's HTML content;
+    the HTML stored at write time is used when it is up to date,
+    otherwise the body is converted from Markdown on the fly.
+
+    Listings (gen_readmore but not *single*) show the stored excerpt
+    of the entries which have one: the listing queries leave out
+    the full HTML (content_html) of those entries.
+
+    Returns the list of entries whose stored HTML is missing or stale.
+    """
+    version = render_version()
+    stale = []
 
     for entry in entries:
-        entry['content'] = Markup(markdown.markdown(entry['body'], ['codehilite']))
+        content_html = entry.get('content_html')
+        excerpt = entry.get('excerpt_html')
+        if entry.get('render_version') != version or \
+           content_html is None and excerpt is None:
+            content_html = render_markdown(entry['body'])
+            excerpt = split_excerpt(content_html)
+            stale.append(entry)
+        elif excerpt is None:
+            # Stored before excerpts were
+            excerpt = split_excerpt(content_html)
+
+        if content_html is not None:
+            entry['content'] = Markup(content_html)
+        else:
+            entry['content'] = Markup(excerpt)
+
         if gen_readmore: 
-            generate_readmore(entry, single)
+            generate_readmore(entry, single, excerpt)
 
+    return stale
 
-def humanize_date(date_string):
+
+def humanize_date(date):
     """
     Converts numerics date to a more friendly form;
-    given a numeric date formatted as "<Year>-<Month>-<Day>""
-    it returns the string "<Month Name> <Day>".
+    given a date (or a numeric date formatted as
+    "<Year>-<Month>-<Day>") it returns the string "<Day> <Month Name>".
     """
-    date = datetime.datetime.strptime(date_string, '%Y-%m-%d')
-    return date.strftime('%d %b').upper()
+    return parse_creation_date(date).strftime('%d %b').upper()
 
 
 def fill_entries(entries):
     """
     Convenience function which inserts several new fields
-    into the entries dict (see above).
+    into the entries dict (see above); the HTML content is
+    filled later by the views (see fill_markdown_content), once
+    they know the client does not hold a fresh copy already.
     """
     # Add humanized post date
     fill_humanized_dates(entries)
     # Add tags
     fill_tags(entries)
-    # Add Markdown entry
-    fill_markdown_content(entries)
     # Add author
     fill_author(entries)
 
 
+def parse_creation_date(value):
+    """
+    Returns an entry's creation_date as a date; sqlite stores it as
+    '%Y-%m-%d', while the datastore already returns a datetime.
+    """
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+    return value
+
+
+def parse_last_date(value):
+    """
+    Returns an entry's last_date as a datetime; sqlite stores either
+    a date ('%Y-%m-%d', older entries) or a UTC timestamp, while the
+    datastore already returns a datetime.
+    """
+    if isinstance(value, basestring):
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return datetime.datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+
+def entry_validators(entries, *extra):
+    """
+    Returns the (etag, last_modified) HTTP validators of a page showing
+    the given entries: last_modified is their most recent last_date,
+    while the etag also covers BUILD_VERSION, the Markdown pipeline
+    and any extra value the page depends on.
+    """
+    last_dates = [parse_last_date(entry['last_date'])
+                  for entry in entries if entry.get('last_date')]
+    if last_dates:
+        # HTTP dates have a one second resolution
+        last_modified = max(last_dates).replace(microsecond=0)
+    else:
+        last_modified = None
+
+    fingerprint = repr((app.config['BUILD_VERSION'],
+                        render_version(),
+                        extra,
+                        [(entry.get('id', entry.get('entry_id')),
+                          unicode(entry.get('last_date')))
+                         for entry in entries]))
+    return hashlib.sha1(fingerprint).hexdigest(), last_modified
+
+
+def highlight_snippet(snippet):
+    """
+    Escapes a search snippet, whose matches are delimited by the
+    \\x02 and \\x03 control characters, and wraps the matches in
+    <mark> tags.
+    """
+    return Markup.escape(snippet or u'') \
+           .replace(u'\x02', Markup(u'<mark>')) \
+           .replace(u'\x03', Markup(u'</mark>'))
+
+
 def filter_projects(entries):
     """
     Removes an entry from the list if it contains the tag "project";
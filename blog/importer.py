@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+
+    blog.importer
+    ~~~~~~~~~~~~~~~~~~
+
+    Bulk import of Markdown posts with a front matter, e.g.
+
+        ---
+        title: Hello, world
+        date: 2010-11-05
+        tags: python, flask
+        ---
+        The body, in *Markdown*.
+
+    Posts are parsed and rendered by a pool of worker processes
+    while the main process stores them in batches, one transaction
+    per batch (see insert_entries in the data layer).
+
+    :copyright: (c) 2010 by Gianluca Bargelli.
+    :license: MIT License, see LICENSE for more details.
+
+
+"""
+
+import os
+import re
+import time
+import codecs
+import datetime
+import multiprocessing
+from flask import g
+from views import app, data_layer
+from helpers import slugify_entry, render_markdown, render_version
+
+EXTENSIONS = ('.md', '.markdown', '.mkd')
+FRONT_MATTER = re.compile(r'\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)',
+                          re.S)
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def import_posts(directory, username, batch_size=500, processes=None):
+    """
+    Imports every Markdown file found in *directory* (and below it)
+    as an entry owned by *username* and returns a dictionary with the
+    number of posts read, imported and skipped (already present), the
+    files which could not be parsed, the elapsed seconds and the
+    throughput in posts per second.
+    """
+    start = time.time()
+    paths = find_posts(directory)
+    report = {'posts': len(paths), 'imported': 0, 'skipped': 0,
+              'failed': []}
+
+    # Workers render while this process writes; they are started
+    # before any connection is opened, so they share none
+    if processes == 1:
+        pool = None
+    else:
+        data_layer.dispose()
+        pool = multiprocessing.Pool(processes)
+
+    ctx = app.test_request_context()
+    ctx.push()
+    try:
+        g.db = data_layer.connect_db()
+        try:
+            user = data_layer.get_user(username)
+            if user is None:
+                raise ValueError('No such user: %s' % username)
+
+            if pool is None:
+                posts = map(load_post, paths)
+            else:
+                posts = pool.imap(load_post, paths, chunksize=32)
+
+            batch = []
+            for path, post, error in posts:
+                if error is not None:
+                    report['failed'].append((path, error))
+                    continue
+                batch.append(post)
+                if len(batch) == batch_size:
+                    store_batch(batch, user['id'], report)
+                    batch = []
+            if batch:
+                store_batch(batch, user['id'], report)
+        finally:
+            data_layer.close()
+    finally:
+        ctx.pop()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report['seconds'] = time.time() - start
+    report['rate'] = report['imported'] / max(report['seconds'], 1e-6)
+    return report
+
+
+def store_batch(batch, owner, report):
+    """Stores a batch of posts and updates the import report."""
+    imported = data_layer.insert_entries(batch, owner)
+    report['imported'] += imported
+    report['skipped'] += len(batch) - imported
+
+
+def find_posts(directory):
+    """Returns the sorted paths of the Markdown files in directory."""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths.extend([os.path.join(root, name) for name in files
+                      if os.path.splitext(name)[1].lower() in EXTENSIONS])
+    paths.sort()
+    return paths
+
+
+def load_post(path):
+    """
+    Reads, parses and renders a post; it returns a (path, post,
+    error) tuple where post is ready for insert_entries and error
+    is None, or post is None and error tells what went wrong.
+    """
+    try:
+        f = codecs.open(path, encoding='utf-8')
+        try:
+            post = parse_post(f.read())
+        finally:
+            f.close()
+    except (IOError, UnicodeDecodeError, ValueError), e:
+        return path, None, str(e)
+
+    post['slug'] = slugify_entry(post['title'])
+    post['content_html'] = render_markdown(post['body'])
+    post['render_version'] = render_version()
+    return path, post, None
+
+
+def parse_post(text):
+    """
+    Splits a post into its front matter (``key: value'' lines, of
+    which title and date are required) and its body; it returns a
+    dictionary with the title, creation_date, tags and body, or
+    raises ValueError.
+    """
+    match = FRONT_MATTER.match(text)
+    if match is None:
+        raise ValueError('Missing front matter')
+
+    meta = {}
+    for line in match.group(1).splitlines():
+        if line.strip() and not line.lstrip().startswith('#'):
+            key, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError('Bad front matter line: %r' % line)
+            meta[key.strip().lower()] = value.strip().strip('"\'')
+
+    if not meta.get('title'):
+        raise ValueError('Missing title')
+
+    return {'title': meta['title'],
+            'creation_date': parse_date(meta.get('date', '')),
+            'tags': parse_tags(meta.get('tags', '')),
+            'body': text[match.end():].strip()}
+
+
+def parse_date(value):
+    """Returns the date of a front matter date (time is ignored)."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError('Bad date: %r' % value)
+
+
+def parse_tags(value):
+    """
+    Returns the tags of a front matter tag list, separated by commas
+    or spaces and optionally in brackets ([python, flask]).
+    """
+    value = value.strip('[]')
+    return [tag.strip('"\'') for tag in re.split(r'[\s,]+', value) if tag]
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+
+    blog.metrics
+    ~~~~~~~~~~~~~~~~~~
+
+    Lightweight per-request phase timing: the time spent in the
+    database (reported by the instrumented cursors of blog.db), in
+    Markdown (Pygments included), in Pygments alone and in the
+    templates is summed up for every request, sent back in a
+    Server-Timing header and aggregated into per-endpoint histograms,
+    which /metrics serves in the Prometheus text format.
+
+    Timing is switched on by the METRICS setting; when it is off the
+    hooks cost a thread-local lookup per call.
+
+    :copyright: (c) 2010 by Gianluca Bargelli.
+    :license: MIT License, see LICENSE for more details.
+
+
+"""
+
+import time
+import bisect
+import threading
+from flask import request, signals_available, request_started
+import flask.templating
+from markdown.extensions.codehilite import CodeHilite
+
+# Histogram upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# The phases of the current request: name -> [seconds, calls], or
+# None when the request is not timed
+_local = threading.local()
+
+
+def timed(phase, calls=1):
+    """
+    Decorator adding the time spent in the decorated function to a
+    phase of the current request, as *calls* calls.
+    """
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+            phases = getattr(_local, 'phases', None)
+            if phases is None:
+                return f(*args, **kwargs)
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record(phases, phase, time.time() - start, calls)
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+    return decorator
+
+
+def add(phase, seconds, calls=1):
+    """Adds *seconds* and *calls* to a phase of the current request."""
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        record(phases, phase, seconds, calls)
+
+
+def timing():
+    """Tells whether the current request is being timed."""
+    return getattr(_local, 'phases', None) is not None
+
+
+def record(phases, phase, seconds, calls=1):
+    """Adds *seconds* and *calls* to a phase."""
+    try:
+        totals = phases[phase]
+    except KeyError:
+        totals = phases[phase] = [0.0, 0]
+    totals[0] += seconds
+    totals[1] += calls
+
+
+class Histogram(object):
+    """Counts observations in the BUCKETS, with their sum."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Registry(object):
+    """
+    Aggregates the timings of the finished requests: a histogram and
+    a call counter per endpoint and phase (the whole request being
+    the ``total'' phase), and a request counter per endpoint and
+    status code.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._calls = {}
+        self._requests = {}
+
+    def observe(self, endpoint, status, total, phases):
+        self._lock.acquire()
+        try:
+            key = (endpoint, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for phase, (seconds, calls) in phases.items() + \
+                                           [('total', (total, 1))]:
+                key = (endpoint, phase)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.observe(seconds)
+                self._calls[key] = self._calls.get(key, 0) + calls
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Forgets every observation (e.g. between tests)."""
+        self._lock.acquire()
+        try:
+            self._histograms.clear()
+            self._calls.clear()
+            self._requests.clear()
+        finally:
+            self._lock.release()
+
+    def exposition(self, extra=()):
+        """
+        Returns the metrics in the Prometheus text format, followed by
+        the *extra* ones, given as (name, type, help, samples) tuples
+        where samples are (labels, value) pairs.
+        """
+        self._lock.acquire()
+        try:
+            lines = ['# HELP blog_request_seconds Time spent per request '
+                     'phase (total is the whole request; markdown '
+                     'includes pygments).',
+                     '# TYPE blog_request_seconds histogram']
+            for (endpoint, phase), histogram in sorted(self._histograms.items()):
+                labels = {'endpoint': endpoint, 'phase': phase}
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('blog_request_seconds_bucket%s %d'
+                                 % (format_labels(labels, le=bound), cumulative))
+                lines.append('blog_request_seconds_sum%s %r'
+                             % (format_labels(labels), histogram.sum))
+                lines.append('blog_request_seconds_count%s %d'
+                             % (format_labels(labels), histogram.count))
+
+            calls = [({'endpoint': endpoint, 'phase': phase}, value)
+                     for (endpoint, phase), value in sorted(self._calls.items())
+                     if phase != 'total']
+            requests = [({'endpoint': endpoint, 'status': status}, value)
+                        for (endpoint, status), value
+                        in sorted(self._requests.items())]
+        finally:
+            self._lock.release()
+
+        families = [('blog_request_phase_calls_total', 'counter',
+                     'Calls per request phase (e.g. database statements).',
+                     calls),
+                    ('blog_requests_total', 'counter',
+                     'Requests handled, by endpoint and status.', requests)]
+        for name, kind, help, samples in families + list(extra):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %r' % (name, format_labels(labels),
+                                          float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def format_labels(labels, **extra):
+    """Returns a Prometheus label set, e.g. {endpoint="about",le="0.5"}."""
+    items = sorted(labels.items()) + extra.items()
+    if not items:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, escape_label(value))
+                              for name, value in items])
+
+
+def escape_label(value):
+    """Escapes a label value as the Prometheus text format requires."""
+    return unicode(value).replace('\\', r'\\').replace('"', r'\"') \
+                         .replace('\n', r'\n').encode('utf-8')
+
+
+def server_timing(phases, total):
+    """Returns the Server-Timing header value of a request's phases."""
+    metrics = ['%s;dur=%.2f;desc="%d calls"' % (phase, seconds * 1000.0, calls)
+               for phase, (seconds, calls) in sorted(phases.items())]
+    metrics.append('total;dur=%.2f' % (total * 1000.0))
+    return ', '.join(metrics)
+
+
+def install(app):
+    """
+    Hooks the timing into app and the libraries doing the work; it has
+    to be called before any other before_request function is
+    registered, so that the whole request is timed.
+    """
+    def start_request(sender=None):
+        if app.config['METRICS']:
+            _local.phases = {}
+            _local.start = time.time()
+        else:
+            _local.phases = None
+
+    def finish_request(response):
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            _local.phases = None
+            total = time.time() - _local.start
+            registry.observe(request.endpoint or 'none', response.status_code,
+                             total, phases)
+            response.headers['Server-Timing'] = server_timing(phases, total)
+        return response
+
+    # The signal comes before the session is opened and the URL matched
+    if signals_available:
+        request_started.connect(start_request, app, weak=False)
+    else:
+        app.before_request(start_request)
+    # after_request functions run in reverse order: this one comes last
+    app.after_request(finish_request)
+
+    # Neither the templates nor the vendored extension have a hook
+    flask.templating._render = timed('template')(flask.templating._render)
+    CodeHilite.hilite = timed('pygments')(CodeHilite.hilite)
+
@@ -35,6 +35,14 @@ class Entry(db.Model):
     slug = db.StringProperty(required=True)
     title = db.StringProperty(required=True)
     body = db.TextProperty(required=True)
+    """
+    content_html caches the rendered body and excerpt_html its part
+    before the read more break (None without one); render_version is
+    the fingerprint of the Markdown pipeline which produced them.
+    """
+    content_html = db.TextProperty()
+    excerpt_html = db.TextProperty()
+    render_version = db.StringProperty()
     creation_date = db.DateTimeProperty(auto_now_add=True)
     """
     creation_only_date is used for single entry display; 
@@ -44,3 +52,13 @@ class Entry(db.Model):
     last_date = db.DateTimeProperty(auto_now=True)
     user_id_FK = db.ReferenceProperty(User, collection_name='Owner')
     tags = db.StringListProperty()
+
+
+class CounterShard(db.Model):
+    """
+    This class models one shard of a named counter; the counter
+    value is the sum of its shards, so that concurrent updates are
+    spread over several entities.
+    """
+    name = db.StringProperty(required=True)
+    count = db.IntegerProperty(required=True, default=0)
@@ -38,6 +38,13 @@ CREATE TABLE tag (
 	name VARCHAR(10) NOT NULL
 );
 
+DROP TABLE IF EXISTS counter;
+/* The full-text index of migration 0004 */
+DROP TABLE IF EXISTS entry_search;
+
+/* Schema version 0: blog/schema/migrations brings it up to date */
+PRAGMA user_version = 0;
+
 /* Sample data */
 INSERT INTO "user" VALUES(1, 'bargio', 'f1b1a13033eddc3fdeecc0ed03bdc019c25890ba906658addad9fefe',0);
 INSERT INTO "user" VALUES(2, 'test', '90a3ed9e32b2aaf4c61c410eb925426119e1a9dc53d4286ade99a809',0);
@@ -0,0 +1,3 @@
+/* Markdown rendered at write time, tagged with the renderer version */
+ALTER TABLE entry ADD COLUMN content_html TEXT;
+ALTER TABLE entry ADD COLUMN render_version VARCHAR(40);
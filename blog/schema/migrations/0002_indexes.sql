@@ -0,0 +1,23 @@
+/* Listings are sorted by date, with the id breaking ties */
+CREATE INDEX IF NOT EXISTS entry_date ON entry (creation_date, id);
+
+/* get_entry looks articles up by slug and date */
+CREATE INDEX IF NOT EXISTS entry_slug ON entry (slug, creation_date);
+
+/* The primary key covers the entry side of the join, this one the tag side */
+CREATE INDEX IF NOT EXISTS entry_tags_tag ON entry_tags (id_tag_FK, id_entry_FK);
+
+/* Merge duplicated tag names into their oldest record before
+   enforcing uniqueness */
+UPDATE OR IGNORE entry_tags
+SET id_tag_FK = (SELECT MIN(first.id)
+                 FROM tag AS first
+                 JOIN tag AS current ON first.name = current.name
+                 WHERE current.id = entry_tags.id_tag_FK);
+DELETE FROM entry_tags
+WHERE id_tag_FK NOT IN (SELECT MIN(id) FROM tag GROUP BY name);
+DELETE FROM tag
+WHERE id NOT IN (SELECT MIN(id) FROM tag GROUP BY name);
+
+DROP INDEX IF EXISTS tag_name;
+CREATE UNIQUE INDEX tag_name ON tag (name);
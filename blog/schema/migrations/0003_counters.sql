@@ -0,0 +1,14 @@
+/* Entry and tag counts, plus the generation number of the page cache */
+CREATE TABLE IF NOT EXISTS counter (
+	name VARCHAR(40) PRIMARY KEY,
+	value INTEGER NOT NULL DEFAULT 0
+);
+
+DELETE FROM counter WHERE name = 'entries' OR name LIKE 'tag:%';
+INSERT INTO counter
+SELECT 'entries', COUNT(*) FROM entry;
+INSERT INTO counter
+SELECT 'tag:' || tag.name, COUNT(*)
+FROM tag
+JOIN entry_tags ON tag.id = entry_tags.id_tag_FK
+GROUP BY tag.name;
@@ -0,0 +1,31 @@
+/* Full-text index over the entries' titles and bodies; the text
+   itself stays in the entry table (external content) */
+CREATE VIRTUAL TABLE entry_search USING fts5(
+	title,
+	body,
+	content = 'entry',
+	content_rowid = 'id',
+	tokenize = 'porter unicode61'
+);
+
+/* Kept in sync by triggers, whatever path writes the entries */
+CREATE TRIGGER entry_search_insert AFTER INSERT ON entry BEGIN
+	INSERT INTO entry_search (rowid, title, body)
+	VALUES (new.id, new.title, new.body);
+END;
+
+CREATE TRIGGER entry_search_delete AFTER DELETE ON entry BEGIN
+	INSERT INTO entry_search (entry_search, rowid, title, body)
+	VALUES ('delete', old.id, old.title, old.body);
+END;
+
+/* Re-rendering the HTML does not touch the index */
+CREATE TRIGGER entry_search_update AFTER UPDATE OF title, body ON entry BEGIN
+	INSERT INTO entry_search (entry_search, rowid, title, body)
+	VALUES ('delete', old.id, old.title, old.body);
+	INSERT INTO entry_search (rowid, title, body)
+	VALUES (new.id, new.title, new.body);
+END;
+
+INSERT INTO entry_search (entry_search) VALUES ('rebuild');
+INSERT INTO entry_search (entry_search) VALUES ('optimize');
@@ -0,0 +1,7 @@
+/* HTML of the entries before their read more break, shown by the
+   listings; NULL when an entry has no break */
+ALTER TABLE entry ADD COLUMN excerpt_html TEXT;
+
+UPDATE entry
+SET excerpt_html = substr(content_html, 1, instr(content_html, '<hr />') - 1)
+WHERE instr(content_html, '<hr />') > 1;
@@ -13,21 +13,20 @@ CREATE TABLE rank (
 
 DROP TABLE IF EXISTS entry;
 CREATE TABLE entry (
-	id INTEGER NOT NULL,
+	id INTEGER PRIMARY KEY autoincrement,
     slug VARCHAR(80) NOT NULL,
 	title VARCHAR(80) NOT NULL,
 	body TEXT NOT NULL,
 	creation_date DATE NOT NULL,
 	last_date DATE,
-	user_id_FK INTEGER NOT NULL REFERENCES user(id),
-    PRIMARY KEY(id, slug)
+	user_id_FK INTEGER NOT NULL REFERENCES user(id)
 );
 
 DROP TABLE IF EXISTS entry_tags;
 CREATE TABLE entry_tags (
-	slug_entry_FK INTEGER REFERENCES entry(id),
+	id_entry_FK INTEGER REFERENCES entry(id),
 	id_tag_FK INTEGER REFERENCES tag(id),
-	PRIMARY KEY(slug_entry_FK, id_tag_FK)
+	PRIMARY KEY(id_entry_FK, id_tag_FK)
 );
 
 DROP TABLE IF EXISTS tag;
@@ -35,3 +34,10 @@ CREATE TABLE tag (
 	id INTEGER PRIMARY KEY autoincrement,
 	name VARCHAR(10) NOT NULL
 );
+
+DROP TABLE IF EXISTS counter;
+/* The full-text index of migration 0004 */
+DROP TABLE IF EXISTS entry_search;
+
+/* Schema version 0: blog/schema/migrations brings it up to date */
+PRAGMA user_version = 0;
@@ -14,23 +14,35 @@
 """
 
 from flask import Flask, request, session, g, redirect, \
-     render_template, abort, flash, url_for
+     render_template, abort, flash, url_for, make_response
+import config
 
 app = Flask(__name__)
+# Defaults first, then the deployment's own settings
+app.config.from_object(config.Config)
 app.config.from_pyfile('../config.cfg')
 # Loading the Data Abstract Layer object
 from db import factory
 data_layer = factory(app.config['PLATFORM'])
+# Full-page cache for the public, read-mostly views
+import cache
+response_cache = cache.factory(app.config)
+CACHED_ENDPOINTS = ('list_entries', 'list_page', 'view_entry',
+                    'search_entries', 'show_projects', 'show_about',
+                    'recent_feed')
+# Phase timing; its hooks go first so that they wrap the whole request
+import metrics
+metrics.install(app)
 
 from helpers import check_password_hash, slugify_entry, \
      fill_entries, entry_pages, unpack_pages, split_pages, \
-     fill_author, fill_tags, fill_markdown_content, \
-     generate_page_title, make_external, random_logo
+     fill_markdown_content, generate_page_title, make_external, \
+     random_logo, entry_validators, render_cache, block_cache
 
 from werkzeug.contrib.atom import AtomFeed
+from werkzeug.http import is_resource_modified
 
 import datetime
-import config
 
 
 @app.before_request
@@ -41,6 +53,25 @@ def before_request():
     """
     g.db = data_layer.connect_db()
     g.user = None 
+    g.cache_key = None
+
+    # Cached pages are served before any other work (with a 304 if
+    # the client's copy is still fresh); pages with pending flash
+    # messages are neither served nor stored, and neither are frozen
+    # pages, whose pager links differ
+    if request.method == 'GET' and request.endpoint in CACHED_ENDPOINTS:
+        g.generation = data_layer.generation()
+
+        if '_flashes' not in session and not app.config['FREEZING']:
+            g.cache_key = response_cache.make_key(g.generation,
+                                                  'user_id' in session,
+                                                  request.path,
+                                                  request.query_string)
+            response = response_cache.get(g.generation, g.cache_key,
+                                          app.response_class)
+            if response is not None:
+                g.cache_key = None
+                return response.make_conditional(request)
     
     if 'user_id' in session:
         g.user = data_layer.load_user_profile(session['user_id'])
@@ -48,14 +79,23 @@ def before_request():
 
 @app.after_request
 def after_request(response):
-    """Closes the database again at the end of the request."""
-    data_layer.close()
+    """
+    Stores cacheable pages and closes the database again at the
+    end of the request.
+    """
+    try:
+        if getattr(g, 'cache_key', None) is not None \
+           and response.status_code == 200:
+            response_cache.set(g.generation, g.cache_key, response)
+    finally:
+        # A failing cache backend must not keep the connection
+        data_layer.close()
     return response
 
 
 @app.route('/blog')
 @app.route('/blog/tags/<tagname>')
-def list_entries(tagname=None):
+def list_entries(tagname=None, page=None):
     """
     Returns a list of entries in the form of pages containing
     MAX_PAGE_ENTRIES entries;
@@ -64,35 +104,197 @@ def list_entries(tagname=None):
 
     Optionally, this method accepts a tagname for tag filtering.
     """
-    try:
-        page = int(request.args['page'])
-        if page <= 0:
+    if page is None:
+        try:
+            page = int(request.args['page'])
+            if page <= 0:
+                page = 1
+        except:
             page = 1
-    except:
-        page = 1
 
-    # Calculate the right offset
-    offset = app.config['MAX_PAGE_ENTRIES']*(page-1)
+    # A ?before= cursor takes precedence over the page number
+    before = request.args.get('before')
+
+    try:
+        if before is not None:
+            page = data_layer.page_number(tagname, before)
+
+        # Calculate the right offset
+        offset = app.config['MAX_PAGE_ENTRIES']*(page-1)
     
-    # Obtain entries and num_entries
-    entries, num_entries = data_layer.get_entries(tagname, offset)
+        # Obtain entries and num_entries
+        entries, num_entries = data_layer.get_entries(tagname, offset, before)
+    except ValueError:
+        abort(400)
 
     # This happens when trying to access a non-existent page
     if len(entries) == 0 and page !=1: 
         abort(404)
 
+    # Answer conditional requests before any rendering
+    validators = page_validators(entries, dated=False)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+
+    fill_content(entries)
+
     # Splitting pages
-    splitted_pages = unpack_pages(split_pages(page, entry_pages(num_entries)))
+    total_pages = entry_pages(num_entries)
+    splitted_pages = unpack_pages(split_pages(page, total_pages))
+
+    # Previous/next links
+    previous_url = next_url = None
+    if page > 1:
+        previous_url = page_url(tagname, page-1)
+    if page < total_pages:
+        next_url = page_url(tagname, page+1)
     
     # Generating title
     title = generate_page_title(tagname)
 
     # Jinja2 render
-    return render_template("list_entries.html",
-                            actual_page=page,
-                            entries=entries,
-                            pages=splitted_pages,
-                            title=title)
+    response = make_response(render_template("list_entries.html",
+                                             actual_page=page,
+                                             entries=entries,
+                                             pages=splitted_pages,
+                                             page_link=lambda page:
+                                             numbered_page_url(tagname, page),
+                                             previous_url=previous_url,
+                                             next_url=next_url,
+                                             tagname=tagname,
+                                             title=title))
+    return set_validators(response, validators)
+
+# Path-only page URLs, which a frozen copy of the blog can serve
+app.add_url_rule('/blog/page/<int:page>', 'list_page', list_entries)
+app.add_url_rule('/blog/tags/<tagname>/page/<int:page>', 'list_page',
+                 list_entries)
+
+
+def page_url(tagname, page):
+    """
+    Returns the URL of a listing page: a stable ?before= URL when
+    the data layer can hand out a cursor for it, ?page= otherwise.
+    While freezing, only path URLs are used.
+    """
+    if app.config['FREEZING']:
+        return numbered_page_url(tagname, page)
+
+    cursor = data_layer.page_cursor(tagname, page)
+    if cursor is not None:
+        return url_for('list_entries', tagname=tagname, before=cursor)
+    else:
+        return numbered_page_url(tagname, page)
+
+
+def numbered_page_url(tagname, page):
+    """
+    Returns the URL of a listing page by number: /blog/page/<page>
+    while freezing, ?page= otherwise.
+    """
+    if page <= 1:
+        return url_for('list_entries', tagname=tagname)
+    elif app.config['FREEZING']:
+        return url_for('list_page', tagname=tagname, page=page)
+    else:
+        return url_for('list_entries', tagname=tagname, page=page)
+
+
+def fill_content(entries, gen_readmore=True, single=False):
+    """
+    Fills the entries' HTML content, scheduling a background
+    re-render when some stored HTML turns out to be stale.
+    """
+    if fill_markdown_content(entries, gen_readmore, single):
+        data_layer.schedule_rerender()
+
+
+def page_validators(entries, dated=True):
+    """
+    Returns the (etag, last_modified) validators of a page showing
+    the given entries; the etag also changes with the site generation
+    and the logged-in state, which affect the rest of the page.
+
+    Listings also change with writes that leave the last_date of the
+    entries they show alone (an entry loses the tag, the pager moves),
+    so they pass dated=False and carry no Last-Modified: a client
+    sending only If-Modified-Since would get a stale 304.
+    """
+    etag, last_modified = entry_validators(entries, g.generation,
+                                           'user_id' in session)
+    return etag, last_modified if dated else None
+
+
+def not_modified(validators):
+    """
+    Returns a 304 response when the client's copy matches the
+    validators, None otherwise; pages carrying flash messages
+    are always sent in full.
+    """
+    etag, last_modified = validators
+    if '_flashes' not in session and \
+       not is_resource_modified(request.environ, etag,
+                                last_modified=last_modified):
+        return set_validators(app.response_class(status=304), validators)
+
+
+def set_validators(response, validators):
+    """Sets the ETag and Last-Modified headers of a response."""
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+@app.route('/search')
+def search_entries():
+    """
+    Returns the entries matching the ``q'' argument, most relevant
+    first, in pages of MAX_PAGE_ENTRIES entries with a highlighted
+    snippet in place of their text.
+    """
+    query = request.args.get('q', u'').strip()
+    try:
+        page = int(request.args['page'])
+        if page <= 0:
+            page = 1
+    except:
+        page = 1
+
+    offset = app.config['MAX_PAGE_ENTRIES']*(page-1)
+    entries, num_results = data_layer.search_entries(query, offset)
+
+    if len(entries) == 0 and page != 1:
+        abort(404)
+
+    validators = page_validators(entries, dated=False)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+
+    total_pages = entry_pages(num_results)
+    splitted_pages = unpack_pages(split_pages(page, total_pages))
+
+    previous_url = next_url = None
+    if page > 1:
+        previous_url = url_for('search_entries', q=query, page=page-1)
+    if page < total_pages:
+        next_url = url_for('search_entries', q=query, page=page+1)
+
+    response = make_response(render_template("list_entries.html",
+                                             actual_page=page,
+                                             entries=entries,
+                                             pages=splitted_pages,
+                                             page_link=lambda page:
+                                             url_for('search_entries',
+                                                     q=query, page=page),
+                                             previous_url=previous_url,
+                                             next_url=next_url,
+                                             query=query,
+                                             title=u'Search: “%s”' % query))
+    return set_validators(response, validators)
 
 
 @app.route('/blog/articles/<int:year>/<int:month>/<int:day>/<title>')
@@ -107,9 +309,17 @@ def view_entry(year, month, day, title):
 
     if entry is None:
         abort(404)
-    else:
-        return render_template('list_entries.html', entries=[entry],
-                                                    title=entry['title'])
+
+    validators = page_validators([entry])
+    response = not_modified(validators)
+    if response is not None:
+        return response
+
+    fill_content([entry], single=True)
+    response = make_response(render_template('list_entries.html',
+                                             entries=[entry],
+                                             title=entry['title']))
+    return set_validators(response, validators)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -231,13 +441,7 @@ def admin_panel():
     """Display a panel for administration purposes."""
     if g.user is not None:
         if g.user['role_name'] == 'administrator':
-            entries_list = data_layer.query_db(
-                           """
-                           SELECT id, user_id_FK, slug, title 
-                           FROM entry
-                           """)
-            fill_tags(entries_list)
-            fill_author(entries_list)
+            entries_list = data_layer.get_entry_list()
 
             return render_template('admin.html', entries=entries_list)
 
@@ -247,6 +451,85 @@ def admin_panel():
         return redirect(url_for('login'))
 
 
+@app.route('/metrics')
+def show_metrics():
+    """
+    Serves the request timings together with the connection pool and
+    the response cache statistics, in the Prometheus text format.
+    """
+    if not app.config['METRICS']:
+        abort(404)
+    if not metrics_allowed():
+        return app.response_class('Administrators only.', 401,
+                                  {'WWW-Authenticate':
+                                   'Basic realm="metrics"'})
+
+    extra = []
+    stats = response_cache.stats()
+    extra.append(('blog_cache_lookups_total', 'counter',
+                  'Response cache lookups.',
+                  [({'result': 'hit'}, stats['hits']),
+                   ({'result': 'miss'}, stats['misses'])]))
+    extra.append(('blog_cache_bytes', 'gauge',
+                  'Bytes held by the pages this process cached.',
+                  [({}, stats['bytes'])]))
+    for name, markdown_cache, lookups, entries in (
+            ('markdown_cache', render_cache(),
+             'Markdown render cache lookups, by tier.',
+             'Outputs held by the memory tier.'),
+            ('markdown_block_cache', block_cache(),
+             'Markdown block cache lookups, by tier.',
+             'Rendered chunks of blocks held by the memory tier.')):
+        if markdown_cache is None:
+            continue
+        stats = markdown_cache.stats()
+        # Misses are counted by the last tier looked up
+        last = markdown_cache.store is None and 'memory' or 'store'
+        extra.append(('blog_%s_lookups_total' % name, 'counter', lookups,
+                      [({'tier': 'memory', 'result': 'hit'}, stats['hits']),
+                       ({'tier': 'store', 'result': 'hit'},
+                        stats['store_hits']),
+                       ({'tier': last, 'result': 'miss'},
+                        stats['misses'])]))
+        extra.append(('blog_%s_entries' % name, 'gauge', entries,
+                      [({}, stats['size'])]))
+    if hasattr(data_layer, 'pool_stats'):
+        stats = data_layer.pool_stats()
+        extra.append(('blog_sqlite_pool_connections', 'gauge',
+                      'Pooled sqlite connections.',
+                      [({'state': state}, stats[state])
+                       for state in ('size', 'open', 'idle', 'in_use')]))
+        extra.append(('blog_sqlite_pool_checkouts_total', 'counter',
+                      'Connections checked out of the pool.',
+                      [({}, stats['checkouts'])]))
+        extra.append(('blog_sqlite_pool_waits_total', 'counter',
+                      'Checkouts which had to wait for a connection.',
+                      [({}, stats['waits'])]))
+        extra.append(('blog_sqlite_pool_wait_seconds_total', 'counter',
+                      'Time spent waiting for a connection.',
+                      [({}, stats['wait_time'])]))
+
+    return app.response_class(metrics.registry.exposition(extra),
+                              content_type='text/plain; version=0.0.4; '
+                                           'charset=utf-8')
+
+
+def metrics_allowed():
+    """
+    Tells whether the client is an administrator, either logged in or
+    giving its credentials with HTTP basic authentication (as a
+    Prometheus server does).
+    """
+    user = g.user
+    auth = request.authorization
+    if user is None and auth is not None:
+        found = data_layer.get_user(auth.username)
+        if found is not None and \
+           check_password_hash(auth.password, found['password']):
+            user = data_layer.load_user_profile(found['id'])
+    return user is not None and user['role_name'] == 'administrator'
+
+
 @app.route('/recent.atom')
 def recent_feed():
     """
@@ -257,6 +540,13 @@ def recent_feed():
                     url=request.url_root)
     
     entries = data_layer.get_recent_entries(15)
+
+    validators = page_validators(entries)
+    response = not_modified(validators)
+    if response is not None:
+        return response
+
+    fill_content(entries)
     # Build feed info
     for entry in entries:
         update_date = entry['last_date']
@@ -277,7 +567,9 @@ def recent_feed():
                  updated=update_date,
                  published=publish_date)
 
-    return feed.get_response()
+    response = app.response_class(feed.to_string(),
+                                  mimetype='application/atom+xml')
+    return set_validators(response, validators)
 
 
 @app.route('/')
@@ -5,6 +5,54 @@ class Config(object):
     TESTING = False
     SECRET_KEY = 'development key'
     MAX_PAGE_ENTRIES = 5
+    # Words of text shown around the matches of a search result
+    SEARCH_SNIPPET_WORDS = 24
+    # Matches ranked by a search, newest first; older ones are left out
+    SEARCH_MAX_RESULTS = 500
+    # SQLite connection pool: connections kept open, seconds to wait
+    # for a free one, page cache (negative means KiB) and mmap size
+    SQLITE_POOL_SIZE = 5
+    SQLITE_POOL_TIMEOUT = 10.0
+    SQLITE_CACHE_SIZE = -8000
+    SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+    # Statements slower than this many milliseconds are written, with
+    # their query plan, to a rotating log (as are plans scanning a
+    # whole table); None turns the query log off
+    SQLITE_SLOW_QUERY_MS = 100
+    SQLITE_SLOW_QUERY_LOG = '/tmp/blog-slow-queries.log'
+    SQLITE_SLOW_QUERY_LOG_BYTES = 1024 * 1024
+    SQLITE_SLOW_QUERY_LOG_BACKUPS = 5
+    # Full-page cache: null, simple, memcached, gaememcached or filesystem
+    CACHE_TYPE = 'simple'
+    CACHE_DEFAULT_TIMEOUT = 300
+    CACHE_THRESHOLD = 500
+    CACHE_KEY_PREFIX = 'blog/'
+    CACHE_MEMCACHED_SERVERS = ['127.0.0.1:11211']
+    CACHE_DIR = '/tmp/blog-cache'
+    # Markdown extensions used when rendering entries; changing them
+    # marks every stored HTML body as stale
+    MARKDOWN_EXTENSIONS = ['codehilite']
+    # Rendered Markdown kept in memory (0 turns the cache off) and the
+    # path of an SQLite database sharing it between processes (None
+    # keeps it in memory only; not available on App Engine)
+    MARKDOWN_CACHE_SIZE = 512
+    MARKDOWN_CACHE_STORE = None
+    # Outputs kept in that database, the least recently used going
+    # first (None keeps them all; see ./manage.py prune_cache)
+    MARKDOWN_CACHE_STORE_LIMIT = 100000
+    # Rendered chunks of blocks kept in memory, and never in the store
+    # (0 turns it off): after an edit, only the chunks which changed
+    # are rendered again
+    MARKDOWN_BLOCK_CACHE_SIZE = 4096
+    # Part of every ETag; bump it when templates change
+    BUILD_VERSION = '1'
+    # Set by the freeze command: pager links use path-only URLs
+    FREEZING = False
+    # Root URL of the frozen site, used for the feed's absolute links
+    FREEZE_BASE_URL = 'http://localhost/'
+    # Per-request phase timing, sent as Server-Timing headers and
+    # aggregated for the administrators at /metrics
+    METRICS = False
 
 class ProductionConfig(Config):
 	DATABASE_URI = 'mysql://user@localhost/foo'
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+
+    manage
+    ~~~~~~~~~~~~~~~~~~
+
+    Maintenance commands for the blog, built on werkzeug.script;
+    run ``./manage.py --help`` for the list of actions.
+
+    :copyright: (c) 2010 by Gianluca Bargelli.
+    :license: MIT License, see LICENSE for more details.
+
+
+"""
+
+from werkzeug import script
+from flask import g
+from blog.views import app, data_layer
+
+
+def run_with_db(func, *args):
+    """
+    Calls func inside a request context with g.db connected,
+    just like a view would be called.
+    """
+    ctx = app.test_request_context()
+    ctx.push()
+    try:
+        g.db = data_layer.connect_db()
+        try:
+            return func(*args)
+        finally:
+            data_layer.close()
+    finally:
+        ctx.pop()
+
+
+def action_initdb(fixture=False):
+    """Create the database tables (with the sample users if --fixture)."""
+    data_layer.init_db(testdb=fixture)
+    print 'Database created at schema version %d.' % \
+          run_with_db(lambda: data_layer.schema_version(g.db))
+
+
+def action_migrate():
+    """Apply the pending schema migrations."""
+    applied = run_with_db(lambda: data_layer.migrate(g.db))
+    version = run_with_db(lambda: data_layer.schema_version(g.db))
+    if applied:
+        print 'Applied migrations %s, now at schema version %d.' % \
+              (', '.join(['%04d' % v for v in applied]), version)
+    else:
+        print 'Schema already at version %d.' % version
+
+
+def action_recount():
+    """Rebuild the entry and tag counters from scratch."""
+    run_with_db(data_layer.recount)
+    print 'Counters rebuilt: %d entries.' % run_with_db(data_layer.count_entries)
+
+
+def action_freeze(destination='frozen', processes=0, full=False):
+    """
+    Freeze the public pages into a tree of flat files; only pages
+    showing changed entries are rendered again, unless --full.
+    """
+    from blog.freeze import freeze
+    report = freeze(destination, processes or None, incremental=not full)
+    print 'Rendered %d pages, %d unchanged, %d removed in %.1f seconds.' % \
+          (report['rendered'], report['unchanged'], report['removed'],
+           report['seconds'])
+    for url, status in report['failed']:
+        print 'Failed: %s (%d)' % (url, status)
+
+
+def action_import(directory='', username='', batch_size=500, processes=0):
+    """
+    Import a directory of Markdown posts with a front matter
+    (title, date and tags) as entries of the given user.
+    """
+    from blog.importer import import_posts
+    report = import_posts(directory, username, batch_size, processes or None)
+    print 'Imported %d of %d posts (%d already present) in %.1f seconds, ' \
+          '%.0f posts/sec.' % (report['imported'], report['posts'],
+                               report['skipped'], report['seconds'],
+                               report['rate'])
+    for path, error in report['failed']:
+        print 'Failed: %s (%s)' % (path, error)
+
+
+def action_prune_cache(limit=0):
+    """
+    Evict the least recently used outputs of the Markdown store
+    (MARKDOWN_CACHE_STORE) beyond --limit, by default beyond
+    MARKDOWN_CACHE_STORE_LIMIT.
+    """
+    from blog.helpers import render_cache
+    cache = render_cache()
+    if cache is None or cache.store is None:
+        print 'No Markdown store is configured.'
+        return
+    limit = limit or app.config['MARKDOWN_CACHE_STORE_LIMIT']
+    if limit is None:
+        print 'No limit given, and MARKDOWN_CACHE_STORE_LIMIT is None.'
+        return
+    print 'Evicted %d outputs from %s.' % (cache.store.prune(limit),
+                                           cache.store.path)
+
+
+action_runserver = script.make_runserver(lambda: app, use_reloader=True)
+action_shell = script.make_shell(lambda: {'app': app, 'data_layer': data_layer})
+
+
+if __name__ == '__main__':
+    script.run()
@@ -47,6 +47,7 @@ import codecs
 import sys
 import warnings
 import logging
+import threading
 from logging import DEBUG, INFO, WARN, ERROR, CRITICAL
 
 
@@ -166,6 +167,7 @@ import postprocessors
 import blockparser
 import etree_loader
 import odict
+import incremental
 
 # Extensions should use "markdown.etree" instead of "etree" (or do `from
 # markdown import etree`).  Do not import it by yourself.
@@ -183,7 +185,9 @@ class Markdown:
                  extensions=[],
                  extension_configs={},
                  safe_mode = False, 
-                 output_format=DEFAULT_OUTPUT_FORMAT):
+                 output_format=DEFAULT_OUTPUT_FORMAT,
+                 cache=None,
+                 block_cache=None):
         """
         Creates a new Markdown instance.
 
@@ -203,10 +207,19 @@ class Markdown:
             Note that it is suggested that the more specific formats ("xhtml1" 
             and "html4") be used as "xhtml" or "html" may change in the future
             if it makes sense at that time. 
+        * cache: A `markdown.cache.RenderCache` to look outputs up in.
+        * block_cache: A `markdown.cache.RenderCache` keeping the output
+          of each block, so that only the blocks which changed since a
+          previous conversion are rendered again (see
+          `markdown.incremental`).
 
         """
         
         self.safeMode = safe_mode
+        self.cache = cache
+        self.blockCache = block_cache
+        self.fingerprint = fingerprint(extensions, extension_configs,
+                                       safe_mode, output_format)
         self.registeredExtensions = []
         self.docType = ""
         self.stripTopLevelTags = True
@@ -366,16 +379,43 @@ class Markdown:
 
         * source: Source text as a Unicode string.
 
+        With a cache, the output is looked up there first.
+
         """
+        if self.cache is not None:
+            return self.cache.convert(self._convert, source, self.fingerprint)
+        return self._convert(source)
+
+    def _convert(self, source):
+        """ Convert markdown, bypassing the render cache. """
+        if self.blockCache is not None and \
+                incremental.isLocal(self, source):
+            return incremental.convert(self, source, self.blockCache)
+
+        self.lines = self.preprocess(source)
+        if self.lines is None:
+            return u""
+
+        # Parse the high-level elements.
+        root = self.parser.parseDocument(self.lines).getroot()
+
+        output = self.render(root, self.treeprocessors.values())
+        return self.postprocess(output).strip()
 
-        # Fixup the source text
+    def preprocess(self, source):
+        """
+        Fix up the source text and run the preprocessors.
+
+        Returns the list of lines, or None if there is nothing to convert.
+
+        """
         if not source.strip():
-            return u""  # a blank unicode string
+            return None
         try:
             source = unicode(source)
         except UnicodeDecodeError:
             message(CRITICAL, 'UnicodeDecodeError: Markdown only accepts unicode or ascii input.')
-            return u""
+            return None
 
         source = source.replace(STX, "").replace(ETX, "")
         source = source.replace("\r\n", "\n").replace("\r", "\n") + "\n\n"
@@ -383,15 +423,25 @@ class Markdown:
         source = source.expandtabs(TAB_LENGTH)
 
         # Split into lines and run the line preprocessors.
-        self.lines = source.split("\n")
+        lines = source.split("\n")
         for prep in self.preprocessors.values():
-            self.lines = prep.run(self.lines)
+            lines = prep.run(lines)
+        return lines
 
-        # Parse the high-level elements.
-        root = self.parser.parseDocument(self.lines).getroot()
+    def render(self, root, treeprocessors):
+        """
+        Run the given tree-processors on an ElementTree and serialize it.
+
+        Keyword arguments:
 
-        # Run the tree-processors
-        for treeprocessor in self.treeprocessors.values():
+        * root: The root Element, a DOC_TAG parsed by `self.parser`.
+        * treeprocessors: A list of tree-processors, in order.
+
+        Returns the output with the top-level tags stripped, before the
+        post-processors run.
+
+        """
+        for treeprocessor in treeprocessors:
             newRoot = treeprocessor.run(root)
             if newRoot:
                 root = newRoot
@@ -410,12 +460,13 @@ class Markdown:
                 else:
                     # We have a serious problem
                     message(CRITICAL, 'Failed to strip top level tags.')
+        return output
 
-        # Run the text post-processors
+    def postprocess(self, output):
+        """ Run the text post-processors on serialized output. """
         for pp in self.postprocessors.values():
             output = pp.run(output)
-
-        return output.strip()
+        return output
 
     def convertFile(self, input=None, output=None, encoding=None):
         """Converts a markdown file and returns the HTML as a unicode string.
@@ -547,6 +598,31 @@ def load_extension(ext_name, configs = []):
         message(CRITICAL, "Failed to initiate extension '%s'" % ext_name)
 
 
+def fingerprint(extensions, configs, safe_mode, output_format):
+    """Return a string identifying what a Markdown instance outputs.
+
+    Two instances built with the same library version, extensions
+    (names, or instances of the same class with the same config),
+    configs, safe mode and output format render any text the same way;
+    the render cache keys outputs by this fingerprint.
+
+    """
+    names = []
+    for ext in extensions:
+        if isinstance(ext, basestring):
+            names.append(ext)
+        else:
+            # Most extensions keep a dict of [value, description] lists,
+            # some the list of settings they were given
+            config = getattr(ext, 'config', None)
+            if isinstance(config, dict):
+                config = sorted(config.items())
+            names.append(('%s.%s' % (ext.__class__.__module__,
+                                     ext.__class__.__name__), config))
+    return repr((version, names, sorted(configs.items()),
+                 safe_mode, output_format))
+
+
 def load_extensions(ext_names):
     """Loads multiple extensions"""
     extensions = []
@@ -562,13 +638,71 @@ EXPORTED FUNCTIONS
 =============================================================================
 
 Those are the two functions we really mean to export: markdown() and
-markdownFromFile().
+markdownFromFile(); get_converter() hands out reusable instances.
 """
 
+# Converters built by get_converter(), per thread
+_converters = threading.local()
+
+
+def get_converter(extensions = [],
+                  configs = {},
+                  safe_mode = False,
+                  output_format = DEFAULT_OUTPUT_FORMAT,
+                  cache = None,
+                  block_cache = None):
+    """Return a ready-to-use Markdown instance for the current thread.
+
+    Building an instance loads the extensions and rebuilds every
+    processor and pattern, which costs more than converting a short
+    text; get_converter() builds one instance per thread and set of
+    arguments, and resets it before handing it out again, so that
+
+        get_converter(extensions).convert(text)
+
+    is equivalent to markdown(text, extensions) but pays for the
+    construction once. Instances must not be shared between threads,
+    nor kept across calls.
+
+    Keyword arguments:
+
+    * extensions: A list of extension names (may contain config args)
+      or instances, as for the `Markdown` class.
+    * configs: A dictionary mapping extension names to config options.
+    * safe_mode, output_format, cache: As for markdown().
+    * block_cache: As for the `Markdown` class.
+
+    """
+    key = (tuple(extensions),
+           tuple(sorted([(name, tuple(map(tuple, value)))
+                         for name, value in configs.items()])),
+           safe_mode,
+           output_format,
+           id(cache),
+           id(block_cache))
+    try:
+        converters = _converters.instances
+    except AttributeError:
+        converters = _converters.instances = {}
+
+    md = converters.get(key)
+    if md is None:
+        md = converters[key] = Markdown(extensions=list(extensions),
+                                        extension_configs=dict(configs),
+                                        safe_mode=safe_mode,
+                                        output_format=output_format,
+                                        cache=cache,
+                                        block_cache=block_cache)
+    else:
+        md.reset()
+    return md
+
+
 def markdown(text,
              extensions = [],
              safe_mode = False,
-             output_format = DEFAULT_OUTPUT_FORMAT):
+             output_format = DEFAULT_OUTPUT_FORMAT,
+             cache = None):
     """Convert a markdown string to HTML and return HTML as a unicode string.
 
     This is a shortcut function for `Markdown` class to cover the most
@@ -588,13 +722,16 @@ def markdown(text,
         Note that it is suggested that the more specific formats ("xhtml1" 
         and "html4") be used as "xhtml" or "html" may change in the future
         if it makes sense at that time. 
+    * cache: A `markdown.cache.RenderCache`; the text is only converted
+      if its output is not found there.
 
     Returns: An HTML document as a string.
 
     """
     md = Markdown(extensions=load_extensions(extensions),
                   safe_mode=safe_mode, 
-                  output_format=output_format)
+                  output_format=output_format,
+                  cache=cache)
     return md.convert(text)
 
 
@@ -603,11 +740,13 @@ def markdownFromFile(input = None,
                      extensions = [],
                      encoding = None,
                      safe_mode = False,
-                     output_format = DEFAULT_OUTPUT_FORMAT):
+                     output_format = DEFAULT_OUTPUT_FORMAT,
+                     cache = None):
     """Read markdown code from a file and write it to a file or a stream."""
     md = Markdown(extensions=load_extensions(extensions), 
                   safe_mode=safe_mode,
-                  output_format=output_format)
+                  output_format=output_format,
+                  cache=cache)
     md.convertFile(input, output, encoding)
 
 
@@ -0,0 +1,357 @@
+"""
+Render Cache
+============
+
+Keeps the output of `Markdown.convert()` keyed by a hash of the source
+text and of everything else the output depends on: the library
+version, the extensions with their configs, the safe mode and the
+output format (see `Markdown.fingerprint`).
+
+A cache has a bounded in-memory LRU tier and, optionally, a second
+tier (a `DirectoryStore` or an `SQLiteStore`) which survives restarts
+and can be shared by several worker processes:
+
+    import markdown
+    from markdown.cache import RenderCache, SQLiteStore
+
+    cache = RenderCache(size=512, store=SQLiteStore('/tmp/markdown.db'))
+    html = markdown.markdown(text, ['codehilite'], cache=cache)
+
+Any `Markdown` instance built with `cache=...` goes through it, so
+`markdownFromFile()` and `get_converter()` accept the argument too.
+Lookups are counted per tier (see `RenderCache.stats()`).
+
+Stores given a `limit` evict their least recently used outputs as they
+fill up; `prune()` does it on demand, e.g. from a cron job.
+
+"""
+
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Stored outputs record their last use to the nearest TOUCH_INTERVAL
+# seconds, which saves a write on most hits
+TOUCH_INTERVAL = 3600
+
+
+class RenderCache:
+    """ A content-addressed cache of rendered Markdown. """
+
+    def __init__(self, size=512, store=None, salt=''):
+        """
+        Create a new cache.
+
+        Keyword arguments:
+
+        * size: Number of outputs kept in memory (0 disables the tier).
+        * store: Second tier, with `get(key)` and `set(key, html)`
+          methods, or None.
+        * salt: Anything else the output depends on (e.g. the version
+          of Pygments, when highlighting code); it is part of the keys.
+
+        """
+        self.size = size
+        self.store = store
+        self.salt = salt
+        self._lock = threading.Lock()
+        self.clear()
+
+    def key(self, source, fingerprint):
+        """ Return the key of `source` converted by a given pipeline. """
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        digest = hashlib.sha1('%s\0%s\0' % (fingerprint, self.salt))
+        digest.update(source)
+        return digest.hexdigest()
+
+    def convert(self, render, source, fingerprint):
+        """
+        Return the cached output of `render(source)`, calling it on a
+        miss; `fingerprint` identifies the pipeline doing the work.
+        """
+        key = self.key(source, fingerprint)
+        html = self.get(key)
+        if html is None:
+            html = render(source)
+            self.set(key, html)
+        return html
+
+    def get(self, key):
+        """ Return the output stored under `key`, or None. """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self.hits += 1
+                self._push(key, link[3])
+                return link[3]
+        finally:
+            self._lock.release()
+
+        html = None
+        if self.store is not None:
+            html = self.store.get(key)
+        self._lock.acquire()
+        try:
+            if html is None:
+                self.misses += 1
+            else:
+                self.store_hits += 1
+                self._push(key, html)
+        finally:
+            self._lock.release()
+        return html
+
+    def set(self, key, html):
+        """ Store `html` under `key` in every tier. """
+        self._lock.acquire()
+        try:
+            self._push(key, html)
+        finally:
+            self._lock.release()
+        if self.store is not None:
+            self.store.set(key, html)
+
+    def clear(self):
+        """ Empty the memory tier and reset the counters. """
+        self._lock.acquire()
+        try:
+            # A circular list of [previous, next, key, html] links, from
+            # the least to the most recently used; _root is the sentinel
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+            self._links = {}
+            self.hits = self.store_hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return the lookup counters and the size of the memory tier. """
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits,
+                    'store_hits': self.store_hits,
+                    'misses': self.misses,
+                    'size': len(self._links)}
+        finally:
+            self._lock.release()
+
+    def _push(self, key, html):
+        """ Make `key` the most recently used item (lock held). """
+        if self.size <= 0:
+            return
+        link = self._links.get(key)
+        if link is not None:
+            link[0][1] = link[1]
+            link[1][0] = link[0]
+        root = self._root
+        last = root[0]
+        link = [last, root, key, html]
+        last[1] = root[0] = self._links[key] = link
+        if len(self._links) > self.size:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+
+
+class DirectoryStore:
+    """
+    A second tier keeping each output in a file of a directory.
+
+    Files are written under a temporary name and renamed into place, so
+    concurrent processes never read a partial output. Errors count as
+    misses: the cache is never the reason a conversion fails.
+
+    The modification time of a file is its last use: with a `limit`,
+    the least recently used files beyond it are removed every
+    `limit / 10` writes (see `prune`).
+    """
+
+    def __init__(self, path, limit=None):
+        self.path = path
+        self.limit = limit
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                html = f.read().decode('utf-8')
+                used = os.fstat(f.fileno()).st_mtime
+            finally:
+                f.close()
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+        if time.time() - used > TOUCH_INTERVAL:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return html
+
+    def set(self, key, html):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        try:
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, temp = tempfile.mkstemp(dir=directory)
+            try:
+                os.write(fd, html.encode('utf-8'))
+            finally:
+                os.close(fd)
+            try:
+                os.rename(temp, path)
+            except OSError:
+                # Windows does not replace files; the other one will do
+                os.remove(temp)
+        except (IOError, OSError):
+            pass
+        self._writes += 1
+        if self.limit is not None and self._writes >= max(1, self.limit // 10):
+            self._writes = 0
+            self.prune()
+
+    def prune(self, limit=None):
+        """
+        Remove the least recently used outputs beyond `limit` (by
+        default the one the store was built with) and return how many
+        were removed.
+        """
+        if limit is None:
+            limit = self.limit
+        if limit is None:
+            return 0
+        files = []
+        try:
+            for directory in os.listdir(self.path):
+                directory = os.path.join(self.path, directory)
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    try:
+                        files.append((os.stat(path).st_mtime, path))
+                    except OSError:
+                        pass
+        except OSError:
+            return 0
+        files.sort(reverse=True)
+        removed = 0
+        for used, path in files[limit:]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+class SQLiteStore:
+    """
+    A second tier keeping the outputs in an SQLite database.
+
+    Every thread (and process) opens its own connection. Errors, e.g.
+    a database locked for longer than `timeout` seconds, count as
+    misses.
+
+    With a `limit`, the least recently used outputs beyond it are
+    deleted every `limit / 10` writes of the store (see `prune`).
+    """
+
+    def __init__(self, path, timeout=5.0, limit=None):
+        if sqlite3 is None:
+            raise ImportError('SQLiteStore needs the sqlite3 module')
+        self.path = path
+        self.timeout = timeout
+        self.limit = limit
+        self._writes = 0
+        self._local = threading.local()
+
+    def _connection(self):
+        # Connections do not survive a fork: a child opens its own
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('CREATE TABLE IF NOT EXISTS render '
+                         '(key TEXT PRIMARY KEY, html TEXT NOT NULL, '
+                         'used INTEGER NOT NULL DEFAULT 0)')
+            try:
+                # Stores created before outputs recorded their last use
+                conn.execute('ALTER TABLE render ADD COLUMN '
+                             'used INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError:
+                pass
+            conn.commit()
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def get(self, key):
+        try:
+            conn = self._connection()
+            row = conn.execute('SELECT html, used FROM render WHERE key = ?',
+                               (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        now = int(time.time())
+        if now - row[1] > TOUCH_INTERVAL:
+            try:
+                conn.execute('UPDATE render SET used = ? WHERE key = ?',
+                             (now, key))
+                conn.commit()
+            except sqlite3.Error:
+                pass
+        return row[0]
+
+    def set(self, key, html):
+        try:
+            conn = self._connection()
+            conn.execute('INSERT OR REPLACE INTO render (key, html, used) '
+                         'VALUES (?, ?, ?)', (key, html, int(time.time())))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+        self._writes += 1
+        if self.limit is not None and self._writes >= max(1, self.limit // 10):
+            self._writes = 0
+            self.prune()
+
+    def prune(self, limit=None):
+        """
+        Delete the least recently used outputs beyond `limit` (by
+        default the one the store was built with) and return how many
+        were deleted.
+        """
+        if limit is None:
+            limit = self.limit
+        if limit is None:
+            return 0
+        try:
+            conn = self._connection()
+            # Ties go to the latest writes, which have the highest rowids
+            cursor = conn.execute('DELETE FROM render WHERE key IN '
+                                  '(SELECT key FROM render '
+                                  'ORDER BY used DESC, rowid DESC '
+                                  'LIMIT -1 OFFSET ?)', (limit,))
+            conn.commit()
+        except sqlite3.Error:
+            return 0
+        return cursor.rowcount
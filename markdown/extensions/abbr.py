@@ -34,7 +34,15 @@ class AbbrExtension(markdown.Extension):
 
     def extendMarkdown(self, md, md_globals):
         """ Insert AbbrPreprocessor before ReferencePreprocessor. """
+        md.registerExtension(self)
+        self.markdown = md
         md.preprocessors.add('abbr', AbbrPreprocessor(md), '<reference')
+
+    def reset(self):
+        """ Remove the abbreviations of the previous document. """
+        for name in self.markdown.inlinePatterns.keys():
+            if name.startswith('abbr-'):
+                del self.markdown.inlinePatterns[name]
         
            
 class AbbrPreprocessor(markdown.preprocessors.Preprocessor):
@@ -0,0 +1,223 @@
+"""
+Incremental Rendering
+=====================
+
+Converts a document chunk by chunk, keeping the output of every chunk
+in a `RenderCache`, so that after an edit only the chunks which changed
+go through the block parser and the tree-processors again:
+
+    import markdown
+    from markdown.cache import RenderCache
+
+    md = markdown.Markdown(['codehilite'], block_cache=RenderCache(4096))
+    html = md.convert(text)
+
+The preprocessors still run on the whole document, as they collect the
+references, abbreviations and footnotes. The preprocessed text is then
+cut into chunks of blocks, each one starting with a block that no block
+processor attaches to the previous ones (see `isChunkStart`). A chunk
+is parsed, tree-processed and post-processed on its own, and its output
+is keyed by its text and by the document state it uses (see
+`dependencies`):
+
+* the raw HTML stashed for the placeholders it contains;
+* the references and abbreviations it mentions;
+* the numbers of the footnotes it refers to.
+
+The list of footnotes is rendered as a last chunk. The outputs are
+joined the way the top-level elements of a whole document are
+serialized, so the result is the same as without the block cache.
+
+Pipelines with a processor not known to work block by block (e.g. the
+header ids of "headerid" and "toc" depend on the whole document) are
+converted as a whole; see `isLocal`.
+
+"""
+
+import re
+import markdown
+
+# Processors which only depend on the block or the tree they are given
+# and on the state checked by `dependencies`, by qualified class name
+LOCAL_PREPROCESSORS = set([
+    'markdown.preprocessors.HtmlBlockPreprocessor',
+    'markdown.preprocessors.ReferencePreprocessor',
+    'markdown.extensions.abbr.AbbrPreprocessor',
+    'markdown.extensions.fenced_code.FencedBlockPreprocessor',
+    'markdown.extensions.footnotes.FootnotePreprocessor'])
+LOCAL_BLOCKPROCESSORS = set([
+    'markdown.blockprocessors.EmptyBlockProcessor',
+    'markdown.blockprocessors.ListIndentProcessor',
+    'markdown.blockprocessors.CodeBlockProcessor',
+    'markdown.blockprocessors.HashHeaderProcessor',
+    'markdown.blockprocessors.SetextHeaderProcessor',
+    'markdown.blockprocessors.HRProcessor',
+    'markdown.blockprocessors.OListProcessor',
+    'markdown.blockprocessors.UListProcessor',
+    'markdown.blockprocessors.BlockQuoteProcessor',
+    'markdown.blockprocessors.ParagraphProcessor',
+    'markdown.extensions.tables.TableProcessor'])
+LOCAL_TREEPROCESSORS = set([
+    'markdown.treeprocessors.InlineProcessor',
+    'markdown.treeprocessors.PrettifyTreeprocessor',
+    'markdown.extensions.codehilite.HiliteTreeprocessor',
+    'markdown.extensions.footnotes.FootnoteTreeprocessor'])
+LOCAL_POSTPROCESSORS = set([
+    'markdown.postprocessors.RawHtmlPostprocessor',
+    'markdown.postprocessors.AndSubstitutePostprocessor',
+    'markdown.extensions.footnotes.FootnotePostprocessor'])
+
+# Indented blocks, lists and blockquotes may continue a previous element
+CHUNK_START_RE = re.compile(r'[^\s\d*+>-]')
+PLACEHOLDER_RE = re.compile(re.escape(
+    markdown.preprocessors.HTML_PLACEHOLDER_PREFIX) + r'(\d+)')
+
+
+def _className(instance):
+    return '%s.%s' % (instance.__class__.__module__,
+                      instance.__class__.__name__)
+
+
+def _footnotes(md):
+    """ Return the footnote extension registered with `md`, or None. """
+    if 'footnote' in md.treeprocessors:
+        return md.treeprocessors['footnote'].footnotes
+    return None
+
+
+def isLocal(md, source):
+    """
+    Return whether `md` converts `source` the same way chunk by chunk.
+
+    Every processor of `md` must be a known one, and the footnotes must
+    go to the end of the document rather than to a marker.
+
+    """
+    if not md.stripTopLevelTags:
+        return False
+    for processors, local in ((md.preprocessors, LOCAL_PREPROCESSORS),
+                              (md.parser.blockprocessors, LOCAL_BLOCKPROCESSORS),
+                              (md.treeprocessors, LOCAL_TREEPROCESSORS),
+                              (md.postprocessors, LOCAL_POSTPROCESSORS)):
+        for processor in processors.values():
+            if _className(processor) not in local:
+                return False
+    footnotes = _footnotes(md)
+    if footnotes is not None and \
+            footnotes.getConfig("PLACE_MARKER") in source:
+        return False
+    return True
+
+
+def isChunkStart(block):
+    """
+    Return whether `block` is parsed the same way after any other block.
+
+    Block processors attach indented blocks, list items and blockquotes
+    to the previous element; anything else starts a new one (which is
+    never empty, so it is also what the next blocks get attached to).
+
+    """
+    return bool(CHUNK_START_RE.match(block))
+
+
+def splitChunks(text):
+    """ Split preprocessed text into chunks of blocks, as a list of strings. """
+    chunks = []
+    for block in text.split('\n\n'):
+        if chunks and not isChunkStart(block):
+            chunks[-1].append(block)
+        else:
+            chunks.append([block])
+    return ['\n\n'.join(blocks) for blocks in chunks]
+
+
+def dependencies(md, text):
+    """
+    Return the document state the output of `text` depends on.
+
+    Keyword arguments:
+
+    * md: The Markdown instance, after the preprocessors ran.
+    * text: Markdown text, from the preprocessed document.
+
+    The returned list holds the stashed HTML of the placeholders in
+    `text`, and the references, abbreviations and footnote numbers
+    whose ids appear in it (or might appear: any superset will do).
+
+    """
+    stash = md.htmlStash.rawHtmlBlocks
+    result = [stash[int(i)] for i in PLACEHOLDER_RE.findall(text)]
+
+    if md.references:
+        lowered = text.lower()
+        result.append(sorted([(id, reference)
+                              for id, reference in md.references.items()
+                              if id in lowered]))
+
+    for name, pattern in md.inlinePatterns.items():
+        if name.startswith('abbr-') and name[5:] in text:
+            result.append((name, pattern.title))
+
+    footnotes = _footnotes(md)
+    if footnotes is not None and '[^' in text:
+        result.append([(id, footnotes.footnotes.index(id))
+                       for id in footnotes.footnotes.keys()
+                       if '[^%s]' % id in text])
+        # The ids have a prefix with UNIQUE_IDS
+        result.append(footnotes.makeFootnoteId(''))
+    return result
+
+
+def renderChunk(md, root, treeprocessors):
+    """
+    Return the output of a parsed chunk, followed by a newline, or an
+    empty string if it has no elements.
+    """
+    if not len(root):
+        return u""
+    return md.postprocess(md.render(root, treeprocessors)) + "\n"
+
+
+def convert(md, source, cache):
+    """
+    Convert `source` like `md.convert()`, rendering only the chunks
+    missing from `cache`; `isLocal(md, source)` must be true.
+    """
+    md.lines = md.preprocess(source)
+    if md.lines is None:
+        return u""
+
+    fingerprint = 'blocks %s' % md.fingerprint
+    footnotes = _footnotes(md)
+    treeprocessors = [treeprocessor
+                      for name, treeprocessor in md.treeprocessors.items()
+                      if name != 'footnote']
+    output = []
+    for text in splitChunks('\n'.join(md.lines)):
+        key = cache.key(repr((text, dependencies(md, text))), fingerprint)
+        html = cache.get(key)
+        if html is None:
+            root = markdown.etree.Element(markdown.DOC_TAG)
+            md.parser.parseChunk(root, text)
+            html = renderChunk(md, root, treeprocessors)
+            cache.set(key, html)
+        output.append(html)
+
+    if footnotes is not None and footnotes.footnotes:
+        # The footnotes are appended after the tree-processors before
+        # "footnote" ran, so they only go through the next ones
+        text = '\n\n'.join(footnotes.footnotes.values())
+        key = cache.key(repr((footnotes.footnotes.items(),
+                              footnotes.makeFootnoteId(''),
+                              dependencies(md, text))), fingerprint)
+        html = cache.get(key)
+        if html is None:
+            root = markdown.etree.Element(markdown.DOC_TAG)
+            root.append(footnotes.makeFootnotesDiv(root))
+            after = md.treeprocessors.index('footnote') + 1
+            html = renderChunk(md, root, md.treeprocessors.values()[after:])
+            cache.set(key, html)
+        output.append(html)
+
+    return u"".join(output).strip()
@@ -1,9 +1,16 @@
 class OrderedDict(dict):
     """
     A dictionary that keeps its keys in the order in which they're inserted.
-    
+
     Copied from Django's SortedDict with some modifications.
 
+    The position of every key and the list of values are cached, so that
+    `index`, `index_for_location` (hence `add` and `link`) and
+    `value_for_index` do not search `keyOrder` once the order settles;
+    the caches are dropped by every method changing the order or the
+    values, and appending keeps the positions. `keyOrder` may be
+    replaced, but must not be changed in place.
+
     """
     def __new__(cls, *args, **kwargs):
         instance = super(OrderedDict, cls).__new__(cls, *args, **kwargs)
@@ -17,10 +24,34 @@ class OrderedDict(dict):
         if isinstance(data, dict):
             self.keyOrder = data.keys()
         else:
-            self.keyOrder = []
+            keyOrder = []
+            seen = {}
             for key, value in data:
-                if key not in self.keyOrder:
-                    self.keyOrder.append(key)
+                if key not in seen:
+                    seen[key] = True
+                    keyOrder.append(key)
+            self.keyOrder = keyOrder
+
+    def _getKeyOrder(self):
+        return self._keyOrder
+
+    def _setKeyOrder(self, keyOrder):
+        self._keyOrder = keyOrder
+        self._positions = None
+        self._searches = 0
+        self._values = None
+
+    keyOrder = property(_getKeyOrder, _setKeyOrder)
+
+    # Lookups searching keyOrder before the positions are mapped
+    searchesBeforeMapping = 4
+
+    def _changed(self, order=True):
+        """Drop the cached values and, if order is true, positions."""
+        self._values = None
+        if order:
+            self._positions = None
+            self._searches = 0
 
     def __deepcopy__(self, memo):
         from copy import deepcopy
@@ -28,50 +59,55 @@ class OrderedDict(dict):
                                for key, value in self.iteritems()])
 
     def __setitem__(self, key, value):
+        if not super(OrderedDict, self).__contains__(key):
+            if self._positions is not None:
+                self._positions[key] = len(self._keyOrder)
+            self._keyOrder.append(key)
         super(OrderedDict, self).__setitem__(key, value)
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
+        self._values = None
 
     def __delitem__(self, key):
         super(OrderedDict, self).__delitem__(key)
-        self.keyOrder.remove(key)
+        del self._keyOrder[self.index(key)]
+        self._changed()
 
     def __iter__(self):
-        for k in self.keyOrder:
+        for k in self._keyOrder:
             yield k
 
     def pop(self, k, *args):
+        had = super(OrderedDict, self).__contains__(k)
         result = super(OrderedDict, self).pop(k, *args)
-        try:
-            self.keyOrder.remove(k)
-        except ValueError:
-            # Key wasn't in the dictionary in the first place. No problem.
-            pass
+        # Key wasn't in the dictionary in the first place. No problem.
+        if had:
+            del self._keyOrder[self.index(k)]
+            self._changed()
         return result
 
     def popitem(self):
         result = super(OrderedDict, self).popitem()
-        self.keyOrder.remove(result[0])
+        del self._keyOrder[self.index(result[0])]
+        self._changed()
         return result
 
     def items(self):
-        return zip(self.keyOrder, self.values())
+        return zip(self._keyOrder, self.values())
 
     def iteritems(self):
-        for key in self.keyOrder:
+        for key in self._keyOrder:
             yield key, super(OrderedDict, self).__getitem__(key)
 
     def keys(self):
-        return self.keyOrder[:]
+        return self._keyOrder[:]
 
     def iterkeys(self):
-        return iter(self.keyOrder)
+        return iter(self._keyOrder)
 
     def values(self):
-        return [super(OrderedDict, self).__getitem__(k) for k in self.keyOrder]
+        return self._valueList()[:]
 
     def itervalues(self):
-        for key in self.keyOrder:
+        for key in self._keyOrder:
             yield super(OrderedDict, self).__getitem__(key)
 
     def update(self, dict_):
@@ -79,29 +115,40 @@ class OrderedDict(dict):
             self.__setitem__(k, v)
 
     def setdefault(self, key, default):
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
-        return super(OrderedDict, self).setdefault(key, default)
+        if not super(OrderedDict, self).__contains__(key):
+            self.__setitem__(key, default)
+        return super(OrderedDict, self).__getitem__(key)
+
+    def _valueList(self):
+        """Return the cached list of the values, in order."""
+        if self._values is None:
+            getitem = super(OrderedDict, self).__getitem__
+            self._values = [getitem(k) for k in self._keyOrder]
+        return self._values
 
     def value_for_index(self, index):
         """Return the value of the item at the given zero-based index."""
-        return self[self.keyOrder[index]]
+        values = self._values
+        if values is None:
+            values = self._valueList()
+        return values[index]
 
     def insert(self, index, key, value):
         """Insert the key, value pair before the item with the given index."""
-        if key in self.keyOrder:
-            n = self.keyOrder.index(key)
-            del self.keyOrder[n]
+        if super(OrderedDict, self).__contains__(key):
+            n = self.index(key)
+            del self._keyOrder[n]
             if n < index:
                 index -= 1
-        self.keyOrder.insert(index, key)
+        self._keyOrder.insert(index, key)
         super(OrderedDict, self).__setitem__(key, value)
+        self._changed()
 
     def copy(self):
         """Return a copy of this object."""
         # This way of initializing the copy means it works for subclasses, too.
         obj = self.__class__(self)
-        obj.keyOrder = self.keyOrder[:]
+        obj.keyOrder = self._keyOrder[:]
         return obj
 
     def __repr__(self):
@@ -117,7 +164,18 @@ class OrderedDict(dict):
 
     def index(self, key):
         """ Return the index of a given key. """
-        return self.keyOrder.index(key)
+        if self._positions is None:
+            # Between changes (e.g. a series of `add` calls), searching
+            # costs less than mapping every key
+            if self._searches < self.searchesBeforeMapping:
+                self._searches += 1
+                return self._keyOrder.index(key)
+            self._positions = dict(zip(self._keyOrder,
+                                       range(len(self._keyOrder))))
+        try:
+            return self._positions[key]
+        except KeyError:
+            raise ValueError('%r is not in list' % (key,))
 
     def index_for_location(self, location):
         """ Return index or None for a given location. """
@@ -148,15 +206,18 @@ class OrderedDict(dict):
 
     def link(self, key, location):
         """ Change location of an existing item. """
-        n = self.keyOrder.index(key)
-        del self.keyOrder[n]
-        i = self.index_for_location(location)
+        n = self.index(key)
+        del self._keyOrder[n]
+        self._changed()
         try:
+            i = self.index_for_location(location)
             if i is not None:
-                self.keyOrder.insert(i, key)
+                self._keyOrder.insert(i, key)
             else:
-                self.keyOrder.append(key)
-        except Error:
+                self._keyOrder.append(key)
+        except:
             # restore to prevent data loss and reraise
-            self.keyOrder.insert(n, key)
-            raise Error
+            self._keyOrder.insert(n, key)
+            self._changed()
+            raise
+        self._changed()
@@ -1,10 +1,46 @@
 import markdown
 import re
+import sre_parse
+import sre_constants
 
 def isString(s):
     """ Check if it's string """
     return isinstance(s, unicode) or isinstance(s, str)
 
+# Search expressions of the inline patterns, by pattern and flags
+_searches = {}
+
+def getSearchRegExp(compiled):
+    """
+    Return a regular expression finding the leftmost match of an inline
+    pattern, numbering its groups as the compiled regular expression
+    does, or None if the pattern was not compiled the way
+    `markdown.inlinepatterns.Pattern` does. The first group holds the
+    match rather than the text before it, and the last one (the text
+    after it) is left out.
+
+    """
+    key = (compiled.pattern, compiled.flags)
+    try:
+        return _searches[key]
+    except KeyError:
+        pass
+    search = None
+    prefix, suffix = "^(.*?)", "(.*?)$"
+    source = compiled.pattern
+    if isString(source) and source.startswith(prefix) \
+            and source.endswith(suffix):
+        # An alternation at the top would take the wrapping apart
+        tree = sre_parse.parse(source, compiled.flags)
+        if tree.data[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+            # Grouping the whole match keeps back-references numbered
+            search = re.compile("(%s)" % source[len(prefix):-len(suffix)],
+                                compiled.flags)
+            if search.groups != compiled.groups - 1:
+                search = None
+    _searches[key] = search
+    return search
+
 class Processor:
     def __init__(self, markdown_instance=None):
         if markdown_instance:
@@ -34,8 +70,17 @@ class Treeprocessor(Processor):
 class InlineProcessor(Treeprocessor):
     """
     A Treeprocessor that traverses a tree, applying inline patterns.
+
+    Patterns compiled the way `markdown.inlinepatterns.Pattern` does are
+    looked for with `search()` and a regular expression holding the same
+    groups, instead of matching "^(.*?)" against a copy of the rest of
+    the text: the regular expression engine skips to the candidates, and
+    a text which does not contain a pattern costs a single scan. Set
+    `searchPatterns` to False to match every pattern the original way.
     """
 
+    searchPatterns = True
+
     def __init__ (self, md):
         self.__placeholder_prefix = markdown.INLINE_PLACEHOLDER_PREFIX
         self.__placeholder_suffix = markdown.ETX
@@ -195,6 +240,40 @@ class InlineProcessor(Treeprocessor):
 
         return result
 
+    def __matchPattern(self, pattern, data, startIndex):
+        """
+        Find the leftmost match of a pattern in data[startIndex:].
+
+        Returns: the match (or None), the text before and after it, and
+        the index in data where the text after it starts.
+
+        """
+        compiled = pattern.getCompiledRegExp()
+        search = self.searchPatterns and getSearchRegExp(compiled)
+        if not search:
+            match = compiled.match(data[startIndex:])
+            if not match:
+                return None, None, None, None
+            last = len(match.groups())
+            return (match, data[:startIndex] + match.group(1),
+                    match.group(last), startIndex + match.start(last))
+
+        # Look-behind assertions must not see what precedes startIndex
+        if startIndex:
+            text = data[startIndex:]
+        else:
+            text = data
+        match = search.search(text)
+        if not match:
+            return None, None, None, None
+        # The compiled expression ends with "(.*?)$", which leaves out
+        # a newline ending the text
+        rest = text[match.end():]
+        if rest.endswith("\n"):
+            rest = rest[:-1]
+        return (match, data[:startIndex + match.start()],
+                rest, startIndex + match.end())
+
     def __applyPattern(self, pattern, data, patternIndex, startIndex=0):
         """
         Check if the line fits the pattern, create the necessary
@@ -210,8 +289,8 @@ class InlineProcessor(Treeprocessor):
         Returns: String with placeholders instead of ElementTree elements.
 
         """
-        match = pattern.getCompiledRegExp().match(data[startIndex:])
-        leftData = data[:startIndex]
+        match, leftData, rightData, rightIndex = \
+            self.__matchPattern(pattern, data, startIndex)
 
         if not match:
             return data, False, 0
@@ -219,7 +298,7 @@ class InlineProcessor(Treeprocessor):
         node = pattern.handleMatch(match)
 
         if node is None:
-            return data, True, len(leftData) + match.span(len(match.groups()))[0]
+            return data, True, rightIndex
 
         if not isString(node):
             if not isinstance(node.text, markdown.AtomicString):
@@ -235,9 +314,7 @@ class InlineProcessor(Treeprocessor):
 
         placeholder = self.__stashNode(node, pattern.type())
 
-        return "%s%s%s%s" % (leftData,
-                             match.group(1),
-                             placeholder, match.groups()[-1]), True, 0
+        return "%s%s%s" % (leftData, placeholder, rightData), True, 0
 
     def run(self, tree):
         """Apply inline patterns to a parsed Markdown tree.
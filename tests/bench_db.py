@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+
+    DB Benchmark
+    ~~~~~~~~~~~~
+
+    Times get_entry, the tag listing and the search queries on a
+    large sqlite database, before and after the schema migrations
+    (searching falls back to LIKE before them):
+
+        python tests/bench_db.py [entries]
+
+    :copyright: © 2010 by Gianluca Bargelli.
+    :license: MIT, see LICENSE for more details.
+
+
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import datetime
+from flask import g
+from blog import app, data_layer
+
+ENTRIES = 100000
+TAGS = 200
+TAGS_PER_ENTRY = 3
+PAGE_ENTRIES = 10
+REPEAT = 200
+BODY_WORDS = 150
+VOCABULARY = 5000
+
+
+def build_database(path, entries=ENTRIES, tags=TAGS, seed=0):
+    """
+    Creates a version 0 database (schema.sql, no migrations) with
+    *entries* entries spread over the last ten years, each one tagged
+    with TAGS_PER_ENTRY of *tags* tags; the tags follow a skewed
+    distribution, so listings range from a few to many thousand entries.
+    Bodies are BODY_WORDS words long, drawn with a similarly skewed
+    distribution from words named word0 (the most common) to
+    word<VOCABULARY-1>.
+    Returns the (slug, creation_date) pairs of the entries.
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(app.open_resource('schema/schema.sql').read())
+    conn.execute("INSERT INTO user VALUES (1, 'bench', 'bench', 0)")
+    conn.executemany('INSERT INTO tag VALUES (?, ?)',
+                     [(i + 1, 'tag%d' % i) for i in range(tags)])
+
+    today = datetime.date.today()
+    keys = []
+    rows = []
+    links = []
+    for i in range(entries):
+        slug = 'entry-number-%d' % i
+        date = today - datetime.timedelta(days=rnd.randint(0, 3650))
+        keys.append((slug, date.isoformat()))
+        body = ' '.join(['word%d' % (int(rnd.paretovariate(0.8)) % VOCABULARY)
+                         for j in range(BODY_WORDS)])
+        rows.append((i + 1, slug, 'Entry number %d' % i, body,
+                     date.isoformat(), date.isoformat(), 1))
+        chosen = set()
+        while len(chosen) < TAGS_PER_ENTRY:
+            chosen.add(int(rnd.paretovariate(1.2)) % tags + 1)
+        links.extend([(i + 1, tag) for tag in chosen])
+
+    conn.executemany('INSERT INTO entry VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.executemany('INSERT INTO entry_tags VALUES (?, ?)', links)
+    conn.commit()
+    conn.close()
+    return keys
+
+
+def timeit(conn, query, args_list, repeat=REPEAT):
+    """Returns the mean time in ms of query over args_list."""
+    start = time.time()
+    for i in range(repeat):
+        conn.execute(query, args_list[i % len(args_list)]).fetchall()
+    return (time.time() - start) * 1000.0 / repeat
+
+
+def run(conn, keys, migrated=False):
+    """Times the queries of get_entry, of the tag listing and of search."""
+    rnd = random.Random(1)
+    sample = rnd.sample(keys, 50)
+    results = []
+
+    results.append(('get_entry', timeit(conn,
+    """
+    SELECT * FROM Entry
+    WHERE slug = ?
+    AND creation_date = ?
+    """, sample)))
+
+    tag_page = """
+    SELECT entry.* FROM entry
+    JOIN entry_tags ON entry.id = entry_tags.id_entry_FK
+    JOIN tag ON entry_tags.id_tag_FK = tag.id
+    WHERE tag.name = ?
+    ORDER BY entry.creation_date DESC, entry.id DESC
+    LIMIT ? OFFSET ?
+    """
+    for name, tag in (('popular', 'tag1'), ('rare', 'tag150')):
+        results.append(('tag listing (%s, page 1)' % name,
+                        timeit(conn, tag_page, [(tag, PAGE_ENTRIES, 0)],
+                               REPEAT // 10)))
+        results.append(('tag listing (%s, page 50)' % name,
+                        timeit(conn, tag_page,
+                               [(tag, PAGE_ENTRIES, 49 * PAGE_ENTRIES)],
+                               REPEAT // 10)))
+
+    results.append(('tag lookup (process_tags)', timeit(conn,
+    """
+    SELECT id FROM tag
+    WHERE tag.name = ?
+    """, [('tag%d' % i,) for i in range(TAGS)])))
+
+    for name, words in (('rare word', 'word4000'),
+                        ('common word', 'word1'),
+                        ('two words', 'word3 word40')):
+        if migrated:
+            with app.test_request_context():
+                g.db = conn
+                start = time.time()
+                for i in range(REPEAT // 10):
+                    data_layer.search_entries(words, 0)
+                elapsed = (time.time() - start) * 1000.0 / (REPEAT // 10)
+        else:
+            like = ' AND '.join(['body LIKE ?'] * len(words.split()))
+            elapsed = timeit(conn,
+                             'SELECT * FROM entry WHERE %s \
+                              ORDER BY creation_date DESC LIMIT ?' % like,
+                             [['%% %s %%' % word for word in words.split()] +
+                              [PAGE_ENTRIES]], REPEAT // 10)
+        results.append(('search (%s)' % name, elapsed))
+    return results
+
+
+def main(entries=ENTRIES):
+    fd, path = tempfile.mkstemp()
+    try:
+        print 'Building a database with %d entries...' % entries
+        keys = build_database(path, entries)
+        conn = sqlite3.connect(path)
+
+        before = run(conn, keys)
+        applied = data_layer.migrate(conn)
+        conn.execute('ANALYZE')
+        after = run(conn, keys, migrated=True)
+        conn.close()
+
+        print 'Applied migrations: %s' % ', '.join(['%04d' % v for v in applied])
+        print
+        print '%-32s %12s %12s %9s' % ('query', 'before (ms)', 'after (ms)',
+                                       'speedup')
+        for (name, old), (_, new) in zip(before, after):
+            print '%-32s %12.3f %12.3f %8.1fx' % (name, old, new,
+                                                 old / max(new, 1e-6))
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+    Incremental Markdown Benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Times saving a long post again after fixing a typo in one of its
+    paragraphs, converted as a whole and with a block cache (see
+    markdown.incremental), and checks that both produce the same HTML:
+
+        python tests/bench_incremental.py [paragraphs] [words]
+
+    :copyright: © 2010 by Gianluca Bargelli.
+    :license: MIT, see LICENSE for more details.
+
+
+"""
+
+import sys
+import time
+import markdown
+from markdown.cache import RenderCache
+from bench_markdown import make_document
+
+PARAGRAPHS = 100
+WORDS = 100
+REPEAT = 5
+EXTENSIONS = [[], ['codehilite'], ['codehilite', 'footnotes', 'abbr']]
+
+CODE = '''    :::python
+    def entry(slug):
+        """Returns the entry with the given slug."""
+        return Entry.all().filter('slug =', slug).get()'''
+
+
+def make_post(paragraphs=PARAGRAPHS, words=WORDS):
+    """
+    Returns a post of *paragraphs* paragraphs of about *words* words,
+    with a code block and a footnote every ten paragraphs, and its
+    abbreviations.
+    """
+    blocks = make_document(paragraphs, words).split('\n\n')
+    for i in range(paragraphs - 1, 0, -10):
+        blocks[i] += ' HTML[^%d]' % i
+        blocks.insert(i + 1, CODE)
+        blocks.append('[^%d]: A note on paragraph %d.' % (i, i))
+    blocks.append('*[HTML]: HyperText Markup Language')
+    return '\n\n'.join(blocks)
+
+
+def best(f, repeat=REPEAT):
+    """Returns the best time of f(i) for i in range(repeat), in milliseconds."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f(i)
+        times.append(time.time() - start)
+    return min(times) * 1000.0
+
+
+def main(paragraphs=PARAGRAPHS, words=WORDS):
+    text = make_post(paragraphs, words)
+    # Typos in the middle of the post, a different one for every save
+    position = text.index('word', len(text) // 2)
+    edit = lambda i: text[:position] + 'wrod%d' % i + text[position + 4:]
+    print 'Saving %d paragraphs of %d words (%d characters) after an edit' \
+          % (paragraphs, words, len(text))
+    print
+    print '%-24s %10s %10s %10s %9s' % ('extensions', 'full (ms)', 'cold (ms)',
+                                        'edit (ms)', 'speedup')
+    for extensions in EXTENSIONS:
+        cache = RenderCache(size=4096)
+        full = markdown.Markdown(extensions=extensions)
+        incremental = markdown.Markdown(extensions=extensions,
+                                        block_cache=cache)
+
+        def convert(md, text):
+            md.reset()
+            return md.convert(text)
+
+        def cold(i):
+            cache.clear()
+            convert(incremental, text)
+
+        whole = best(lambda i: convert(full, edit(i)))
+        first = best(cold)
+        # The post before the typo fixes is in the cache
+        again = best(lambda i: convert(incremental, edit(i)))
+        if convert(full, edit(REPEAT)) != convert(incremental, edit(REPEAT)):
+            raise AssertionError('Different HTML with %r' % extensions)
+        print '%-24s %10.1f %10.1f %10.1f %8.1fx' % (
+            ', '.join(extensions) or 'none', whole, first, again,
+            whole / max(again, 1e-6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+
+    Markdown Benchmark
+    ~~~~~~~~~~~~~~~~~~
+
+    Times the conversion of long, link-dense paragraphs with the inline
+    patterns matched the original way and searched for (see
+    markdown.treeprocessors.InlineProcessor), and checks that both
+    produce the same HTML:
+
+        python tests/bench_markdown.py [paragraphs] [words]
+
+    :copyright: © 2010 by Gianluca Bargelli.
+    :license: MIT, see LICENSE for more details.
+
+
+"""
+
+import sys
+import time
+import random
+import markdown
+from markdown.treeprocessors import InlineProcessor
+
+PARAGRAPHS = 20
+WORDS = 400
+REPEAT = 5
+EXTENSIONS = [[], ['codehilite'], ['extra']]
+
+
+def make_document(paragraphs=PARAGRAPHS, words=WORDS, seed=0):
+    """
+    Returns a document of *paragraphs* paragraphs of about *words*
+    words, one in five of them being a link (inline, reference or
+    automatic), emphasized, code or inline HTML.
+    """
+    rnd = random.Random(seed)
+    markup = [lambda i: '[link %d](http://example.com/%d "Title %d")' % (i, i, i),
+              lambda i: '[reference %d][%d]' % (i, i % 10),
+              lambda i: '<http://example.com/auto/%d>' % i,
+              lambda i: '*emphasis %d*' % i,
+              lambda i: '**strong %d**' % i,
+              lambda i: '`code(%d)`' % i,
+              lambda i: '<span>html %d</span>' % i,
+              lambda i: 'AT&amp;T %d' % i]
+    blocks = []
+    for p in range(paragraphs):
+        text = []
+        for i in range(words):
+            if rnd.random() < 0.2:
+                text.append(rnd.choice(markup)(i))
+            else:
+                text.append('word%d' % rnd.randint(0, 999))
+        blocks.append(' '.join(text))
+    blocks.extend(['[%d]: http://example.com/reference/%d' % (i, i)
+                   for i in range(10)])
+    return '\n\n'.join(blocks)
+
+
+def timeit(text, extensions, search, repeat=REPEAT):
+    """
+    Returns the best time of *repeat* conversions of text, in
+    milliseconds, and the HTML.
+    """
+    InlineProcessor.searchPatterns = search
+    try:
+        best = None
+        for i in range(repeat):
+            md = markdown.Markdown(extensions=extensions)
+            start = time.time()
+            html = md.convert(text)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        InlineProcessor.searchPatterns = True
+    return best * 1000.0, html
+
+
+def main(paragraphs=PARAGRAPHS, words=WORDS):
+    text = make_document(paragraphs, words)
+    print 'Converting %d paragraphs of %d words (%d characters)' \
+          % (paragraphs, words, len(text))
+    print
+    print '%-24s %12s %12s %9s' % ('extensions', 'match (ms)', 'search (ms)',
+                                   'speedup')
+    for extensions in EXTENSIONS:
+        old, old_html = timeit(text, extensions, False)
+        new, new_html = timeit(text, extensions, True)
+        if old_html != new_html:
+            raise AssertionError('Different HTML with %r' % extensions)
+        print '%-24s %12.1f %12.1f %8.1fx' % (', '.join(extensions) or 'none',
+                                             old, new, old / max(new, 1e-6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
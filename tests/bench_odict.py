@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+
+    OrderedDict Benchmark
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmarks of markdown.odict.OrderedDict, whose instances
+    hold the processors and patterns of every Markdown instance, on
+    setups with many extensions or many registered items (one inline
+    pattern per abbreviation, one item per footnote):
+
+        python tests/bench_odict.py [items]
+
+    :copyright: © 2010 by Gianluca Bargelli.
+    :license: MIT, see LICENSE for more details.
+
+
+"""
+
+import sys
+import time
+import markdown
+from markdown.odict import OrderedDict
+
+ITEMS = 500
+REPEAT = 15
+EXTENSIONS = ['extra', 'toc', 'codehilite', 'wikilinks', 'headerid', 'meta']
+
+
+def best(f, repeat=REPEAT):
+    """Returns the best time of *repeat* calls of f, in milliseconds."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times) * 1000.0
+
+
+def registry(items):
+    """
+    Registers *items* items the way extensions do, each one before or
+    after an earlier one, then moves some of them.
+    """
+    d = OrderedDict()
+    d['first'] = 0
+    d.add('item0', 0, '_begin')
+    for i in range(1, items):
+        d.add('item%d' % i, i, i % 2 and '<first' or '>item%d' % (i // 2))
+    for i in range(0, items, 10):
+        d.link('item%d' % i, '_end')
+    return d
+
+
+def walk(d, rounds=20):
+    """Reads every value by index, as the inline processor does."""
+    for j in range(rounds):
+        for i in range(len(d)):
+            d.value_for_index(i)
+
+
+def lookup(d):
+    """Looks up the position of every key, as the footnotes do."""
+    for key in d.keys():
+        d.index(key)
+
+
+def abbreviations(items):
+    """Returns a paragraph using *items* abbreviations, with their definitions."""
+    words = ['ABBR%d' % i for i in range(items)]
+    definitions = ['*[%s]: Abbreviation %d' % (word, i)
+                   for i, word in enumerate(words)]
+    return ' '.join(words[:50]) + '\n\n' + '\n'.join(definitions)
+
+
+def footnotes(items):
+    """Returns a paragraph with *items* footnotes, with their definitions."""
+    references = ' '.join(['word[^%d]' % i for i in range(items)])
+    notes = '\n'.join(['[^%d]: Note %d' % (i, i) for i in range(items)])
+    return references + '\n\n' + notes
+
+
+def main(items=ITEMS):
+    d = registry(items)
+    abbr = abbreviations(items)
+    notes = footnotes(items)
+    cases = [('add and link %d items' % items, lambda: registry(items)),
+             ('value_for_index x20', lambda: walk(d)),
+             ('index of %d keys' % len(d), lambda: lookup(d)),
+             ('Markdown(%d extensions)' % len(EXTENSIONS),
+              lambda: markdown.Markdown(extensions=EXTENSIONS)),
+             ('%d abbreviations' % items,
+              lambda: markdown.markdown(abbr, ['abbr'])),
+             ('%d footnotes' % items,
+              lambda: markdown.markdown(notes, ['footnotes']))]
+    print '%-32s %10s' % ('case', 'best (ms)')
+    for name, f in cases:
+        print '%-32s %10.2f' % (name, best(f))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
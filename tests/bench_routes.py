@@ -0,0 +1,688 @@
+# -*- coding: utf-8 -*-
+"""
+
+    Route Benchmark
+    ~~~~~~~~~~~~~~~
+
+    Drives every route of blog.views through app.test_client() on
+    generated sqlite databases and reports, for each route, the
+    p50/p95/p99 latency, the statements executed per request and the
+    objects a request allocates:
+
+        python tests/bench_routes.py [-e 1000,10000,100000] [-o out.json]
+                                     [-c earlier.json] [-b memory]
+
+    Fixtures hold realistic Markdown entries (paragraphs with inline
+    markup, lists, quotes, fenced and highlighted code) tagged with a
+    skewed distribution; they are built once per size and seed, kept
+    in the fixture directory and copied before every run, since some
+    routes write. The results are saved as JSON, and the results of an
+    earlier run can be given to print the changes.
+
+    Pages come straight from the views: the response cache is replaced
+    by a NullCache unless --cache is given. With --backend memory the
+    same entries are loaded into a MemoryLayer instead, which gives
+    the cost of everything but the database.
+
+    :copyright: © 2010 by Gianluca Bargelli.
+    :license: MIT, see LICENSE for more details.
+
+
+"""
+
+import gc
+import os
+import math
+import time
+import random
+import shutil
+import sqlite3
+import hashlib
+import datetime
+import tempfile
+import optparse
+import platform
+import subprocess
+from flask import g, json
+from werkzeug.contrib.cache import NullCache
+from blog import app, data_layer, views, db
+from blog.helpers import slugify_entry, render_markdown, render_version
+
+SIZES = (1000, 10000, 100000)
+TAGS = 200
+TAGS_PER_ENTRY = 3
+VOCABULARY = 3000
+BATCH_SIZE = 1000
+REQUESTS = 100
+WARMUP = 2
+MIN_REQUESTS = 5
+MAX_SECONDS = 10.0
+ALLOC_REQUESTS = 3
+USERNAME = 'bench'
+PASSWORD = 'bench'
+# Named tags first (the most used ones), then tag<n>
+TAG_NAMES = ['python', 'flask', 'sqlite', 'javascript', 'project', 'linux',
+             'web', 'markdown', 'google-app-engine', 'university']
+# Fenced code needs its extension, which the default pipeline lacks
+EXTENSIONS = ['fenced_code']
+SNIPPETS = [
+    ('python', '''def fibonacci(n):
+    """Returns the n-th Fibonacci number."""
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+
+print [fibonacci(n) for n in range(10)]'''),
+    ('python', '''@app.route('/blog/tags/<tagname>')
+def list_entries(tagname):
+    entries = query_db('SELECT * FROM entry WHERE tag = ?', [tagname])
+    return render_template('list_entries.html', entries=entries)'''),
+    ('javascript', '''$(document).ready(function() {
+    $('.comments_count a').click(function(event) {
+        event.preventDefault();
+        $(this).parent().next('.comments').toggle();
+    });
+});'''),
+    ('sql', '''SELECT entry.title, COUNT(*) AS tags
+FROM entry
+JOIN entry_tags ON entry.id = entry_tags.id_entry_FK
+GROUP BY entry.id
+ORDER BY tags DESC
+LIMIT 10;'''),
+    ('bash', '''$ virtualenv env && . env/bin/activate
+$ pip install flask
+$ python manage.py initdb
+$ python manage.py runserver'''),
+    ('c', '''int main(int argc, char *argv[])
+{
+    int i;
+    for (i = 0; i < argc; i++)
+        printf("%d: %s\\n", i, argv[i]);
+    return 0;
+}'''),
+]
+
+
+class CountingConnection(db.InstrumentedConnection):
+    """A pooled connection which counts the statements of all connections."""
+
+    queries = 0
+
+    def execute(self, *args):
+        CountingConnection.queries += 1
+        return db.InstrumentedConnection.execute(self, *args)
+
+    def executemany(self, *args):
+        CountingConnection.queries += 1
+        return db.InstrumentedConnection.executemany(self, *args)
+
+
+def make_vocabulary(seed=0):
+    """Returns VOCABULARY made-up words, the most common first."""
+    rnd = random.Random(seed)
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'so', 'vi', 'de', 'po',
+                 'gra', 'stel', 'bri', 'quo', 'fen', 'dor', 'lin', 'mar']
+    words = []
+    seen = set()
+    while len(words) < VOCABULARY:
+        word = ''.join([rnd.choice(syllables)
+                        for i in range(rnd.randint(1, 4))])
+        if word not in seen:
+            seen.add(word)
+            words.append(unicode(word))
+    return words
+
+
+def skewed(rnd, items, alpha=0.8, scale=10):
+    """
+    Picks one of items with a Pareto distribution, the first ones
+    being far more likely; the larger *scale*, the flatter the head.
+    """
+    return items[int((rnd.paretovariate(alpha) - 1) * scale) % len(items)]
+
+
+def make_blocks(rnd, words):
+    """
+    Returns the Markdown blocks posts are made of, by kind, as
+    (markdown, html) pairs; a post is a sequence of blocks, so its
+    HTML is (but for blank lines) the sequence of their HTML and
+    fixtures of any size need only these few conversions.
+    """
+    def sentence():
+        text = ' '.join([skewed(rnd, words)
+                         for i in range(rnd.randint(6, 18))])
+        return text[0].upper() + text[1:] + '.'
+
+    def paragraph():
+        parts = []
+        for i in range(rnd.randint(2, 6)):
+            text = sentence()
+            markup = rnd.random()
+            if markup < 0.2:
+                tokens = text.split(' ')
+                k = rnd.randrange(1, len(tokens) - 1)
+                tokens[k] = rnd.choice(['*%s*', '**%s**']) % tokens[k]
+                text = ' '.join(tokens)
+            elif markup < 0.35:
+                word = skewed(rnd, words)
+                text += ' See `%s()`.' % word
+            elif markup < 0.45:
+                word = skewed(rnd, words)
+                text += ' More on [%s](http://example.com/%s).' % (word, word)
+            parts.append(text)
+        return ' '.join(parts)
+
+    def listing():
+        return '\n'.join(['* ' + sentence() for i in range(rnd.randint(2, 6))])
+
+    def quote():
+        return '> ' + sentence()
+
+    def heading():
+        return '## ' + sentence()[:-1]
+
+    def code():
+        language, snippet = rnd.choice(SNIPPETS)
+        if rnd.random() < 0.5:
+            return '~~~{.%s}\n%s\n~~~' % (language, snippet)
+        # Indented, highlighted by codehilite
+        lines = [':::' + language] + snippet.splitlines()
+        return '\n'.join(['    ' + line for line in lines])
+
+    makers = {'paragraph': (paragraph, 400), 'list': (listing, 60),
+              'quote': (quote, 40), 'heading': (heading, 40),
+              'code': (code, 60)}
+    blocks = {}
+    for kind, (maker, count) in makers.iteritems():
+        blocks[kind] = []
+        for i in range(count):
+            text = maker()
+            blocks[kind].append((text, render_markdown(text)))
+    blocks['more'] = [('* * *', render_markdown('* * *'))]
+    return blocks
+
+
+def make_post(rnd, number, words, blocks, date, tags):
+    """Returns a post as insert_entries expects it."""
+    title = ' '.join([skewed(rnd, words)
+                      for i in range(rnd.randint(2, 6))]).capitalize()
+    title = '%s (%d)' % (title, number)
+
+    # An introduction, usually followed by the read more marker
+    chosen = [rnd.choice(blocks['paragraph'])]
+    if rnd.random() < 0.8:
+        chosen.append(blocks['more'][0])
+    previous = None
+    for i in range(rnd.randint(2, 8)):
+        kind = skewed(rnd, ['paragraph', 'code', 'list', 'heading', 'quote'],
+                      1.5, 1)
+        # Adjacent code blocks, lists or quotes would merge into one,
+        # and code after a list would continue its last item
+        if kind == previous and kind in ('code', 'list', 'quote') \
+           or previous == 'list' and kind == 'code':
+            kind = 'paragraph'
+        chosen.append(rnd.choice(blocks[kind]))
+        previous = kind
+
+    return {'title': title,
+            'slug': slugify_entry(title),
+            'body': '\n\n'.join([text for text, html in chosen]),
+            'content_html': '\n'.join([html for text, html in chosen]),
+            'render_version': render_version(),
+            'creation_date': date,
+            'tags': tags}
+
+
+def tag_names():
+    """Returns the TAGS tags of the fixtures, the most used first."""
+    return TAG_NAMES + ['tag%d' % i for i in range(len(TAG_NAMES), TAGS)]
+
+
+def make_posts(entries, seed=0):
+    """
+    Yields the *entries* posts of a fixture, spread over the last ten
+    years and each one tagged with TAGS_PER_ENTRY of TAGS tags.
+    """
+    rnd = random.Random(seed)
+    words = make_vocabulary(seed)
+    blocks = make_blocks(rnd, words)
+    tags = tag_names()
+
+    today = datetime.date.today()
+    for i in range(entries):
+        date = today - datetime.timedelta(days=rnd.randint(0, 3650))
+        chosen = set()
+        while len(chosen) < TAGS_PER_ENTRY:
+            chosen.add(skewed(rnd, tags, 1.2))
+        yield make_post(rnd, i, words, blocks, date, list(chosen))
+
+
+def insert_posts(layer, entries, seed=0):
+    """Inserts the posts of a fixture in batches, owned by user 1."""
+    batch = []
+    for post in make_posts(entries, seed):
+        batch.append(post)
+        if len(batch) == BATCH_SIZE:
+            layer.insert_entries(batch, 1)
+            batch = []
+    if batch:
+        layer.insert_entries(batch, 1)
+
+
+def build_fixture(path, entries, seed=0):
+    """
+    Creates a fully migrated database at path, with the bench user
+    (an administrator) and the posts of the fixture.
+    """
+    app.config['DATABASE'] = path
+    data_layer.init_db()
+
+    ctx = app.test_request_context()
+    ctx.push()
+    try:
+        g.db = data_layer.connect_db()
+        try:
+            g.db.execute("INSERT INTO rank VALUES (0, 'administrator')")
+            g.db.execute('INSERT INTO user VALUES (1, ?, ?, 0)',
+                         (USERNAME, hashlib.sha256(PASSWORD).hexdigest()))
+            g.db.commit()
+            insert_posts(data_layer, entries, seed)
+            g.db.execute('ANALYZE')
+            g.db.commit()
+        finally:
+            data_layer.close()
+    finally:
+        ctx.pop()
+    data_layer.dispose()
+
+
+def load_memory(layer, entries, seed=0):
+    """Fills a MemoryLayer with the bench user and the posts of the fixture."""
+    layer.init_db()
+    layer.insert_user(USERNAME, hashlib.sha256(PASSWORD).hexdigest())
+    insert_posts(layer, entries, seed)
+
+
+def fixture_path(directory, entries, seed):
+    """
+    Returns the path of a fixture, which depends on the pipeline and
+    the schema version too.
+    """
+    return os.path.join(directory, 'blog-routes-%d-%d-%s-%d.db'
+                        % (entries, seed, render_version()[:8],
+                           db.list_migrations()[-1][0]))
+
+
+def percentile(samples, p):
+    """Returns the nearest-rank p-th percentile of sorted samples."""
+    index = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[max(0, min(index, len(samples) - 1))]
+
+
+def describe_fixture(entries, seed):
+    """
+    Returns what the routes are driven with: the popular and rare
+    tags, a sample of entries, some search words and page cursors.
+    """
+    info = {}
+    ctx = app.test_request_context()
+    ctx.push()
+    try:
+        g.db = data_layer.connect_db()
+        try:
+            counts = [(tag, data_layer.count_entries(tag))
+                      for tag in tag_names()]
+            # The most used first, then by name
+            counts = sorted([item for item in counts if item[1]],
+                            key=lambda item: (-item[1], item[0]))
+            info['popular'], info['popular_count'] = counts[0]
+            info['rare'], info['rare_count'] = counts[-1]
+            step = max(1, entries // 100)
+            archive = [(entry['id'], entry['slug'], entry['creation_date'])
+                       for entry in data_layer.get_archive()
+                       if entry['id'] % step == 0]
+            info['sample'] = sorted(archive)[:100]
+            pages = int(math.ceil(entries / float(app.config['MAX_PAGE_ENTRIES'])))
+            info['middle_page'] = max(1, pages // 2)
+            info['cursor'] = data_layer.page_cursor(None, info['middle_page'])
+            tag_pages = int(math.ceil(info['popular_count'] /
+                                      float(app.config['MAX_PAGE_ENTRIES'])))
+            info['last_tag_page'] = max(1, tag_pages)
+        finally:
+            data_layer.close()
+    finally:
+        ctx.pop()
+
+    words = make_vocabulary(seed)
+    info['common_word'] = words[0]
+    info['rare_word'] = words[VOCABULARY // 3]
+    info['two_words'] = '%s %s' % (words[3], words[40])
+    return info
+
+
+def plan_routes(info):
+    """
+    Returns the requests to time: dictionaries with a name, the
+    endpoint, the method, a function building the url (and the form)
+    of the i-th request, whether the client logs in first and whether
+    every request needs a new client (for those changing the session).
+    """
+    def article_url(i):
+        entry_id, slug, date = info['sample'][i % len(info['sample'])]
+        year, month, day = [int(part) for part in date[:10].split('-')]
+        return '/blog/articles/%d/%d/%d/%s' % (year, month, day, slug)
+
+    def new_entry(i):
+        return {'title': 'Benchmark entry %d %f' % (i, time.time()),
+                'entry_text': 'Some *Markdown* text.\n\n    :::python\n'
+                              '    print "hello"',
+                'tags': '%s bench' % info['popular'],
+                'img_url': ''}
+
+    def route(name, endpoint, url, method='GET', form=None, login=False,
+              fresh=False):
+        if not callable(url):
+            url = (lambda path: lambda i: path)(url)
+        return {'name': name, 'endpoint': endpoint, 'url': url,
+                'method': method, 'form': form, 'login': login,
+                'fresh': fresh}
+
+    popular, rare = info['popular'], info['rare']
+    return [
+        route('home', 'show_home', '/'),
+        route('listing', 'list_entries', '/blog'),
+        route('listing (middle page)', 'list_entries',
+              '/blog?page=%d' % info['middle_page']),
+        route('listing (cursor)', 'list_entries',
+              '/blog?before=%s' % info['cursor']),
+        route('listing (page 2)', 'list_page', '/blog/page/2'),
+        route('tag (popular)', 'list_entries', '/blog/tags/%s' % popular),
+        route('tag (popular, last page)', 'list_page',
+              '/blog/tags/%s/page/%d' % (popular, info['last_tag_page'])),
+        route('tag (rare)', 'list_entries', '/blog/tags/%s' % rare),
+        route('article', 'view_entry', article_url),
+        route('search (common word)', 'search_entries',
+              '/search?q=%s' % info['common_word']),
+        route('search (rare word)', 'search_entries',
+              '/search?q=%s' % info['rare_word']),
+        route('search (two words)', 'search_entries',
+              '/search?q=%s' % info['two_words'].replace(' ', '+')),
+        route('projects', 'show_projects', '/projects'),
+        route('about', 'show_about', '/about'),
+        route('feed', 'recent_feed', '/recent.atom'),
+        route('login form', 'login', '/login'),
+        route('login', 'login', '/login', 'POST',
+              lambda i: {'username': USERNAME, 'password': PASSWORD},
+              fresh=True),
+        route('logout', 'logout', '/logout', login=True, fresh=True),
+        route('admin panel', 'admin_panel', '/admin', login=True),
+        route('new entry form', 'add_entry', '/add_entry', login=True),
+        route('add entry', 'add_entry', '/add_entry', 'POST', new_entry,
+              login=True),
+        route('edit entry form', 'edit_entry',
+              lambda i: '/edit/%d' % info['sample'][i % len(info['sample'])][0],
+              login=True),
+    ]
+
+
+def make_client(route):
+    """Returns a test client, logged in if the route needs it."""
+    client = app.test_client()
+    if route['login']:
+        client.post('/login', data={'username': USERNAME,
+                                    'password': PASSWORD})
+    return client
+
+
+def request(client, route, i):
+    """Performs the i-th request of a route and returns the response."""
+    form = route['form'] and route['form'](i)
+    response = client.open(route['url'](i), method=route['method'], data=form)
+    # Reading the body runs any lazy part of the response
+    response.data
+    return response
+
+
+def drive(route, requests=REQUESTS, max_seconds=MAX_SECONDS):
+    """
+    Times a route and returns its statistics: the status codes, the
+    number of timed requests, the mean and the p50/p95/p99 latency in
+    ms, the statements per request and, from a few extra requests run
+    with the collector off, the objects allocated and still alive at
+    the end of a request (the net growth of the gc-tracked objects)
+    and those the collector then frees (garbage cycles).
+    """
+    client = make_client(route)
+    for i in range(WARMUP):
+        request(route['fresh'] and make_client(route) or client, route, i)
+
+    times = []
+    queries = []
+    statuses = set()
+    deadline = time.time() + max_seconds
+    for i in range(requests):
+        if route['fresh']:
+            client = make_client(route)
+        CountingConnection.queries = 0
+        start = time.time()
+        response = request(client, route, i)
+        times.append((time.time() - start) * 1000.0)
+        queries.append(CountingConnection.queries)
+        statuses.add(response.status_code)
+        if len(times) >= MIN_REQUESTS and time.time() > deadline:
+            break
+
+    objects = []
+    garbage = []
+    for i in range(ALLOC_REQUESTS):
+        if route['fresh']:
+            client = make_client(route)
+        gc.collect()
+        gc.disable()
+        try:
+            before = len(gc.get_objects())
+            request(client, route, i)
+            objects.append(len(gc.get_objects()) - before)
+        finally:
+            gc.enable()
+        garbage.append(gc.collect())
+
+    times.sort()
+    return {'endpoint': route['endpoint'],
+            'method': route['method'],
+            'url': route['url'](0),
+            'status': sorted(statuses),
+            'requests': len(times),
+            'mean': sum(times) / len(times),
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+            'queries': sum(queries) / float(len(queries)),
+            'objects': sorted(objects)[len(objects) // 2],
+            'garbage': sorted(garbage)[len(garbage) // 2]}
+
+
+def drive_routes(entries, options):
+    """
+    Times every route on the loaded fixture and returns what they were
+    driven with, the routes and their statistics by name.
+    """
+    info = describe_fixture(entries, options.seed)
+
+    routes = plan_routes(info)
+    driven = set([route['endpoint'] for route in routes])
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint != 'static' and rule.endpoint not in driven:
+            print 'Warning: %s (%s) is not driven' % (rule.endpoint,
+                                                      rule.rule)
+
+    results = {}
+    for route in routes:
+        results[route['name']] = drive(route, options.requests,
+                                       options.max_seconds)
+    return info, routes, results
+
+
+def run(entries, options):
+    """
+    Benchmarks every route on a copy of the fixture of this size, or
+    on a memory layer holding the same entries.
+    """
+    built = None
+    if options.backend == 'memory':
+        print 'Loading %d entries...' % entries
+        start = time.time()
+        load_memory(data_layer, entries, options.seed)
+        built = time.time() - start
+        info, routes, results = drive_routes(entries, options)
+        return result(entries, info, routes, results, built)
+
+    fixture = fixture_path(options.fixtures, entries, options.seed)
+    if not os.path.exists(fixture):
+        print 'Building a fixture with %d entries...' % entries
+        start = time.time()
+        partial = fixture + '.part'
+        for path in (partial, partial + '-wal', partial + '-shm'):
+            if os.path.exists(path):
+                os.unlink(path)
+        build_fixture(partial, entries, options.seed)
+        os.rename(partial, fixture)
+        built = time.time() - start
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        shutil.copyfile(fixture, path)
+        app.config['DATABASE'] = path
+        info, routes, results = drive_routes(entries, options)
+    finally:
+        data_layer.dispose()
+        for name in (path, path + '-wal', path + '-shm'):
+            if os.path.exists(name):
+                os.unlink(name)
+    return result(entries, info, routes, results, built)
+
+
+def result(entries, info, routes, results, built):
+    """Returns the results of a size, as they are saved."""
+    return {'fixture': {'entries': entries,
+                        'popular_tag': [info['popular'], info['popular_count']],
+                        'rare_tag': [info['rare'], info['rare_count']],
+                        'build_seconds': built},
+            'routes': results,
+            'order': [route['name'] for route in routes]}
+
+
+def report(entries, result, previous=None):
+    """Prints the results of a size, against an earlier run if given."""
+    print
+    print '%d entries (popular tag: %s, %d entries; rare tag: %s, %d)' % (
+          (entries,) + tuple(result['fixture']['popular_tag'])
+                     + tuple(result['fixture']['rare_tag']))
+    header = '%-28s %6s %5s %9s %9s %9s %7s %8s' % (
+             'route', 'status', 'n', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+             'queries', 'objects')
+    if previous is not None:
+        header += ' %9s %9s' % ('was p50', 'change')
+    print header
+
+    for name in result['order']:
+        stats = result['routes'][name]
+        line = '%-28s %6s %5d %9.2f %9.2f %9.2f %7.1f %8d' % (
+               name, ','.join([str(s) for s in stats['status']]),
+               stats['requests'], stats['p50'], stats['p95'], stats['p99'],
+               stats['queries'], stats['objects'])
+        old = previous and previous['routes'].get(name)
+        if old:
+            line += ' %9.2f %+8.0f%%' % (old['p50'],
+                    (stats['p50'] / max(old['p50'], 1e-6) - 1) * 100)
+        print line
+
+
+def revision():
+    """Returns the git revision of the tree, if there is one."""
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        output = process.communicate()[0].strip()
+        return output or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-e', '--entries', default=','.join(map(str, SIZES)),
+                      help='comma separated fixture sizes [%default]')
+    parser.add_option('-n', '--requests', type='int', default=REQUESTS,
+                      help='timed requests per route [%default]')
+    parser.add_option('-t', '--max-seconds', type='float', default=MAX_SECONDS,
+                      help='time limit per route, once %d requests are '
+                           'done [%%default]' % MIN_REQUESTS)
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='fixture seed [%default]')
+    parser.add_option('-f', '--fixtures', default=tempfile.gettempdir(),
+                      help='directory keeping the fixtures [%default]')
+    parser.add_option('--cache', action='store_true', default=False,
+                      help='keep the configured response cache')
+    parser.add_option('-b', '--backend', default='sqlite',
+                      choices=['sqlite', 'memory'],
+                      help='data layer, sqlite or memory [%default]')
+    parser.add_option('-o', '--output', default='bench-routes.json',
+                      help='JSON file for the results [%default]')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='JSON results of an earlier run')
+    options, args = parser.parse_args(argv)
+    sizes = [int(size) for size in options.entries.split(',')]
+
+    previous = {}
+    if options.compare:
+        f = open(options.compare)
+        try:
+            previous = json.load(f)['runs']
+        finally:
+            f.close()
+
+    for extension in EXTENSIONS:
+        if extension not in app.config['MARKDOWN_EXTENSIONS']:
+            app.config['MARKDOWN_EXTENSIONS'] = \
+                [extension] + list(app.config['MARKDOWN_EXTENSIONS'])
+    if not options.cache:
+        views.response_cache.backend = NullCache()
+    if options.backend == 'memory':
+        global data_layer
+        data_layer = views.data_layer = db.MemoryLayer()
+    else:
+        data_layer.connection_factory = CountingConnection
+
+    results = {'meta': {'date': datetime.datetime.utcnow().isoformat(),
+                        'revision': revision(),
+                        'python': platform.python_version(),
+                        'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(),
+                        'requests': options.requests,
+                        'max_seconds': options.max_seconds,
+                        'seed': options.seed,
+                        'cache': options.cache,
+                        'backend': options.backend,
+                        'extensions': list(app.config['MARKDOWN_EXTENSIONS'])},
+               'runs': {}}
+    for entries in sizes:
+        result = run(entries, options)
+        results['runs'][str(entries)] = result
+        report(entries, result, previous.get(str(entries)))
+
+    f = open(options.output, 'w')
+    try:
+        json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    print
+    print 'Results saved to %s' % options.output
+
+
+if __name__ == '__main__':
+    main()
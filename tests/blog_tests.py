@@ -12,15 +12,84 @@
 
 """
 
-from flask import Flask
+from flask import Flask, g
 import os
 import math
+import base64
+import hashlib
+import shutil
+import sqlite3
 import unittest
 import tempfile
 import datetime
+import threading
+import markdown
+import markdown.cache
 from blog import app, data_layer
 from blog import views
 from blog import helpers
+from blog import freeze
+from blog import importer
+from blog import metrics
+from blog import db as blog_db
+from blog.db import list_migrations, query_log
+
+
+class CountingConnection(sqlite3.Connection):
+    """A sqlite connection which counts the executed statements."""
+
+    queries = 0
+
+    def execute(self, *args):
+        self.queries += 1
+        return sqlite3.Connection.execute(self, *args)
+
+    def executemany(self, *args):
+        self.queries += 1
+        return sqlite3.Connection.executemany(self, *args)
+
+
+class FakeDatastore(object):
+    """
+    Stands for google.appengine.ext.db in the BigtableLayer tests:
+    entities are looked up by key in a dictionary.
+    """
+
+    def __init__(self, entities):
+        self.entities = entities
+        self.gets = []
+
+    def get(self, keys):
+        self.gets.append(list(keys))
+        return [self.entities.get(key) for key in keys]
+
+
+class FakeReference(object):
+    """A ReferenceProperty holding the key in the _owner attribute."""
+
+    def get_value_for_datastore(self, item):
+        return item._owner
+
+
+class FakeEntry(object):
+    """An Entry entity; dereferencing user_id_FK is an error."""
+
+    user_id_FK = FakeReference()
+
+    def __init__(self, id, owner):
+        self._id = id
+        self._owner = owner
+        self.slug = self.title = self.body = u'entry-%d' % id
+        self.content_html = self.excerpt_html = self.render_version = None
+        self.creation_date = self.last_date = datetime.datetime(2010, 11, 5)
+        self.creation_only_date = self.creation_date.date()
+        self.tags = []
+
+    def key(self):
+        return self
+
+    def id(self):
+        return self._id
 
 
 class BlogTestCase(unittest.TestCase):
@@ -30,10 +99,13 @@ class BlogTestCase(unittest.TestCase):
         """Before each test, set up a sample database"""
         self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
         self.app = app.test_client()
+        # Every database starts at the same generation
+        views.response_cache.backend.clear()
         data_layer.init_db(testdb=True)
 
     def tearDown(self):
         """Get rid of the database again after each test."""
+        data_layer.dispose()
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
 
@@ -70,6 +142,16 @@ class BlogTestCase(unittest.TestCase):
         for entry in range(n):
             self.add_entry('Test Title', 'this is a test!','tag1 tag2 tag3')
 
+    def insert_sample_entries(self, n=10, title=u'Test Title',
+                              text=u'this is a test!', tags='tag1 tag2 tag3'):
+        """Inserts *n* entries of the test user through the data layer."""
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            g.user = data_layer.get_user('test')
+            for entry in range(n):
+                data_layer.insert_entry(title, text, g.user['id'], tags)
+            data_layer.close()
+
     def test_empty_db(self):
         """Tests if an initial database is empty."""
         rv = self.app.get("/")
@@ -173,6 +255,696 @@ class BlogTestCase(unittest.TestCase):
         rv = self.app.get('/admin')
         assert 'Administration Panel' not in rv.data
 
+    def test_fill_entries_query_count(self):
+        """
+        Tests that hydrating entries with tags and authors costs
+        the same number of queries whatever the number of entries.
+        """
+        self.insert_sample_entries(12)
+        with app.test_request_context():
+            g.db = sqlite3.connect(app.config['DATABASE'],
+                                   factory=CountingConnection)
+            for n in (1, 5, 12):
+                entries = data_layer.query_db('SELECT * FROM entry LIMIT ?',
+                                              [n])
+                g.db.queries = 0
+                helpers.fill_entries(entries)
+                # One query for the tags, one for the authors
+                assert g.db.queries == 2
+                assert entries[0]['tags'] == ['tag1', 'tag2', 'tag3']
+                assert entries[0]['author'] == 'test'
+            g.db.close()
+
+    def test_process_tags_query_count(self):
+        """
+        Tests that saving an entry costs the same number of queries
+        whatever the number of its tags, and that updates only touch
+        the tags which changed.
+        """
+        with app.test_request_context():
+            g.db = sqlite3.connect(app.config['DATABASE'],
+                                   factory=CountingConnection)
+            g.user = data_layer.get_user('test')
+            counts = []
+            for tags in ('tag1', 'tag1 tag2 tag3 tag4 tag5 tag5'):
+                g.db.queries = 0
+                data_layer.insert_entry(u'Test Title', u'this is a test!',
+                                        g.user['id'], tags)
+                counts.append(g.db.queries)
+            assert counts[0] == counts[1]
+            data_layer.update_entry(2, u'Test Title', u'this is a test!',
+                                    'tag1 tag6')
+            assert data_layer.count_entries('tag1') == 2
+            assert data_layer.count_entries('tag2') == 0
+            assert data_layer.count_entries('tag6') == 1
+            g.db.close()
+
+    def test_entry_dates(self):
+        """
+        Tests that entries come with date objects, as the templates
+        and the feed expect, and that they can be looked up by id.
+        """
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            g.user = data_layer.get_user('test')
+            data_layer.insert_entry(u'Test Title', u'this is a test!',
+                                    g.user['id'], 'tag1 tag2')
+            entry = data_layer.get_recent_entries(1)[0]
+            assert isinstance(entry['creation_date'], datetime.date)
+            assert isinstance(entry['last_date'], datetime.datetime)
+            assert entry['human_date'] == \
+                   entry['creation_date'].strftime('%d %b').upper()
+            by_id = data_layer.get_entry_by_id(entry['id'])
+            assert by_id['entry_id'] == entry['id']
+            assert sorted(by_id['tags']) == ['tag1', 'tag2']
+            assert data_layer.get_entry_by_id(entry['id'] + 1) is None
+            data_layer.close()
+        rv = self.app.get('/recent.atom')
+        assert rv.status_code == 200
+        assert 'Test Title' in rv.data
+
+    def test_connection_pool(self):
+        """Tests that connections are reused across requests."""
+        self.app.get('/blog')
+        stats = data_layer.pool_stats()
+        self.app.get('/blog')
+        assert data_layer.pool_stats()['open'] == stats['open'] == 1
+        assert data_layer.pool_stats()['checkouts'] == stats['checkouts'] + 1
+        assert data_layer.pool_stats()['in_use'] == 0
+        conn = data_layer.connect_db()
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        data_layer.pool.checkin(conn)
+
+    def test_connection_returned_on_cache_error(self):
+        """Tests that a failing response cache does not leak connections."""
+        def broken(*args):
+            raise IOError('cache backend down')
+        views.response_cache.set = broken
+        try:
+            assert self.app.get('/blog').status_code == 500
+        finally:
+            del views.response_cache.set
+        assert data_layer.pool_stats()['in_use'] == 0
+
+    def test_metrics(self):
+        """Tests the Server-Timing header and the metrics page."""
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            g.db.execute("UPDATE user SET password = ? WHERE username = 'test'",
+                         [hashlib.sha256('secret').hexdigest()])
+            g.db.commit()
+            data_layer.close()
+
+        app.config['METRICS'] = True
+        metrics.registry.reset()
+        try:
+            timing = self.app.get('/about').headers['Server-Timing']
+            assert 'markdown;dur=' in timing
+            assert 'template;dur=' in timing
+            assert 'total;dur=' in timing
+            timing = self.app.get('/blog').headers['Server-Timing']
+            assert 'db;dur=' in timing
+            # Administrators only, e.g. with HTTP basic authentication
+            assert self.app.get('/metrics').status_code == 401
+            auth = [('Authorization',
+                     'Basic ' + base64.b64encode('test:secret'))]
+            rv = self.app.get('/metrics', headers=auth)
+            assert rv.status_code == 200
+            assert 'blog_request_seconds_count' \
+                   '{endpoint="show_about",phase="total"} 1' in rv.data
+            assert 'blog_requests_total' \
+                   '{endpoint="list_entries",status="200"} 1.0' in rv.data
+            assert 'blog_sqlite_pool_connections{state="open"}' in rv.data
+        finally:
+            app.config['METRICS'] = False
+        assert 'Server-Timing' not in self.app.get('/blog').headers
+        assert self.app.get('/metrics').status_code == 404
+
+    def test_query_db(self):
+        """Tests the rows of query_db, as a list or lazily."""
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            query = 'SELECT id, username FROM user ORDER BY id'
+            users = data_layer.query_db(query)
+            assert 'test' in [user['username'] for user in users]
+            assert list(data_layer.query_db(query, lazy=True)) == users
+            assert data_layer.query_db(query, one=True) == users[0]
+            assert data_layer.query_db('SELECT * FROM user WHERE id = 0',
+                                       one=True) is None
+            empty = 'WITH none AS (SELECT id FROM user WHERE id = 0) ' \
+                    'SELECT * FROM none'
+            assert data_layer.query_db(empty) == []
+            assert data_layer.query_db(empty, one=True) is None
+            assert list(data_layer.query_db(empty, lazy=True)) == []
+            data_layer.close()
+
+    def test_empty_search(self):
+        """Tests that searches matching no entry find nothing."""
+        self.insert_sample_entries(3)
+        rv = self.app.get('/search?q=nowhere')
+        assert rv.status_code == 200
+        assert 'No entries match' in rv.data
+
+    def test_query_log(self):
+        """
+        Tests that statements are recorded with their parameters and
+        rows, and that slow ones and full scans reach the slow log.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        settings = app.config['SQLITE_SLOW_QUERY_MS'], \
+                   app.config['SQLITE_SLOW_QUERY_LOG']
+        app.config['SQLITE_SLOW_QUERY_LOG'] = path
+        query_log.reset()
+        try:
+            with app.test_request_context():
+                g.db = data_layer.connect_db()
+                rows = g.db.execute('SELECT * FROM user WHERE id IN (?, ?)',
+                                    [1, 2]).fetchall()
+                record = query_log.recent[-1]
+                assert record['sql'] == 'SELECT * FROM user WHERE id IN (?, ...)'
+                assert record['parameters'] == '(int x 2)'
+                assert record['rows'] == len(rows)
+                assert not record['scans'] and not record['slow']
+                # Every user is read: the plan scans the whole table
+                g.db.execute('SELECT username FROM user WHERE password = ?',
+                             [u'test']).fetchall()
+                assert query_log.recent[-1]['scans'] == ['user']
+                app.config['SQLITE_SLOW_QUERY_MS'] = 0
+                g.db.execute('SELECT count(*) FROM entry').fetchone()
+                data_layer.close()
+            assert query_log.recent[-1]['slow']
+            log = open(path).read()
+            assert 'Full table scan' in log and 'password = ?' in log
+            assert 'Slow statement' in log and 'plan: ' in log
+            assert query_log.stats()[0]['calls'] >= 1
+        finally:
+            app.config['SQLITE_SLOW_QUERY_MS'], \
+            app.config['SQLITE_SLOW_QUERY_LOG'] = settings
+            query_log.logger()
+            os.unlink(path)
+
+    def test_response_cache(self):
+        """
+        Tests that public pages are cached until the next write, and
+        that logged-in users never get the anonymous copies.
+        """
+        stats = views.response_cache.stats
+        hits = stats()['hits']
+        anonymous = self.app.get('/about')
+        assert stats()['hits'] == hits
+        assert self.app.get('/about').data == anonymous.data
+        assert stats()['hits'] == hits + 1
+
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            g.db.execute("UPDATE user SET password = ? WHERE username = 'test'",
+                         [hashlib.sha256('secret').hexdigest()])
+            g.db.commit()
+            data_layer.close()
+        assert 'You were logged in' in self.login('test', 'secret').data
+        logged_in = self.app.get('/about')
+        assert stats()['hits'] == hits + 1
+        assert 'Logout' in logged_in.data and logged_in.data != anonymous.data
+        self.logout()
+        assert self.app.get('/about').data == anonymous.data
+        assert stats()['hits'] == hits + 2
+
+        # Adding an entry bumps the generation number
+        self.app.get('/blog')
+        self.insert_sample_entries(1, title=u'Fresh Entry')
+        assert 'Fresh Entry' in self.app.get('/blog').data
+        self.app.get('/about')
+        assert stats()['hits'] == hits + 2
+
+    def test_conditional_requests(self):
+        """
+        Tests that listings are validated by their ETag alone, while
+        single entries also carry a Last-Modified date.
+        """
+        today = datetime.date.today()
+        self.insert_sample_entries(1)
+        rv = self.app.get('/blog')
+        assert rv.headers.get('ETag') and 'Last-Modified' not in rv.headers
+        etag = rv.headers['ETag']
+        assert self.app.get('/blog', headers={'If-None-Match': etag}) \
+                   .status_code == 304
+        rv = self.app.get('/blog', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        assert rv.status_code == 200
+
+        path = '/blog/articles/%s/%s/%s/test-title' % (today.year,
+                                                       today.month, today.day)
+        rv = self.app.get(path)
+        assert 'Last-Modified' in rv.headers
+        rv = self.app.get(path, headers={
+            'If-Modified-Since': rv.headers['Last-Modified']})
+        assert rv.status_code == 304
+
+    def test_migrations(self):
+        """
+        Tests that the migrations bring a version 0 database forward,
+        merging duplicated tags, and run only once.
+        """
+        versions = [version for version, path in list_migrations()]
+        conn = sqlite3.connect(app.config['DATABASE'])
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == versions[-1]
+        indexes = [row[0] for row in conn.execute(
+                   "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        for index in ('entry_date', 'entry_slug', 'entry_tags_tag', 'tag_name'):
+            assert index in indexes
+        self.assertRaises(sqlite3.IntegrityError, conn.execute,
+                          "INSERT INTO tag SELECT null, 'dup' \
+                           UNION ALL SELECT null, 'dup'")
+        conn.close()
+
+        # An existing production database, with duplicated tags
+        fd, path = tempfile.mkstemp()
+        conn = sqlite3.connect(path)
+        conn.executescript(app.open_resource('schema/schema.sql').read())
+        conn.executescript("""
+        INSERT INTO entry VALUES (1, 'a', 'A', 'a', '2010-01-01', null, 1);
+        INSERT INTO tag VALUES (1, 'python');
+        INSERT INTO tag VALUES (2, 'python');
+        INSERT INTO entry_tags VALUES (1, 1);
+        INSERT INTO entry_tags VALUES (1, 2);
+        """)
+        assert data_layer.migrate(conn) == versions
+        assert data_layer.migrate(conn) == []
+        assert conn.execute('SELECT * FROM tag').fetchall() == [(1, 'python')]
+        assert conn.execute('SELECT * FROM entry_tags').fetchall() == [(1, 1)]
+        assert conn.execute("SELECT value FROM counter \
+                             WHERE name = 'tag:python'").fetchone()[0] == 1
+        conn.close()
+        os.close(fd)
+        os.unlink(path)
+
+        # Creating the tables again over the test database
+        self.insert_sample_entries(1)
+        data_layer.init_db(testdb=True)
+        conn = sqlite3.connect(app.config['DATABASE'])
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == versions[-1]
+        assert conn.execute('SELECT COUNT(*) FROM entry').fetchone()[0] == 0
+        conn.close()
+        self.insert_sample_entries(1, text=u'We run the tests')
+        assert '<mark>run</mark>' in self.app.get('/search?q=running').data
+
+    def test_search(self):
+        """
+        Tests full-text search, highlighting and its pages, and that
+        databases migrated without FTS5 find nothing.
+        """
+        self.insert_sample_entries(1, title=u'Running',
+                                   text=u'We <b>run</b> the tests', tags='')
+        self.insert_sample_entries(6)
+        rv = self.app.get('/search?q=runs')
+        assert '<mark>run</mark>' in rv.data
+        assert '&lt;b&gt;' in rv.data
+        rv = self.app.get('/search?q=test+"this')
+        assert '/search?q=test+%22this&amp;page=2' in rv.data
+        assert self.app.get('/search?q=test&page=9').status_code == 404
+        rv = self.app.get('/search?q=nothing')
+        assert 'No entries match' in rv.data
+
+        has_fts5 = blog_db.has_fts5
+        blog_db.has_fts5 = lambda: False
+        try:
+            data_layer.dispose()
+            os.unlink(app.config['DATABASE'])
+            data_layer.init_db(testdb=True)
+        finally:
+            blog_db.has_fts5 = has_fts5
+        self.insert_sample_entries(1, title=u'Running')
+        rv = self.app.get('/search?q=running')
+        assert rv.status_code == 200
+        assert 'No entries match' in rv.data
+
+    def test_freeze(self):
+        """Tests freezing the public pages and re-freezing them."""
+        self.insert_sample_entries(7)
+        # The entries share their slug and date, and so their page
+        urls = [url for url, digest in freeze.enumerate_pages()]
+        assert len(urls) == len(set(urls))
+        destination = tempfile.mkdtemp()
+        try:
+            report = freeze.freeze(destination, processes=1)
+            assert report['failed'] == []
+            for path in ('index.html', 'recent.atom', 'blog/index.html',
+                         'blog/page/2/index.html',
+                         'blog/tags/tag1/page/2/index.html'):
+                assert os.path.exists(os.path.join(destination, path))
+            rv = open(os.path.join(destination, 'blog/index.html')).read()
+            assert 'href="/blog/page/2"' in rv
+            # Only the pages without entries are rendered again
+            report = freeze.freeze(destination, processes=1)
+            assert report['rendered'] == 2
+        finally:
+            shutil.rmtree(destination)
+
+    def test_import(self):
+        """Tests the bulk import of Markdown posts."""
+        directory = tempfile.mkdtemp()
+        try:
+            for i in range(3):
+                f = open(os.path.join(directory, 'post%d.md' % i), 'w')
+                f.write('---\ntitle: Post %d\ndate: 2010-11-0%d\n'
+                        'tags: [python, flask]\n---\n*Hello* %d' % (i, i+1, i))
+                f.close()
+            open(os.path.join(directory, 'broken.md'), 'w').write('Hello')
+            report = importer.import_posts(directory, 'test', processes=1)
+            assert report['imported'] == 3
+            assert report['failed'][0][1] == 'Missing front matter'
+            # Posts already imported are skipped
+            report = importer.import_posts(directory, 'test', processes=1)
+            assert report['imported'] == 0 and report['skipped'] == 3
+        finally:
+            shutil.rmtree(directory)
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            assert data_layer.count_entries() == 3
+            assert data_layer.count_entries('python') == 3
+            data_layer.close()
+        rv = self.app.get('/blog/articles/2010/11/2/post-1')
+        assert '<em>Hello</em> 1' in rv.data
+
+    def test_excerpts(self):
+        """
+        Tests that listings show the stored excerpt of an entry and
+        its page the full text.
+        """
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            content_html = helpers.render_markdown('Intro\n\n* * *\n\nRest')
+            data_layer.insert_entries([{'title': u'Long', 'slug': u'long',
+                                        'body': 'Intro\n\n* * *\n\nRest',
+                                        'content_html': content_html,
+                                        'render_version': helpers.render_version(),
+                                        'creation_date': datetime.date(2010, 11, 5),
+                                        'tags': ['python']}], 1)
+            assert g.db.execute('SELECT excerpt_html FROM entry').fetchone()[0] \
+                   == '<p>Intro</p>\n'
+            data_layer.close()
+        for url in ('/blog', '/blog/tags/python', '/recent.atom'):
+            rv = self.app.get(url)
+            assert 'Intro' in rv.data and 'Rest' not in rv.data
+            assert 'Read more about' in rv.data
+        rv = self.app.get('/blog/articles/2010/11/5/long')
+        assert 'Intro' in rv.data and 'Rest' in rv.data
+        assert 'Read more about' not in rv.data
+
+    def test_gae_authors(self):
+        """
+        Tests that the authors of datastore entries are fetched with
+        one batch get, and then cached.
+        """
+        class FakeUser(object):
+            def __init__(self, username):
+                self.username = username
+        fake = FakeDatastore({'User:ann': FakeUser('ann'),
+                              'User:bob': FakeUser('bob')})
+        entries = [FakeEntry(i, ['User:ann', 'User:bob', 'User:eve'][i % 3])
+                   for i in range(9)]
+        blog_db.db, blog_db.Entry = fake, FakeEntry
+        blog_db._authors.clear()
+        try:
+            result = blog_db.gqlentries_to_list(entries)
+            assert [entry['author'] for entry in result[:3]] == \
+                   ['ann', 'bob', None]
+            assert result[0]['user_id_FK'] == 'User:ann'
+            assert fake.gets == [['User:ann', 'User:bob', 'User:eve']]
+            # Known authors come from the cache
+            blog_db.gqlentries_to_list(entries[:2])
+            assert len(fake.gets) == 1
+        finally:
+            del blog_db.db, blog_db.Entry
+            blog_db._authors.clear()
+
+    def test_memory_layer(self):
+        """
+        Tests that the memory layer lists, pages and finds entries as
+        the sqlite one does, and that the views run on it.
+        """
+        memory = blog_db.MemoryLayer()
+        memory.init_db(testdb=True)
+        posts = [{'title': u'Post %d' % i, 'slug': u'post-%d' % i,
+                  'body': u'Word%d *text*' % i,
+                  'content_html': helpers.render_markdown(u'Word%d *text*' % i),
+                  'render_version': helpers.render_version(),
+                  'creation_date': datetime.date(2010, 1 + i % 3, 1 + i % 5),
+                  'tags': [i % 2 and 'odd' or 'even', 'all']}
+                 for i in range(13)]
+
+        def listed(entries):
+            return [(entry['id'], entry['slug'], entry['author'],
+                     sorted(entry['tags'])) for entry in entries]
+
+        with app.test_request_context():
+            g.db = data_layer.connect_db()
+            for layer in (data_layer, memory):
+                assert layer.insert_entries(posts, 2) == 13
+            for tagname in (None, 'even', 'all', 'missing'):
+                assert data_layer.count_entries(tagname) == \
+                       memory.count_entries(tagname)
+                for offset in (0, 5, 10, 15):
+                    entries, total = data_layer.get_entries(tagname, offset)
+                    found, found_total = memory.get_entries(tagname, offset)
+                    assert (listed(entries), total) == (listed(found), found_total)
+            for page in (1, 2, 3, 4):
+                cursor = data_layer.page_cursor(None, page)
+                assert cursor == memory.page_cursor(None, page)
+                if cursor is not None:
+                    assert data_layer.page_number(None, cursor) == \
+                           memory.page_number(None, cursor) == page
+                    assert listed(data_layer.get_entries(None, 0, cursor)[0]) \
+                           == listed(memory.get_entries(None, 0, cursor)[0])
+            # The page boundaries move with the next write
+            newest = dict(posts[0], slug=u'post-13',
+                          creation_date=datetime.date(2010, 12, 31))
+            for layer in (data_layer, memory):
+                assert layer.insert_entries([newest], 2) == 1
+            for page in (2, 3):
+                cursor = data_layer.page_cursor(None, page)
+                assert cursor == memory.page_cursor(None, page)
+                assert data_layer.page_number(None, cursor) == page
+            # A cursor on a tag listing counts the entries with the tag
+            evens = data_layer.get_entries('even', 5)[0]
+            cursor = blog_db.format_cursor((str(evens[0]['creation_date']),
+                                            evens[0]['id']))
+            assert data_layer.page_number('even', cursor) == \
+                   memory.page_number('even', cursor) == 2
+            assert data_layer.page_number(None, cursor) == \
+                   memory.page_number(None, cursor)
+            assert listed([data_layer.get_entry(u'post-3',
+                                                datetime.date(2010, 1, 4))]) == \
+                   listed([memory.get_entry(u'post-3', datetime.date(2010, 1, 4))])
+            assert listed(data_layer.get_recent_entries(4)) == \
+                   listed(memory.get_recent_entries(4))
+            assert [entry['id'] for entry in data_layer.get_archive()] == \
+                   [entry['id'] for entry in memory.get_archive()]
+            assert memory.get_user('test')['password'] == \
+                   data_layer.get_user('test')['password']
+            assert memory.load_user_profile(1) == data_layer.load_user_profile(1)
+            data_layer.close()
+
+        views.data_layer = memory
+        try:
+            assert 'Post 9' in self.app.get('/blog/tags/odd').data
+            rv = self.app.get('/blog/articles/2010/1/4/post-3')
+            assert '<em>text</em>' in rv.data
+            rv = self.app.get('/search?q=word7')
+            assert '<mark>Word7</mark>' in rv.data
+        finally:
+            views.data_layer = data_layer
+
+    def test_markdown_converter(self):
+        """
+        Tests that converters are reused within a thread, start every
+        text afresh and are not shared between threads.
+        """
+        extensions = ['codehilite']
+        converter = markdown.get_converter(extensions)
+        assert markdown.get_converter(extensions) is converter
+        assert markdown.get_converter([]) is not converter
+        text = '[Flask][1]\n\n[1]: http://flask.pocoo.org/'
+        assert converter.convert(text) == markdown.markdown(text, extensions)
+        # The reference above is gone
+        assert 'href' not in markdown.get_converter(extensions).convert('[Flask][1]')
+
+        # Nor do the abbreviations and footnotes of the previous text stay
+        extensions = ['abbr', 'footnotes']
+        documents = ['An HTML page[^1].\n\n*[HTML]: HyperText\n\n[^1]: A note.',
+                     'An HTML page, and CSS.\n\n*[CSS]: Style Sheets']
+        for block_cache in (None, markdown.cache.RenderCache(size=64)):
+            for text in documents:
+                converter = markdown.get_converter(extensions,
+                                                   block_cache=block_cache)
+                fresh = markdown.Markdown(extensions=extensions)
+                assert converter.convert(text) == fresh.convert(text)
+
+        converters = []
+        thread = threading.Thread(target=lambda:
+                                  converters.append(markdown.get_converter(extensions)))
+        thread.start()
+        thread.join()
+        assert converters[0] is not converter
+
+    def test_inline_search(self):
+        """
+        Tests that searching for the inline patterns gives the HTML
+        matching them from the start of the text gives.
+        """
+        text = ('**x* y* [a](http://a/ "t") [b][1] ![i](p.png) `*c*` '
+                '<http://e.com/> <b>b</b> AT&amp;T \\*e\\* _u_ __s__  \n'
+                '***y*** [x] [a [b](c) d](e)\n\n[1]: http://one/\n')
+        inline = markdown.treeprocessors.InlineProcessor
+        for extensions in ([], ['extra']):
+            html = markdown.markdown(text, extensions)
+            inline.searchPatterns = False
+            try:
+                assert markdown.markdown(text, extensions) == html
+            finally:
+                inline.searchPatterns = True
+        assert '<a href="http://one/">b</a>' in html
+        assert '<code>*c*</code>' in html
+
+    def test_ordered_dict(self):
+        """
+        Tests that the cached positions and values of the processor
+        registries follow every change.
+        """
+        d = markdown.odict.OrderedDict()
+        d['a'] = 1
+        d['c'] = 3
+        for i in range(10):
+            assert d.index('c') == 1
+        d.add('b', 2, '<c')
+        d.add('z', 26, '_begin')
+        d.add('d', 4, '>c')
+        assert d.keys() == ['z', 'a', 'b', 'c', 'd']
+        assert [d.index(key) for key in d.keys()] == range(5)
+        assert d.value_for_index(2) == 2
+        d['b'] = 'two'
+        assert d.value_for_index(2) == 'two'
+        d.link('z', '_end')
+        assert d.index('z') == 4 and d.value_for_index(0) == 1
+        del d['a']
+        assert d.values() == ['two', 3, 4, 26]
+        self.assertRaises(ValueError, d.link, 'z', '<missing')
+        assert d.keys() == ['b', 'c', 'd', 'z']
+        d.keyOrder = ['z', 'd', 'c', 'b']
+        assert d.index('z') == 0 and d.value_for_index(0) == 26
+
+    def test_markdown_cache(self):
+        """
+        Tests the render cache tiers: outputs are keyed by the text and
+        the pipeline, the memory tier is bounded, the SQLite store
+        is shared between caches and the stores can be bounded too.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            store = markdown.cache.SQLiteStore(os.path.join(directory, 'render.db'))
+            cache = markdown.cache.RenderCache(size=2, store=store)
+            html = markdown.markdown('*cached*', cache=cache)
+            assert html == markdown.markdown('*cached*')
+            assert markdown.markdown('*cached*', cache=cache) == html
+            # Another pipeline is another key
+            assert markdown.markdown('*cached*', ['codehilite'], cache=cache) == html
+            markdown.markdown('*evicted*', cache=cache)
+            stats = cache.stats()
+            assert (stats['hits'], stats['misses'], stats['size']) == (1, 3, 2)
+
+            # A second process finds the outputs in the store
+            other = markdown.cache.RenderCache(size=2, store=store)
+            assert markdown.markdown('*cached*', cache=other) == html
+            assert other.stats()['store_hits'] == 1
+
+            # Outputs are not looked up again once they are in memory
+            other.store = None
+            assert markdown.markdown('*cached*', cache=other) == html
+            assert other.stats()['hits'] == 1
+            # Extensions keeping their settings in a list
+            assert '<abbr' in markdown.markdown('A\n\n*[A]: Letter', ['abbr'],
+                                                cache=other)
+
+            # Bounded stores evict their least recently used outputs
+            keys = ['%040d' % i for i in range(30)]
+            store = markdown.cache.SQLiteStore(os.path.join(directory, 'lru.db'),
+                                               limit=10)
+            for key in keys:
+                store.set(key, u'<p>%s</p>' % key)
+            assert len([key for key in keys if store.get(key)]) == 10
+            store._connection().execute('UPDATE render SET used = 0')
+            assert store.get(keys[-1]) and store.prune(1) == 9
+            assert [key for key in keys if store.get(key)] == keys[-1:]
+
+            store = markdown.cache.DirectoryStore(os.path.join(directory, 'lru'),
+                                                  limit=10)
+            for key in keys:
+                store.set(key, u'<p>%s</p>' % key)
+            assert len([key for key in keys if store.get(key)]) == 10
+            for key in keys:
+                if os.path.exists(store._path(key)):
+                    os.utime(store._path(key), (0, 0))
+            assert store.get(keys[-1]) and store.prune(1) == 9
+            assert [key for key in keys if store.get(key)] == keys[-1:]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_incremental_markdown(self):
+        """
+        Tests the block cache: after an edit, only the chunks which
+        changed or depend on a changed reference, abbreviation or
+        footnote are rendered again, and the output is unchanged.
+        """
+        extensions = ['codehilite', 'abbr', 'footnotes']
+        blocks = ['# Title', 'A [link][home] to the HTML page[^1].',
+                  '* one\n* two', '* three', 'Plain text.',
+                  '    :::python\n    print "code"', '> A quote[^2].',
+                  '[home]: http://example.com/', '*[HTML]: Markup',
+                  '[^1]: First note.', '[^2]: Second note.']
+        cache = markdown.cache.RenderCache(size=100)
+        md = markdown.Markdown(extensions, block_cache=cache)
+
+        def check(blocks):
+            text = '\n\n'.join(blocks)
+            misses = cache.stats()['misses']
+            md.reset()
+            assert md.convert(text) == markdown.markdown(text, extensions)
+            return cache.stats()['misses'] - misses
+
+        # Lists, code and quotes go with the blocks before them, the
+        # footnotes are the last chunk
+        assert check(blocks) == 4
+        assert check(blocks) == 0
+        blocks[4] = 'Plain text, edited.'
+        assert check(blocks) == 1
+        blocks[7] = '[home]: http://example.com/home'
+        assert check(blocks) == 1
+        blocks[8] = '*[HTML]: HyperText Markup Language'
+        assert check(blocks) == 1
+        # Swapping the footnotes renumbers them in the text
+        blocks[9:] = blocks[:8:-1]
+        assert check(blocks) == 3
+        blocks[3] = '* four'
+        assert check(blocks) == 1
+        # Header ids depend on the whole document: no chunks
+        misses = cache.stats()['misses']
+        text = '\n\n'.join(blocks)
+        assert markdown.Markdown(['headerid'], block_cache=cache).convert(text) \
+               == markdown.markdown(text, ['headerid'])
+        assert cache.stats()['misses'] == misses
+
+        # The blog keeps the blocks in memory, even with a store
+        settings = dict(app.config)
+        try:
+            app.config['MARKDOWN_CACHE_STORE'] = os.path.join(
+                tempfile.gettempdir(), 'unused-render.db')
+            assert helpers.block_cache().store is None
+            app.config['MARKDOWN_BLOCK_CACHE_SIZE'] = 0
+            assert helpers.block_cache() is None
+        finally:
+            app.config.update(settings)
+
     def test_pagination(self):
         """
         Tests if the pagination algorithms works correctly.
@@ -215,6 +987,7 @@ class BlogTestCase(unittest.TestCase):
         using every time a different number of entries.
         This test assumes that MAX_PAGES_ENTRIES = 5 (See config)
         """
+        today = datetime.date.today()
         # Login
         self.login('test','test')
         # Create eight entries                      
@@ -225,7 +998,8 @@ class BlogTestCase(unittest.TestCase):
         assert """<span>\xe2\x80\xb9\xe2\x80\xb9 previous</span>\n  \n  \n    \n      """ in rv.data
         assert """<span>1</span>\n    \n  \n    \n      """ in rv.data
         assert """<a href="/?page=2">2</a>\n    \n  \n  \n    """ in rv.data
-        assert """<a href="/?page=2">next \xe2\x80\xba\xe2\x80\xba</a>\n  </div>""" in rv.data
+        # The next link seeks past the last entry of the page (id 4)
+        assert """<a href="/blog?before=%s_4">next \xe2\x80\xba\xe2\x80\xba</a>\n  </div>""" % today in rv.data
         # Add eighty-two more entries to trigger pagination split functions -> (82+8)/5 = 18
         self.create_sample_entries(82)
         # Expecting this pagination -> ‹‹ previous 1 2 3 4 ... 15 16 17 18 next ››
@@ -242,7 +1016,7 @@ class BlogTestCase(unittest.TestCase):
         assert """<a href="/?page=16">16</a>\n    \n  \n    \n""" in rv.data
         assert """<a href="/?page=17">17</a>\n    \n  \n    \n""" in rv.data      
         assert """<a href="/?page=18">18</a>\n    \n  \n  \n""" in rv.data    
-        assert """<a href="/?page=2">next \xe2\x80\xba\xe2\x80\xba</a>\n  </div>""" in rv.data
+        assert """<a href="/blog?before=%s_86">next \xe2\x80\xba\xe2\x80\xba</a>\n  </div>""" % today in rv.data
 
         # TODO Write all pagination cases
 